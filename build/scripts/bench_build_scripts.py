@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+""" Offline benchmarks of the build scripts.
+
+Times the DTS parser (fdt_hotfix), the FDT patching functions (fdt_patcher),
+the platform configuration parser (config_parser) and the manifest generation
+(build_peregrine) on synthetic inputs (see bench_generators.py). Nothing is
+built and no external tool is invoked.
+
+Usage:
+    $ ./bench_build_scripts.py --scale medium --out results.json
+    $ ./bench_build_scripts.py --scale medium --baseline results.json
+
+When a baseline is given, the median time of each benchmark is compared against
+it and the script exits with status 1 if any of them got slower by more than
+`--threshold`, or by more than the noise of the two medians if that is larger.
+Each benchmark runs at least `--iterations` times and until `--min-time` seconds
+were measured.
+
+With `--fdt`, the VM device tree patching flow that reparses and stores the
+tree after every step is compared against `fdt_patcher.FdtPipeline` on
+existing DTS / DTB files instead:
+    $ ./bench_build_scripts.py --fdt ../targets/fvp/vm-dts/primary_vm_fdt.dts
+"""
+
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fdt
+from fdt_hotfix import FDT_HOTFIX
+import fdt_patcher
+import config_parser
+import build_peregrine
+import bench_generators
+
+# generator parameters of each predefined scale
+SCALES = {
+    "small":  {"nodes": 200,   "buses": 4,  "depth": 3, "aliases": 50,   "cpus": 8,   "vms": 4},
+    "medium": {"nodes": 2000,  "buses": 8,  "depth": 4, "aliases": 500,  "cpus": 64,  "vms": 16},
+    "large":  {"nodes": 10000, "buses": 16, "depth": 6, "aliases": 2000, "cpus": 256, "vms": 64},
+}
+
+# initrd placeholders used by the VM DTS templates (not valid DTS by themselves)
+FDT_SUBSTITUTIONS = [ ("<initrd-start>", "<0x85000000>"),
+                      ("<initrd-end>",   "<0x86000000>") ]
+
+# memory size and kernel base address of the patching benchmarks
+FDT_MEMORY = (0x20000000, 0x80000000)
+
+
+class BenchContext:
+    """ Inputs shared by all benchmarks """
+
+    def __init__(self, work_dir, params):
+        """ Initializer for BenchContext
+
+        Args:
+            work_dir (str): Scratch directory
+            params (dict): Generator parameters (see `SCALES`)
+        """
+
+        self.work_dir = work_dir
+        self.params = params
+
+        self.dts_text = bench_generators.generate_dts(
+            nodes=params["nodes"], buses=params["buses"], depth=params["depth"],
+            aliases=params["aliases"], cpus=params["cpus"], seed=params["seed"])
+        self.whitelist = bench_generators.generate_whitelist(
+            params["nodes"], params["buses"], params["depth"], seed=params["seed"])
+
+        self.dtb_path = os.path.join(work_dir, "bench.dtb")
+        with open(self.dtb_path, "wb") as f:
+            f.write(bench_generators.generate_dtb(self.dts_text))
+
+        self.root = os.path.join(work_dir, "root")
+        self.config_path = bench_generators.write_platform(
+            self.root, self.dts_text, vm_count=params["vms"],
+            cpus_per_vm=max(1, params["cpus"] // params["vms"]),
+            whitelist=self.whitelist)
+        with open(self.config_path, "r") as f:
+            self.config_text = f.read()
+
+        self.tree = FDT_HOTFIX.parse_dts(self.dts_text)
+
+    def fresh_tree(self):
+        """ Newly parsed tree, for benchmarks that modify it """
+        return FDT_HOTFIX.parse_dts(self.dts_text)
+
+    def platform_config(self):
+        """ Parses the platform configuration """
+        config_parser.set_root(self.root)
+        return config_parser.PlatformConfig.from_json(self.config_text)
+
+    def prepare_builder(self):
+        """ Sets up `Builder` as `build_vms()` would leave it
+
+        Returns:
+            list(VM): parsed VM configurations
+        """
+
+        Builder = build_peregrine.Builder
+        Builder.BUILD_ROOT = self.root + "/"
+        Builder.config = self.platform_config()
+        Builder.cpio_members = {}
+
+        config_parser.vm_count = 0
+        vms = []
+        vm_dir = os.path.join(Builder.config.build_options["target_dir"], "VMs")
+        for name in sorted(os.listdir(vm_dir)):
+            with open(os.path.join(vm_dir, name), "r") as f:
+                vm = config_parser.VM.from_json(f.read())
+            vms.append(vm)
+            Builder.cpio_members[f"{vm.vm_id}_{os.path.basename(vm.kernel_path)}"] = vm.kernel_path
+
+        return vms
+
+
+def _benchmarks(ctx):
+    """ List of benchmarks
+
+    Args:
+        ctx (BenchContext): Shared inputs
+
+    Returns:
+        list(tuple(str, callable, callable)): (name, setup, run); `setup()` is
+            not timed and its result is passed to `run()`
+    """
+
+    mem_args = (0x20000000, 0x80000000, 0x84000000, 0x85000000)
+    manifest_path = os.path.join(ctx.work_dir, "manifest.dtb")
+    num_cpus = max(1, ctx.params["cpus"] // 2)
+
+    return [
+        ("parse_dts",
+            None, lambda _: FDT_HOTFIX.parse_dts(ctx.dts_text)),
+        ("parse_fdt (dtb)",
+            None, lambda _: fdt_patcher.parse_fdt(ctx.dtb_path)),
+        ("get_nodelist",
+            None, lambda _: fdt_patcher.get_nodelist(ctx.tree)),
+        ("get_nodelist (minimal)",
+            None, lambda _: fdt_patcher.get_nodelist(ctx.tree, minimal=True)),
+        ("apply_whitelist",
+            ctx.fresh_tree, lambda tree: fdt_patcher.apply_whitelist(tree, ctx.whitelist)),
+        ("apply_whitelist (prune dependents)",
+            ctx.fresh_tree, lambda tree: fdt_patcher.apply_whitelist(tree, ctx.whitelist, True)),
+        ("set_memory",
+            ctx.fresh_tree, lambda tree: fdt_patcher.set_memory(tree, *mem_args)),
+        ("trim_excess_cpus",
+            ctx.fresh_tree, lambda tree: fdt_patcher.trim_excess_cpus(tree, num_cpus)),
+        ("store_fdt (dts)",
+            None, lambda _: fdt_patcher.store_fdt(os.path.join(ctx.work_dir, "out.dts"), ctx.tree)),
+        ("store_fdt (dtb)",
+            None, lambda _: fdt_patcher.store_fdt(os.path.join(ctx.work_dir, "out.dtb"), ctx.tree)),
+        ("PlatformConfig.from_json",
+            None, lambda _: ctx.platform_config()),
+        ("extract_platform_details",
+            ctx.platform_config, lambda config: config.extract_platform_details()),
+        ("create_merged_manifest",
+            ctx.prepare_builder,
+            lambda vms: build_peregrine.Builder.create_merged_manifest(manifest_path, vms)),
+    ]
+
+
+def measure(run, setup=None, iterations=5, min_time=0.0):
+    """ Times a function
+
+    Args:
+        run (callable): Timed function; receives the result of `setup()`
+        setup (callable, optional): Untimed preparation of each iteration
+        iterations (int, optional): Minimum number of runs. Defaults to 5.
+        min_time (float, optional): Keep running until the timed runs add up
+            to this many seconds. Defaults to 0.
+
+    Returns:
+        dict: min / first quartile / median / third quartile / max wall time
+            [ms] and number of runs
+    """
+
+    times = []
+    while len(times) < iterations or sum(times) < min_time * 1000:
+        arg = setup() if setup else None
+        gc.collect()
+
+        start = time.perf_counter()
+        run(arg)
+        times.append((time.perf_counter() - start) * 1000)
+
+    quartiles = statistics.quantiles(times) if len(times) > 1 else times * 3
+    return {"min_ms": min(times),
+            "q1_ms": quartiles[0],
+            "median_ms": quartiles[1],
+            "q3_ms": quartiles[2],
+            "max_ms": max(times),
+            "iterations": len(times)}
+
+
+def run_benchmarks(params, iterations=5, only=None, min_time=0.0):
+    """ Generates the inputs and runs all benchmarks
+
+    Args:
+        params (dict): Generator parameters (see `SCALES`)
+        iterations (int, optional): Minimum runs per benchmark. Defaults to 5.
+        min_time (float, optional): Minimum measured time per benchmark [s].
+            Defaults to 0.
+        only (list(str), optional): Names of the benchmarks to run. Defaults
+            to all of them.
+
+    Returns:
+        dict: benchmark name -> timings (see `measure()`)
+    """
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        ctx = BenchContext(work_dir, params)
+
+        print('%-40s %12s %12s %12s' % ('benchmark', 'min [ms]', 'median [ms]', 'max [ms]'))
+        for name, setup, run in _benchmarks(ctx):
+            if only and name not in only:
+                continue
+
+            # benchmarked functions print their own diagnostics; hide them
+            with open(os.devnull, "w") as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    results[name] = measure(run, setup, iterations, min_time)
+                finally:
+                    sys.stdout = stdout
+
+            print('%-40s %12.2f %12.2f %12.2f' % (name, results[name]["min_ms"],
+                  results[name]["median_ms"], results[name]["max_ms"]))
+
+    return results
+
+
+def _patch_stepwise(fdt_in, work_dir, num_cpus, whitelist):
+    """ Reparses and stores the tree after every patching step, as the build
+    did before `FdtPipeline` (`dtc` compiles the result if available) """
+
+    work_name = os.path.join(work_dir, os.path.basename(fdt_in))
+    shutil.copyfile(fdt_in, work_name)
+
+    if work_name.endswith(".dts"):
+        with open(work_name, "r") as f:
+            text = f.read()
+        for old, new in FDT_SUBSTITUTIONS:
+            text = text.replace(old, new)
+        with open(work_name, "w") as f:
+            f.write(text)
+
+    steps = [ (fdt_patcher.set_memory, FDT_MEMORY),
+              (fdt_patcher.trim_excess_cpus, (num_cpus,)) ]
+    if whitelist:
+        steps.append((fdt_patcher.apply_whitelist, (whitelist,)))
+
+    for func, args in steps:
+        fdt_data = fdt_patcher.parse_fdt(work_name)
+        func(fdt_data, *args)
+        fdt_patcher.store_fdt(work_name, fdt_data)
+
+    if work_name.endswith(".dts") and shutil.which("dtc"):
+        subprocess.run(["dtc", "-I", "dts", "-O", "dtb", "-o",
+                        work_name[:-1] + "b", work_name], check=True)
+
+
+def _patch_pipeline(fdt_in, work_dir, num_cpus, whitelist):
+    """ Single parse, in-memory passes and native DTB emission """
+
+    pipeline = fdt_patcher.FdtPipeline(fdt_in)
+    for old, new in FDT_SUBSTITUTIONS:
+        pipeline.substitute(old, new)
+    pipeline.add_pass("set_memory", fdt_patcher.set_memory, *FDT_MEMORY)
+    pipeline.add_pass("trim_excess_cpus", fdt_patcher.trim_excess_cpus, num_cpus)
+    if whitelist:
+        pipeline.add_pass("apply_whitelist", fdt_patcher.apply_whitelist, whitelist)
+
+    pipeline.run()
+    pipeline.store(os.path.join(work_dir, "out.dtb"))
+
+
+def compare_patching(fdt_files, iterations=5, num_cpus=2, whitelist=None):
+    """ Times step-wise patching against `FdtPipeline` on existing trees
+
+    Args:
+        fdt_files (list(str)): DTS / DTB files
+        iterations (int, optional): Runs per file. Defaults to 5.
+        num_cpus (int, optional): CPUs to retain. Defaults to 2.
+        whitelist (list(str), optional): Node paths to keep. Defaults to all.
+
+    Returns:
+        dict: file name -> {"stepwise": timings, "pipeline": timings} (see
+            `measure()`)
+    """
+
+    if not shutil.which("dtc"):
+        print("WAR: `dtc` not found; step-wise timings exclude DTS compilation")
+
+    results = {}
+    print("%-40s %14s %14s %8s" % ("file", "stepwise [ms]", "pipeline [ms]", "speedup"))
+    with tempfile.TemporaryDirectory() as work_dir:
+        for fdt_in in fdt_files:
+            result = results[os.path.basename(fdt_in)] = {}
+            for name, func in (("stepwise", _patch_stepwise), ("pipeline", _patch_pipeline)):
+                # the patching functions print their own diagnostics; hide them
+                with open(os.devnull, "w") as devnull:
+                    stdout, sys.stdout = sys.stdout, devnull
+                    try:
+                        result[name] = measure(
+                            lambda _: func(fdt_in, work_dir, num_cpus, whitelist),
+                            iterations=iterations)
+                    finally:
+                        sys.stdout = stdout
+
+            print("%-40s %14.2f %14.2f %7.2fx" % (os.path.basename(fdt_in),
+                  result["stepwise"]["min_ms"], result["pipeline"]["min_ms"],
+                  result["stepwise"]["min_ms"] / result["pipeline"]["min_ms"]))
+
+    return results
+
+
+def median_error(timings):
+    """ Estimates the standard error of a median wall time
+
+    Args:
+        timings (dict): Timings (see `measure()`)
+
+    Returns:
+        float: standard error [ms], from the interquartile range of the runs
+            (their min-max range for results without quartiles)
+    """
+
+    spread = timings.get("q3_ms", timings["max_ms"]) - timings.get("q1_ms", timings["min_ms"])
+    # IQR = 1.349 sigma for normally distributed times
+    return 1.2533 * (spread / 1.349) / math.sqrt(timings["iterations"])
+
+
+def tolerance(baseline, result, threshold):
+    """ Relative slowdown of the median wall time that is not a regression
+
+    Args:
+        baseline (dict): Baseline timings (see `measure()`)
+        result (dict): Current timings (see `measure()`)
+        threshold (float): Minimum tolerance, e.g.: 0.1 for 10%
+
+    Returns:
+        float: `threshold`, or twice the combined standard error of both
+            medians relative to the baseline if that is larger (a change
+            within the noise cannot be told apart from it)
+    """
+
+    error = math.hypot(median_error(baseline), median_error(result))
+    return max(threshold, 2 * error / max(baseline["median_ms"], 1e-6))
+
+
+def compare(results, baseline, threshold):
+    """ Compares results against a baseline (by median wall time)
+
+    Args:
+        results (dict): Output of `run_benchmarks()`
+        baseline (dict): Output of a previous `run_benchmarks()`
+        threshold (float): Tolerated slowdown, e.g.: 0.1 for 10%; raised to
+            the noise of each benchmark (see `tolerance()`)
+
+    Returns:
+        list(str): names of the benchmarks that regressed
+    """
+
+    regressions = []
+
+    print('%-40s %12s %12s %8s %8s' % ('benchmark', 'base [ms]', 'now [ms]', 'ratio', 'tol.'))
+    for name, result in results.items():
+        if name not in baseline:
+            print('%-40s %12s %12.2f %8s' % (name, '-', result["median_ms"], 'new'))
+            continue
+
+        tol = tolerance(baseline[name], result, threshold)
+        ratio = result["median_ms"] / max(baseline[name]["median_ms"], 1e-6)
+        status = ''
+        if ratio > 1 + tol:
+            status = 'SLOWER'
+            regressions.append(name)
+        elif ratio < 1 - tol:
+            status = 'faster'
+
+        print('%-40s %12.2f %12.2f %7.2fx %7.0f%% %s' % (name, baseline[name]["median_ms"],
+              result["median_ms"], ratio, tol * 100, status))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                        prog='bench_build_scripts.py',
+                        description='Offline benchmarks of the build scripts')
+    parser.add_argument('--scale', choices=SCALES.keys(), default='medium',
+                        help='predefined input size (default: medium)')
+    for key in SCALES['small']:
+        parser.add_argument('--%s' % key, type=int, metavar='N', default=None,
+                            help='override the %s of the selected scale' % key)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the input generators (default: 0)')
+    parser.add_argument('-n', '--iterations', type=int, default=5,
+                        help='minimum runs per benchmark (default: 5)')
+    parser.add_argument('--min-time', type=float, metavar='SECONDS', default=1.0,
+                        help='minimum measured time per benchmark (default: 1.0)')
+    parser.add_argument('--only', action='append', metavar='NAME', default=None,
+                        help='run only this benchmark (repeatable)')
+    parser.add_argument('-o', '--out', metavar='FILE', type=str,
+                        help='write results as JSON')
+    parser.add_argument('-b', '--baseline', metavar='FILE', type=str,
+                        help='compare against the JSON results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='tolerated slowdown w.r.t. the baseline, raised to '
+                             'the noise of the medians (default: 0.1)')
+    parser.add_argument('--fdt', action='append', metavar='FILE', default=None,
+                        help='compare step-wise FDT patching against the pipeline '
+                             'on this DTS / DTB instead (repeatable)')
+    parser.add_argument('--fdt-cpus', type=int, metavar='N', default=2,
+                        help='CPUs retained by --fdt (default: 2)')
+    parser.add_argument('--fdt-whitelist', metavar='FILE', type=str,
+                        help='node paths (one per line) whitelisted by --fdt')
+    args = parser.parse_args()
+
+    if args.fdt:
+        whitelist = None
+        if args.fdt_whitelist:
+            with open(args.fdt_whitelist, 'r') as f:
+                whitelist = [ it.strip() for it in f if it.strip() ]
+
+        compare_patching(args.fdt, args.iterations, args.fdt_cpus, whitelist)
+        return
+
+    params = dict(SCALES[args.scale], seed=args.seed)
+    for key in SCALES['small']:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+
+    results = run_benchmarks(params, args.iterations, args.only, args.min_time)
+
+    report = {
+        "params": params,
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "fdt": getattr(fdt, "__version__", None),
+        },
+        "results": results,
+    }
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+        if baseline.get("params") != params:
+            print('WAR: baseline was generated with different parameters: %s'
+                  % baseline.get("params"))
+
+        print()
+        regressions = compare(results, baseline["results"], args.threshold)
+        if regressions:
+            print('ERR: %d benchmark(s) slower than the baseline beyond their tolerance'
+                  % len(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+""" Synthetic inputs for the build script benchmarks (see bench_build_scripts.py).
+
+Everything is generated from a seed, so that two runs with the same parameters
+benchmark the exact same inputs:
+    - DTS / DTB files of arbitrary size: nested buses, labelled devices that
+      reference each other via phandles, a large "/aliases" node and CPU nodes
+      spread over all three MPIDR affinity levels
+    - VM configuration files (VMs/*.json) referencing these device trees
+    - a platform configuration file (<platform>.json) and its target directory
+"""
+
+import json
+import os
+import random
+
+from fdt_hotfix import FDT_HOTFIX
+import fdt_patcher
+
+DEVICE_BASE_ADDR = 0x10000000
+DEVICE_SIZE      = 0x1000
+GIC_SPI_COUNT    = 988
+
+
+def cpu_affinities(cpus, cores_per_cluster=4, clusters_per_socket=4):
+    """ MPIDR-style affinity values of a number of CPUs
+
+    Args:
+        cpus (int): Number of CPUs
+        cores_per_cluster (int, optional): CPUs sharing Aff1. Defaults to 4.
+        clusters_per_socket (int, optional): Clusters sharing Aff2. Defaults to 4.
+
+    Returns:
+        list(int): Aff2 << 16 | Aff1 << 8 | Aff0 of each CPU
+    """
+
+    affinities = []
+    for i in range(cpus):
+        aff0 = i % cores_per_cluster
+        aff1 = (i // cores_per_cluster) % clusters_per_socket
+        aff2 = i // (cores_per_cluster * clusters_per_socket)
+        affinities.append(aff2 << 16 | aff1 << 8 | aff0)
+    return affinities
+
+
+def generate_dts(nodes=1000, buses=8, depth=4, aliases=100, cpus=8,
+                 cores_per_cluster=4, clusters_per_socket=4, seed=0):
+    """ Generates a device tree source
+
+    Devices are spread round-robin over `buses` top-level buses, each of which
+    is a chain of `depth` nested buses. Every device is labelled, has "reg",
+    "interrupts" and "clocks" properties and some of them reference another
+    device via phandle (e.g.: "phys", "dmas").
+
+    Args:
+        nodes (int, optional): Number of devices. Defaults to 1000.
+        buses (int, optional): Number of top-level buses. Defaults to 8.
+        depth (int, optional): Nesting depth of each bus. Defaults to 4.
+        aliases (int, optional): Entries of "/aliases". Defaults to 100.
+        cpus (int, optional): Number of "cpu@..." nodes. Defaults to 8.
+        cores_per_cluster (int, optional): see `cpu_affinities()`
+        clusters_per_socket (int, optional): see `cpu_affinities()`
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        str: DTS text
+    """
+
+    rng = random.Random(seed)
+    buses = max(1, buses)
+    depth = max(1, depth)
+
+    out = ['/dts-v1/;', '', '/ {',
+           '\t#address-cells = <0x2>;',
+           '\t#size-cells = <0x2>;',
+           '\tcompatible = "peregrine,bench";',
+           '\tinterrupt-parent = <&gic>;',
+           '']
+
+    # "/aliases": mix of path references and plain strings
+    out.append('\taliases {')
+    for i in range(min(aliases, nodes)):
+        if i % 2:
+            out.append('\t\tserial%d = &dev%d;' % (i, i))
+        else:
+            out.append('\t\tethernet%d = "%s";' % (i, device_path(i, buses, depth)))
+    out.append('\t};')
+    out.append('')
+
+    # "/cpus"
+    out.append('\tcpus {')
+    out.append('\t\t#address-cells = <0x2>;')
+    out.append('\t\t#size-cells = <0x0>;')
+    for i, aff in enumerate(cpu_affinities(cpus, cores_per_cluster, clusters_per_socket)):
+        out.append('\t\tcpu%d: cpu@%x {' % (i, aff))
+        out.append('\t\t\tdevice_type = "cpu";')
+        out.append('\t\t\tcompatible = "arm,armv8";')
+        out.append('\t\t\treg = <0x0 0x%x>;' % aff)
+        out.append('\t\t\tenable-method = "psci";')
+        out.append('\t\t\tnext-level-cache = <&l2>;')
+        out.append('\t\t};')
+    out.append('\t\tl2: l2-cache0 {')
+    out.append('\t\t\tcompatible = "cache";')
+    out.append('\t\t};')
+    out.append('\t};')
+    out.append('')
+
+    out.append('\tmemory@80000000 {')
+    out.append('\t\tdevice_type = "memory";')
+    out.append('\t\treg = <0x0 0x80000000 0x0 0x80000000>;')
+    out.append('\t};')
+    out.append('')
+
+    out.append('\tgic: interrupt-controller@2f000000 {')
+    out.append('\t\tcompatible = "arm,gic-v3";')
+    out.append('\t\t#interrupt-cells = <0x3>;')
+    out.append('\t\tinterrupt-controller;')
+    out.append('\t\treg = <0x0 0x2f000000 0x0 0x10000>, <0x0 0x2f100000 0x0 0x200000>;')
+    out.append('\t};')
+    out.append('')
+
+    out.append('\tclk: clock {')
+    out.append('\t\tcompatible = "fixed-clock";')
+    out.append('\t\t#clock-cells = <0x0>;')
+    out.append('\t\tclock-frequency = <24000000>;')
+    out.append('\t};')
+    out.append('')
+
+    # devices of each bus level: levels[bus][level] = [device index, ...]
+    levels = [ [ [] for _ in range(depth) ] for _ in range(buses) ]
+    for i in range(nodes):
+        levels[i % buses][(i // buses) % depth].append(i)
+
+    for bus in range(buses):
+        for level in range(depth):
+            indent = '\t' * (level + 1)
+            out.append('%sbus%d_%d: bus@%x {' % (indent, bus, level, bus_addr(bus, level)))
+            out.append('%s\tcompatible = "simple-bus";' % indent)
+            out.append('%s\t#address-cells = <0x1>;' % indent)
+            out.append('%s\t#size-cells = <0x1>;' % indent)
+            out.append('%s\tranges;' % indent)
+
+            for i in levels[bus][level]:
+                addr = DEVICE_BASE_ADDR + i * DEVICE_SIZE
+                out.append('%s\tdev%d: device@%x {' % (indent, i, addr))
+                out.append('%s\t\tcompatible = "vendor,dev%d", "vendor,generic";' % (indent, i % 32))
+                out.append('%s\t\treg = <0x%x 0x%x>;' % (indent, addr, DEVICE_SIZE))
+                out.append('%s\t\tinterrupts = <0x0 0x%x 0x4>;' % (indent, i % GIC_SPI_COUNT))
+                out.append('%s\t\tclocks = <&clk>;' % indent)
+                if i > 0 and rng.random() < 0.2:
+                    out.append('%s\t\tphys = <&dev%d>;' % (indent, rng.randrange(i)))
+                out.append('%s\t\tstatus = "okay";' % indent)
+                out.append('%s\t};' % indent)
+
+        for level in reversed(range(depth)):
+            out.append('%s};' % ('\t' * (level + 1)))
+        out.append('')
+
+    out.append('\tchosen {')
+    out.append('\t\tbootargs = "console=ttyAMA0";')
+    out.append('\t};')
+    out.append('};')
+
+    return '\n'.join(out) + '\n'
+
+
+def bus_addr(bus, level):
+    """ Unit address of a bus node """
+    return 0x1000 * (bus + 1) + level
+
+
+def device_path(i, buses, depth):
+    """ Absolute path of device `i` of a tree made by `generate_dts()`
+
+    Args:
+        i (int): Device index
+        buses (int): see `generate_dts()`
+        depth (int): see `generate_dts()`
+
+    Returns:
+        str: node path
+    """
+
+    bus = i % buses
+    level = (i // buses) % depth
+    path = ''.join('/bus@%x' % bus_addr(bus, it) for it in range(level + 1))
+    return '%s/device@%x' % (path, DEVICE_BASE_ADDR + i * DEVICE_SIZE)
+
+
+def generate_dtb(dts_text):
+    """ Compiles a device tree source without `dtc`
+
+    Args:
+        dts_text (str): DTS text
+
+    Returns:
+        bytes: DTB blob
+    """
+    return fdt_patcher.to_dtb(FDT_HOTFIX.parse_dts(dts_text))
+
+
+def generate_whitelist(nodes, buses=8, depth=4, ratio=0.25, seed=0):
+    """ Picks a random subset of the devices of a generated tree
+
+    Args:
+        nodes (int): see `generate_dts()`
+        buses (int, optional): see `generate_dts()`
+        depth (int, optional): see `generate_dts()`
+        ratio (float, optional): Fraction of whitelisted devices. Defaults to 0.25.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        list(str): absolute node paths
+    """
+
+    rng = random.Random(seed)
+    picked = sorted(rng.sample(range(nodes), int(nodes * ratio)))
+    return [ '/cpus', '/memory@80000000', '/interrupt-controller@2f000000',
+             '/clock', '/chosen' ] + \
+           [ device_path(it, max(1, buses), max(1, depth)) for it in picked ]
+
+
+def generate_vm_configs(count, fdt_path, kernel_path, ramdisk_path=None,
+                        cpus_per_vm=1, devices_per_vm=4, whitelist=None,
+                        cores_per_cluster=4, clusters_per_socket=4):
+    """ Generates VM configuration files
+
+    The first VM is the primary one. Every VM gets its own physical CPUs and
+    `devices_per_vm` device regions.
+
+    Args:
+        count (int): Number of VMs
+        fdt_path (str): Device tree of every VM
+        kernel_path (str): Kernel image of every VM
+        ramdisk_path (str, optional): Ramdisk image of every VM. Defaults to None.
+        cpus_per_vm (int, optional): Physical CPUs assigned to each VM. Defaults to 1.
+        devices_per_vm (int, optional): Device regions of each VM. Defaults to 4.
+        whitelist (list(str), optional): "device_whitelist" of every VM
+        cores_per_cluster (int, optional): see `cpu_affinities()`
+        clusters_per_socket (int, optional): see `cpu_affinities()`
+
+    Returns:
+        dict: file name -> JSON text
+    """
+
+    affinities = cpu_affinities(count * cpus_per_vm, cores_per_cluster,
+                                clusters_per_socket)
+    configs = {}
+
+    for i in range(count):
+        vm = {
+            "uuid": "00000000-0000-4000-8000-%012x" % (i + 1),
+            "name": "Bench VM %d" % (i + 1),
+            "kernel_path": kernel_path,
+            "kernel_version": 1,
+            "fdt_path": fdt_path,
+            "fdt_version": 1,
+            "is_enabled": True,
+            "is_primary": i == 0,
+            "vcpu_count": cpus_per_vm,
+            "cpus": [ hex(it) for it in affinities[i * cpus_per_vm:(i + 1) * cpus_per_vm] ],
+            "memory_size": "0x20000000",
+            "ipa_memory_layout": {
+                "gic": "0x2f000000",
+                "kernel": "0x80000000",
+                "fdt": "0x84000000",
+                "ramdisk": "0x85000000"
+            },
+            "device_regions": {
+                "dev%d" % it: {
+                    "description": "Device %d" % it,
+                    "base-address": "0x00000000 %#x" % (DEVICE_BASE_ADDR + it * DEVICE_SIZE),
+                    "pages-count": 1,
+                    "attributes": "0x3",
+                    "interrupts": "%d 0x0" % (32 + it % GIC_SPI_COUNT)
+                }
+                for it in range(i * devices_per_vm, (i + 1) * devices_per_vm)
+            }
+        }
+
+        if ramdisk_path:
+            vm["ramdisk_path"] = ramdisk_path
+            vm["ramdisk_version"] = 1
+        if whitelist:
+            vm["device_whitelist"] = whitelist
+
+        configs["bench%03d.json" % i] = json.dumps({"vm": vm}, indent=2)
+
+    return configs
+
+
+def generate_platform_config(max_vms=None):
+    """ Generates a platform configuration file
+
+    Args:
+        max_vms (int, optional): Maximum number of VMs. Defaults to the
+            number of CPUs of the platform device tree.
+
+    Returns:
+        str: JSON text
+    """
+
+    platform = {
+        "uuid": "10e6c722-e384-4603-8a4a-f55477eafaff",
+        "version": 1,
+        "build_options": {
+            "debug_hypervisor": False,
+            "hypervisor_log_level": "LOG_LEVEL_INFO",
+            "debug_tfa": False,
+            "debug_kernel": False,
+            "out_dir": "$(ROOT)/out/",
+            "target_dir": "$(ROOT)/build/targets/bench",
+            "u_boot_device_tree_file": "bench.dts",
+            "docker_support": False
+        },
+        "memory_layout": {
+            "UBOOT_KERNEL_START_ADDR": "0x80300000",
+            "UBOOT_CMD_START_ADDR": "0x80900000",
+            "UBOOT_FIT_START_ADDR": "0x80A00000",
+            "PEREGRINE_KERNEL_START_ADDR": "0x80B00000",
+            "PEREGRINE_FDT_START_ADDR": "0x80C00000",
+            "VMS_START_ADDR": "0x81000000"
+        }
+    }
+
+    if max_vms:
+        platform["max_vms"] = max_vms
+
+    return json.dumps({"platform": platform}, indent=4)
+
+
+def write_platform(root, dts_text, vm_count=4, cpus_per_vm=1, devices_per_vm=4,
+                   whitelist=None, cores_per_cluster=4, clusters_per_socket=4):
+    """ Writes a complete benchmark platform below `root`
+
+    Layout (mirrors the real build tree):
+        build/targets/bench/bench.json           platform configuration
+        build/targets/bench/platform_fdt.dts     platform device tree
+        build/targets/bench/vm-dts/vm_fdt.dts    device tree of every VM
+        build/targets/bench/VMs/bench*.json      VM configurations
+        linux/Image, linux/rootfs.cpio.gz        dummy VM images
+        out/
+
+    Args:
+        root (str): Root directory (i.e.: `$(ROOT)`)
+        dts_text (str): Device tree of the platform & of every VM
+        vm_count (int, optional): Number of VMs. Defaults to 4.
+        cpus_per_vm, devices_per_vm, whitelist, cores_per_cluster,
+        clusters_per_socket: see `generate_vm_configs()`
+
+    Returns:
+        str: path of the platform configuration file
+    """
+
+    target_dir = os.path.join(root, "build", "targets", "bench")
+    for it in ("VMs", "vm-dts"):
+        os.makedirs(os.path.join(target_dir, it), exist_ok=True)
+    os.makedirs(os.path.join(root, "linux"), exist_ok=True)
+    os.makedirs(os.path.join(root, "out"), exist_ok=True)
+
+    for name in ("platform_fdt.dts", os.path.join("vm-dts", "vm_fdt.dts")):
+        with open(os.path.join(target_dir, name), "w") as f:
+            f.write(dts_text)
+
+    for name in ("Image", "rootfs.cpio.gz"):
+        with open(os.path.join(root, "linux", name), "wb") as f:
+            f.write(b"\0" * 4096)
+
+    configs = generate_vm_configs(vm_count,
+                                  "$(ROOT)/build/targets/bench/vm-dts/vm_fdt.dts",
+                                  "$(ROOT)/linux/Image",
+                                  "$(ROOT)/linux/rootfs.cpio.gz",
+                                  cpus_per_vm, devices_per_vm, whitelist,
+                                  cores_per_cluster, clusters_per_socket)
+    for name, text in configs.items():
+        with open(os.path.join(target_dir, "VMs", name), "w") as f:
+            f.write(text)
+
+    config_path = os.path.join(target_dir, "bench.json")
+    with open(config_path, "w") as f:
+        f.write(generate_platform_config(vm_count))
+
+    return config_path
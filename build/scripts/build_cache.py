@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+""" Content-addressed cache for VM build artifacts.
+
+Every VM is described by a set of named input components (its configuration,
+the contents of its kernel / ramdisk / FDT, the patcher scripts, ...). Each
+component is reduced to a SHA-256 digest and the digests are combined into a
+single cache key. Outputs produced for a key (e.g.: the patched DTB) are stored
+once under `objects/<digest>` and staged into the cpio directory by reflink (or
+copy) instead of being regenerated.
+
+Cache layout:
+    <cache_dir>/objects/<sha256>    content-addressed output blobs
+    <cache_dir>/entries/<key>.json  inputs & outputs of a cached build
+    <cache_dir>/vms/<uuid>.json     last entry built for a VM (for --explain)
+    <cache_dir>/file_hashes.json    file digests memoized by file identity
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from build_utils import reflink_or_copy
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def digest_bytes(data):
+    """ SHA-256 hex digest of a bytes object
+
+    Args:
+        data (bytes): Input data
+
+    Returns:
+        str: hex digest
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def digest_value(value):
+    """ SHA-256 hex digest of a JSON-serializable value
+
+    Args:
+        value (any): Input value; dict keys are sorted before hashing
+
+    Returns:
+        str: hex digest
+    """
+    return digest_bytes(json.dumps(value, sort_keys=True).encode())
+
+
+def _file_identity(st):
+    """ Values that change whenever the content of a file may have changed """
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+
+def _atomic_write(path, data):
+    """ Write a file so that readers never observe a partial version """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class ArtifactCache:
+    """ Persistent, content-addressed store of VM build outputs """
+
+    def __init__(self, cache_dir):
+        """ Initializer for ArtifactCache
+
+        Args:
+            cache_dir (str): Root directory of the cache (created if missing)
+        """
+
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.entries_dir = os.path.join(cache_dir, "entries")
+        self.vms_dir = os.path.join(cache_dir, "vms")
+        self.file_hashes_path = os.path.join(cache_dir, "file_hashes.json")
+
+        for it in (self.objects_dir, self.entries_dir, self.vms_dir):
+            os.makedirs(it, exist_ok=True)
+
+        try:
+            with open(self.file_hashes_path, "r") as f:
+                self.file_hashes = json.load(f)
+        except (OSError, ValueError):
+            self.file_hashes = {}
+
+    def file_digest(self, path):
+        """ SHA-256 hex digest of a file's content
+
+        Digests are memoized by file identity (device, inode, size, mtime,
+        ctime) so that unchanged multi-hundred-MB images are not re-read.
+
+        Args:
+            path (str): Input file
+
+        Returns:
+            str: hex digest; None if the file does not exist
+        """
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        path = os.path.abspath(path)
+        identity = _file_identity(st)
+        memo = self.file_hashes.get(path)
+        if memo is not None and memo[0] == identity:
+            return memo[1]
+
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                h.update(chunk)
+
+        self.file_hashes[path] = [identity, h.hexdigest()]
+        return h.hexdigest()
+
+    def make_key(self, inputs):
+        """ Combine the input component digests into one cache key
+
+        Args:
+            inputs (dict): component name -> digest (or None if absent)
+
+        Returns:
+            str: cache key
+        """
+        return digest_value(inputs)
+
+    def lookup(self, key):
+        """ Find a cached build by key
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            dict: entry ({"inputs": ..., "outputs": {name: digest}}) if the
+                entry and all of its output objects exist; None otherwise
+        """
+
+        try:
+            with open(os.path.join(self.entries_dir, f"{key}.json"), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        for digest in entry["outputs"].values():
+            if not os.path.exists(os.path.join(self.objects_dir, digest)):
+                return None
+
+        return entry
+
+    def store(self, key, inputs, outputs):
+        """ Record the outputs of a build
+
+        Args:
+            key (str): Cache key
+            inputs (dict): component name -> digest
+            outputs (dict): output name -> path of the produced file
+
+        Returns:
+            dict: the new entry
+        """
+
+        entry = {"key": key, "inputs": inputs, "outputs": {}}
+
+        for name, path in outputs.items():
+            digest = self.file_digest(path)
+            obj_path = os.path.join(self.objects_dir, digest)
+            if not os.path.exists(obj_path):
+                tmp = f"{obj_path}.tmp"
+                shutil.copyfile(path, tmp)
+                os.replace(tmp, obj_path)
+            entry["outputs"][name] = digest
+
+        _atomic_write(os.path.join(self.entries_dir, f"{key}.json"),
+                      json.dumps(entry, indent=2, sort_keys=True).encode())
+        return entry
+
+    def materialize(self, entry, name, dest):
+        """ Stage a cached output by reflink or copy
+
+        Args:
+            entry (dict): Entry returned by `lookup()`
+            name (str): Output name
+            dest (str): Destination path
+        """
+        reflink_or_copy(os.path.join(self.objects_dir, entry["outputs"][name]), dest)
+
+    def last_entry(self, vm_uuid):
+        """ Inputs of the last build recorded for a VM
+
+        Args:
+            vm_uuid (str): VM UUID
+
+        Returns:
+            dict: entry; None if the VM was never built with the cache enabled
+        """
+        try:
+            with open(os.path.join(self.vms_dir, f"{vm_uuid}.json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set_last_entry(self, vm_uuid, entry):
+        """ Remember the entry used for the VM's current build
+
+        Args:
+            vm_uuid (str): VM UUID
+            entry (dict): Entry returned by `lookup()` or `store()`
+        """
+        _atomic_write(os.path.join(self.vms_dir, f"{vm_uuid}.json"),
+                      json.dumps(entry, indent=2, sort_keys=True).encode())
+
+    def explain(self, vm_uuid, inputs):
+        """ Describe which inputs changed since a VM's last recorded build
+
+        Args:
+            vm_uuid (str): VM UUID
+            inputs (dict): component name -> digest of the current build
+
+        Returns:
+            list(str): names of changed components; None if there is no
+                previous build to compare against
+        """
+
+        previous = self.last_entry(vm_uuid)
+        if previous is None:
+            return None
+
+        old_inputs = previous["inputs"]
+        return sorted(it for it in set(inputs) | set(old_inputs)
+                      if inputs.get(it) != old_inputs.get(it))
+
+    def save(self):
+        """ Persist the file digest memo """
+
+        # drop memoized digests of files that no longer exist
+        self.file_hashes = { k: v for k, v in self.file_hashes.items()
+                             if os.path.exists(k) }
+        _atomic_write(self.file_hashes_path,
+                      json.dumps(self.file_hashes, sort_keys=True).encode())
@@ -12,7 +12,15 @@ import json
 import jsonpickle
 from build_utils import *
 import tempfile
+import time
 import fdt_patcher
+import fdt_hotfix
+import build_utils
+import build_scheduler
+import build_cache
+import cpio_archive
+import build_trace
+import build_watch
 
 import fdt
 
@@ -20,6 +28,14 @@ class Builder:
     BUILD_ROOT = f"{os.getcwd()}/../"
     config: config_parser.PlatformConfig = None
     env_exports = {}
+    jobs = None
+    cache: build_cache.ArtifactCache = None
+    explain = False
+    fdt_cross_check = False
+    vm_sources = {}
+    cpio_members = {}
+    cpio_writer: cpio_archive.CpioWriter = None
+    tracer: build_trace.BuildTracer = build_trace.BuildTracer()
 
     ##### Start of hooks
 
@@ -124,10 +140,11 @@ class Builder:
         print("Running:", ["make", *file_args, target],
             dict(cwd=dir, env={**cls.env_exports}, check=True))
 
-        subprocess.run(["make", *file_args, target],
-                    cwd=dir,
-                    env={**os.environ, **cls.env_exports, **os.environ},
-                    check=True)
+        with cls.tracer.span(f"make {target}"):
+            subprocess.run(["make", *file_args, target],
+                        cwd=dir,
+                        env={**os.environ, **cls.env_exports, **os.environ},
+                        check=True)
 
     @classmethod
     def create_platform_fit_image(cls):
@@ -141,12 +158,180 @@ class Builder:
                         os.path.join(cls.BUILD_ROOT, "u-boot/cot_peregrine/peregrine.its"), *remaining_parameters], check=True)
 
     @classmethod
-    def build_vm(cls, vm, force_rebuild=False):
+    def vm_needs_build(cls, vm, force_rebuild=False):
+        """ Checks whether the VM's build command must be executed
+
+        Args:
+            vm (VM): The VM
+            force_rebuild (bool, optional): Rebuilds the VM on true. Defaults to False.
+
+        Returns:
+            bool: True if the build command should run
+        """
+
+        # the cache key does not cover the sources the build command compiles,
+        # so `always_rebuild` VMs are never skipped because of a cache hit
+        return bool(vm.build_command) and (force_rebuild or vm.always_rebuild)
+
+    @classmethod
+    def get_vm_inputs(cls, vm):
+        """ Computes the digests of everything the VM's artifacts depend on
+
+        Args:
+            vm (VM): The VM
+
+        Returns:
+            dict: input component name -> digest (None if absent)
+        """
+
+        # scripts that transform the VM's artifacts
+        patchers = [ fdt_patcher.__file__, fdt_hotfix.__file__, build_utils.__file__ ]
+
+        return {
+            "config": build_cache.digest_bytes(cls.vm_sources.get(vm.uuid, "").encode()),
+            "build_env": build_cache.digest_value(vm.build_env),
+            "kernel": cls.cache.file_digest(vm.kernel_path),
+            "ramdisk": cls.cache.file_digest(vm.ramdisk_path) if vm.ramdisk_path else None,
+            "fdt": cls.get_fdt_digest(vm.fdt_path) if vm.fdt_path else None,
+            "device_whitelist": build_cache.digest_value(vm.device_whitelist),
+            "ipa_memory_layout": build_cache.digest_value(vm.ipa_memory_layout),
+            "patchers": build_cache.digest_value([ cls.cache.file_digest(it) for it in patchers ]
+                                                 + [fdt.__version__]),
+        }
+
+    @classmethod
+    def get_fdt_digest(cls, fdt_path):
+        """ Digest of a VM's device tree and of the files it includes
+
+        Args:
+            fdt_path (str): Path to the DTS or DTB
+
+        Returns:
+            str: digest covering the file and its /include/ and /incbin/
+                dependencies
+        """
+
+        deps = []
+        if fdt_path.endswith(".dts"):
+            try:
+                with open(fdt_path, "r") as f:
+                    deps = fdt_hotfix.FDT_HOTFIX.get_dependencies(f.read(),
+                                                                  os.path.dirname(fdt_path))
+            except OSError:
+                pass
+
+        return build_cache.digest_value([ (it, cls.cache.file_digest(it))
+                                          for it in [os.path.abspath(fdt_path), *deps] ])
+
+    @classmethod
+    def describe_changes(cls, vm, inputs):
+        """ Summarizes why the VM's cached artifacts cannot be reused
+
+        Args:
+            vm (VM): The VM
+            inputs (dict): Current input digests (see get_vm_inputs())
+
+        Returns:
+            str: Human-readable reason
+        """
+
+        changed = cls.cache.explain(vm.uuid, inputs)
+        if changed is None:
+            return "no previous build"
+        if not changed:
+            return "cache entry evicted"
+
+        return "changed: " + ", ".join(changed)
+
+    @classmethod
+    def explain_vm(cls, vm, message):
+        """ Prints a `--explain` message for a VM
+
+        Args:
+            vm (VM): The VM
+            message (str): Explanation
+        """
+
+        if cls.explain:
+            print(f"[explain] {vm.vm_id} ({vm.name}): {message}")
+
+    @classmethod
+    def get_vm_build_command(cls, vm):
+        """ Assembles the argv, working directory and environment of a VM build
+
+        Args:
+            vm (VM): The VM
+
+        Returns:
+            tuple(list(str), str, dict): argv, working directory, environment
+        """
+
+        # create argv based on whether the build command is a cmdline or just the path to a script
+        build_command = vm.build_command
+        if os.path.exists(vm.build_command):
+            script_dir = os.path.dirname(vm.build_command)
+            build_command = [build_command]
+        else:
+            build_command = shlex.split(build_command)
+            script_dir = os.path.join(cls.BUILD_ROOT, "build")
+        custom_env = {**os.environ, **vm.build_env, **cls.env_exports}
+
+        return build_command, script_dir, custom_env
+
+    @classmethod
+    def run_vm_builds(cls, vms, force_rebuild=False):
+        """ Executes the build commands of all VMs concurrently.
+
+        The global job budget (see `--jobs`) is split between the builds and
+        each build's output is captured in `<out_dir>/logs/<vm_id>.build.log`.
+        On the first failure, all remaining builds are stopped and the tail of
+        the failing build's log is printed.
+
+        Args:
+            vms (list(VM)): VMs whose build command should be executed
+            force_rebuild (bool, optional): Rebuilds the VMs on true. Defaults to False.
+        """
+
+        scheduler = build_scheduler.VMBuildScheduler(
+            jobs=cls.jobs,
+            log_dir=os.path.join(cls.config.build_options["out_dir"], "logs"))
+
+        for vm in vms:
+            if not vm.is_enabled:
+                continue
+
+            if cls.vm_needs_build(vm, force_rebuild):
+                reason = "forced by --rebuild" if force_rebuild else "always_rebuild"
+                cls.explain_vm(vm, f"running build command ({reason})")
+
+                scheduler.add(vm.vm_id, *cls.get_vm_build_command(vm))
+
+        try:
+            with cls.tracer.span("run_vm_builds"):
+                scheduler.run()
+        except build_scheduler.BuildError as e:
+            print(f"ERROR: {e}\n"
+                  f"----- last lines of {e.job.log_path} -----\n{e.tail}")
+            sys.exit(1)
+        finally:
+            # each build runs in its own lane of the trace
+            for job in scheduler.queue:
+                if job.started is not None and job.duration is not None:
+                    cls.tracer.record(f"build command {', '.join(job.names)}",
+                                      job.started, job.duration,
+                                      thread=f"build {job.names[0]}",
+                                      returncode=job.returncode)
+
+    @classmethod
+    def build_vm(cls, vm, force_rebuild=False, run_build_command=True):
         """ Regenerates VM manifest and potentially rebuilds VM.
 
         Args:
             vm (VM): The VM
             force_rebuild (bool, optional): Rebuilds the VM on true. Defaults to False.
+            run_build_command (bool, optional): Executes the VM's build command
+                if needed. Set to False if it was already run by `run_vm_builds()`.
+                Defaults to True.
 
         Returns:
             bool: True on success, else False
@@ -154,19 +339,12 @@ class Builder:
 
         if vm.is_enabled:
             # if a build command is provided (can be script path, make cmdline, etc.)
-            if vm.build_command and (force_rebuild or vm.always_rebuild):
-                # create argv based on whether the build command is a cmdline or just the path to a script
-                build_command = vm.build_command
-                if os.path.exists(vm.build_command):
-                    script_dir = os.path.dirname(vm.build_command)
-                    build_command = [build_command]
-                else:
-                    build_command = shlex.split(build_command)
-                    script_dir = os.path.join(cls.BUILD_ROOT, "build")
-                custom_env = {**os.environ, **vm.build_env, **cls.env_exports}
+            if run_build_command and cls.vm_needs_build(vm, force_rebuild):
+                build_command, script_dir, custom_env = cls.get_vm_build_command(vm)
 
                 # execute build command in a subprocess
-                subprocess.run([*build_command], cwd=script_dir, env=custom_env, check=True)
+                with cls.tracer.span(f"build command {vm.vm_id}"):
+                    subprocess.run([*build_command], cwd=script_dir, env=custom_env, check=True)
             if not vm.kernel_path:
                 print(
                     f'No kernel image provided for VM with UUID "{vm.uuid}", aborting.\n')
@@ -177,138 +355,124 @@ class Builder:
 
             if os.path.exists(vm.kernel_path): # no kernel no party
 
-                kernel_out_file = os.path.join(cpio_out_dir, f"{vm.vm_id}_{kernel_filename}")
-
-                shutil.copy(vm.kernel_path, kernel_out_file)
+                # the kernel is streamed into the archive from its build location
+                cls.cpio_members[f"{vm.vm_id}_{kernel_filename}"] = vm.kernel_path
 
-                # if it exists, copy the VM's initrd image as well
+                # if it exists, add the VM's initrd image as well
                 if vm.ramdisk_path:
                     ramdisk_filename = os.path.basename(vm.ramdisk_path)
-                    ramdisk_out_file = os.path.join(cpio_out_dir, f"{vm.vm_id}_{ramdisk_filename}")
-                    shutil.copyfile(vm.ramdisk_path, ramdisk_out_file)
+                    cls.cpio_members[f"{vm.vm_id}_{ramdisk_filename}"] = vm.ramdisk_path
 
                 # if it exists, copy the Device Tree and make the needed alterations
                 # depending on the format (DTS or DTB) compiling it may be required
                 if vm.fdt_path:
-                    # determine DT type by extension
-                    if vm.fdt_path.endswith(".dtb"):
-                        filetype = "dtb"
-                    elif vm.fdt_path.endswith(".dts"):
-                        filetype = "dts"
-                    else:
-                        print("Unable to infer DT type from file name: \"%s\"" \
-                              % vm.fdt_path)
-                        return False
-
-                    # make a working copy of the DT
-                    fdt_copy = os.path.join(cls.config.build_options["out_dir"],
-                                            f"{vm.vm_id}_{os.path.basename(vm.fdt_path)}")
-                    shutil.copyfile(vm.fdt_path, fdt_copy)
-
                     # determine path & name of modified DT
                     patched_fdt_name = os.path.basename(vm.fdt_path)
                     patched_fdt_name = f"{vm.vm_id}_{patched_fdt_name[:-1]}b"
                     outpath = os.path.join(cpio_out_dir, patched_fdt_name)
 
-                    # patch ramdisk size in "/chosen" node (if ramdisk present)
-                    if vm.ramdisk_path:
-                        ramdisk_start = vm.ipa_memory_layout["ramdisk"]
-                        ramdisk_end   = ramdisk_start + os.path.getsize(vm.ramdisk_path)
-
-                        # DTS patch
-                        if filetype == "dts":
-                            with open(fdt_copy, "rt") as f_in:
-                                fdt_content = f_in.read()
-
-                            fdt_content = fdt_content.replace(
-                                            "linux,initrd-start = <initrd-start>;",
-                                            "linux,initrd-start = <%#x>;" % ramdisk_start)
-                            fdt_content = fdt_content.replace(
-                                            "linux,initrd-end = <initrd-end>;",
-                                            "linux,initrd-end = <%#x>;" % ramdisk_end)
-
-                            with open(fdt_copy, "wt") as f_out:
-                                f_out.write(fdt_content)
-                        # DTB patch
-                        else:
-                            fdt_data = fdt_patcher.parse_fdt(fdt_copy)
-                            if fdt_data is None:
-                                print("Unable to parse DTB file: \"%s\"" % fdt_copy)
+                # reuse the patched DT of an identical previous build if possible
+                inputs = cls.get_vm_inputs(vm) if cls.cache else None
+                entry = cls.cache.lookup(cls.cache.make_key(inputs)) if cls.cache else None
+
+                if entry is not None:
+                    if vm.fdt_path:
+                        with cls.tracer.span("materialize cached fdt"):
+                            cls.cache.materialize(entry, "fdt", outpath)
+                    cls.explain_vm(vm, "artifacts unchanged, reusing cache entry %s"
+                                   % entry["key"][:12])
+                else:
+                    if vm.fdt_path:
+                        with cls.tracer.span("patch_vm_fdt"):
+                            if not cls.patch_vm_fdt(vm, outpath):
                                 return False
 
-                            # this will reuse existing "bootargs" and
-                            # "stdout-path" properties
-                            fdt_patcher.set_chosen(fdt_data,
-                                                   rd_start=ramdisk_start,
-                                                   rd_end=ramdisk_end)
-
-                            ans = fdt_patcher.store_fdt(fdt_copy, fdt_data)
-                            if ans is False:
-                                print("Unable to store chosen node changes: \"%s\""
-                                      % fdt_copy)
-
-                    # patch "/memory@..." node based on main components IPA layout
-                    if vm.ipa_memory_layout and vm.memory_size:
-                        fdt_data = fdt_patcher.parse_fdt(fdt_copy)
-
-                        # prepare arguments for invocation
-                        kernel_addr  = vm.ipa_memory_layout['kernel']
-                        fdt_addr     = vm.ipa_memory_layout['fdt']      \
-                                       if 'fdt' in vm.ipa_memory_layout \
-                                       else 2**64 - 1
-                        ramdisk_addr = vm.ipa_memory_layout['ramdisk']      \
-                                       if 'ramdisk' in vm.ipa_memory_layout \
-                                       else 2**64 - 1
-
-                        # perform the patch
-                        fdt_patcher.set_memory(fdt_data, vm.memory_size,
-                                            kernel_addr, fdt_addr, ramdisk_addr)
-
-                        ans = fdt_patcher.store_fdt(fdt_copy, fdt_data)
-                        if ans is False:
-                            print("Unable to store memory node changes: \"%s\""
-                                  % fdt_copy)
-
-                    # patch "/cpus" node based on VM's physical CPU assignation
-                    if vm.cpus:
-                        fdt_data = fdt_patcher.parse_fdt(fdt_copy)
-
-                        # perform the patch
-                        fdt_patcher.trim_excess_cpus(fdt_data, vm.vcpu_count)
-
-                        ans = fdt_patcher.store_fdt(fdt_copy, fdt_data)
-                        if ans is False:
-                            print("Unable to store cpus node changes: \"%s\""
-                                  % fdt_copy)
-                    else:
-                        print("No physical CPU assignation detected")
-                        return False
-
-                    # delete nodes based on whitelist (if specified by user)
-                    if vm.device_whitelist:
-                        fdt_data = fdt_patcher.parse_fdt(fdt_copy)
-                        if fdt_data is None:
-                            print("Unable to parse FDT file: \"%s\"" % fdt_copy)
-                            return False
-
-                        fdt_patcher.apply_whitelist(fdt_data, vm.device_whitelist)
-
-                        ans = fdt_patcher.store_fdt(fdt_copy, fdt_data)
-                        if ans is False:
-                            print("Unable to store whitelist changes: \"%s\""
-                                  % fdt_copy)
-
-                    # compile if FDT is in DTS format
-                    if vm.fdt_path.endswith(".dts"):
-                        compile_dts(fdt_copy, outpath)
-                    # or copy it as-is in case it's DTB
-                    elif vm.fdt_path.endswith(".dtb"):
-                        shutil.copyfile(fdt_copy, outpath)
-                    else:
-                        print("Unknown FDT format: \"%s\"" % fdt_copy)
-                        return False
+                    if cls.cache:
+                        cls.explain_vm(vm, "artifacts regenerated (%s)"
+                                       % cls.describe_changes(vm, inputs))
+                        with cls.tracer.span("cache store"):
+                            entry = cls.cache.store(cls.cache.make_key(inputs), inputs,
+                                                    {"fdt": outpath} if vm.fdt_path else {})
+
+                if cls.cache:
+                    cls.cache.set_last_entry(vm.uuid, entry)
+
+                with cls.tracer.span("after_vm_built"):
+                    cls.after_vm_built(vm)
+
+        return True
+
+    @classmethod
+    def patch_vm_fdt(cls, vm, outpath):
+        """ Applies the VM-specific alterations to the VM's device tree
+
+        Args:
+            vm (VM): The VM
+            outpath (str): Output path of the patched DTB
+
+        Returns:
+            bool: True on success, else False
+        """
+
+        # parse the DT once, apply all patches in memory, emit the DTB once
+        pipeline = fdt_patcher.FdtPipeline(vm.fdt_path)
+
+        # patch ramdisk size in "/chosen" node (if ramdisk present)
+        if vm.ramdisk_path:
+            ramdisk_start = vm.ipa_memory_layout["ramdisk"]
+            ramdisk_end   = ramdisk_start + os.path.getsize(vm.ramdisk_path)
+
+            # DTS patch
+            if vm.fdt_path.endswith(".dts"):
+                pipeline.substitute("linux,initrd-start = <initrd-start>;",
+                                    "linux,initrd-start = <%#x>;" % ramdisk_start)
+                pipeline.substitute("linux,initrd-end = <initrd-end>;",
+                                    "linux,initrd-end = <%#x>;" % ramdisk_end)
+            # DTB patch; this will reuse existing "bootargs" and "stdout-path"
+            # properties
+            else:
+                pipeline.add_pass("set_chosen", fdt_patcher.set_chosen,
+                                  rd_start=ramdisk_start, rd_end=ramdisk_end)
+
+        # patch "/memory@..." node based on main components IPA layout
+        if vm.ipa_memory_layout and vm.memory_size:
+            # prepare arguments for invocation
+            kernel_addr  = vm.ipa_memory_layout['kernel']
+            fdt_addr     = vm.ipa_memory_layout['fdt']      \
+                           if 'fdt' in vm.ipa_memory_layout \
+                           else 2**64 - 1
+            ramdisk_addr = vm.ipa_memory_layout['ramdisk']      \
+                           if 'ramdisk' in vm.ipa_memory_layout \
+                           else 2**64 - 1
+
+            pipeline.add_pass("set_memory", fdt_patcher.set_memory, vm.memory_size,
+                              kernel_addr, fdt_addr, ramdisk_addr)
+
+        # patch "/cpus" node based on VM's physical CPU assignation
+        if vm.cpus:
+            pipeline.add_pass("trim_excess_cpus", fdt_patcher.trim_excess_cpus,
+                              vm.vcpu_count)
+        else:
+            print("No physical CPU assignation detected")
+            return False
+
+        # delete nodes based on whitelist (if specified by user)
+        if vm.device_whitelist:
+            pipeline.add_pass("apply_whitelist", fdt_patcher.apply_whitelist,
+                              vm.device_whitelist, vm.prune_dependent_devices)
+
+        start = time.monotonic()
+        try:
+            if not pipeline.run():
+                print("Unable to patch FDT file: \"%s\"" % vm.fdt_path)
+                return False
 
-                cls.after_vm_built(vm)
+            if not pipeline.store(outpath, cross_check=cls.fdt_cross_check):
+                print("Unable to store patched FDT: \"%s\"" % outpath)
+                return False
+        finally:
+            # one span per pipeline step (load, each pass, store)
+            cls.tracer.record_sequence("fdt ", pipeline.timings, start)
 
         return True
 
@@ -347,11 +511,10 @@ class Builder:
 
         # for each VM in the received list
         for vm in VMs:
-            cpio_out_dir    = os.path.join(cls.config.build_options["out_dir"], "cpio")
             kernel_filename = os.path.basename(vm.kernel_path)
 
             # skip VM if not built
-            if not os.path.exists(os.path.join(cpio_out_dir, f"{vm.vm_id}_{kernel_filename}")):
+            if f"{vm.vm_id}_{kernel_filename}" not in cls.cpio_members:
                 print(f"WARNING:kernel is missing for VM '{vm.name}'.")
                 continue
 
@@ -375,7 +538,8 @@ class Builder:
         else:
             print("Warning: Building without any VMs!\n")
 
-        fdt_out = fdt.FDT()
+        # pyfdt's default `entries` list is shared between FDT objects
+        fdt_out = fdt.FDT(entries=[])
         fdt_out.add_item(hypervisor)
 
         # generate .dts from the constructed FDT object
@@ -383,8 +547,24 @@ class Builder:
         with open(dts_path, "w+") as f:
             f.write(fdt_out.to_dts())
 
-        # compile .dts into a .dtb
-        compile_dts(dts_path, manifest_path)
+        # emit the .dtb directly (optionally verified against `dtc`)
+        dtb_data = fdt_patcher.to_dtb(fdt_out)
+
+        # an unchanged manifest is left untouched so that it does not force
+        # rewriting the whole archive (see `pack_platform_image()`)
+        try:
+            with open(manifest_path, "rb") as f:
+                unchanged = f.read() == dtb_data
+        except OSError:
+            unchanged = False
+
+        if not unchanged:
+            with open(manifest_path, "wb") as f:
+                f.write(dtb_data)
+
+        if cls.fdt_cross_check and not fdt_patcher.check_dtb(fdt_out, dtb_data):
+            print("ERROR: manifest DTB differs from dtc output.")
+            sys.exit(1)
 
     @classmethod
     def parse_vm_from_file(cls, file_obj):
@@ -397,7 +577,14 @@ class Builder:
             VM: VM
         """
 
-        return config_parser.VM.from_json(file_obj.read())
+        json_string = file_obj.read()
+        vm = config_parser.VM.from_json(json_string)
+
+        # keep the expanded configuration around as cache input
+        if vm is not None:
+            cls.vm_sources[vm.uuid] = json_string.replace("$(ROOT)", cls.BUILD_ROOT)
+
+        return vm
 
 
     @classmethod
@@ -416,6 +603,7 @@ class Builder:
         """
 
         VMs = []
+        parsed_vms = []
         vm_uuids = []
         vm_cpus = set()
         config_parser.vm_count = 0
@@ -453,11 +641,7 @@ class Builder:
                         print("ERROR: CPU0 was not assigned to primary VM")
                         sys.exit(1)
 
-                    # build new vm
-                    ans = cls.build_vm(new_vm, force_rebuild) if build else True
-                    if not ans:
-                        print("ERROR: Could not build VM.")
-                        sys.exit(1)
+                    parsed_vms.append(new_vm)
 
                     if new_vm.vm_id == "vm1" and len(VMs):
                         VMs.insert(0, new_vm)
@@ -471,6 +655,21 @@ class Builder:
             print("No VMs are enabled. Please enable at least one VM.")
             sys.exit(1)
 
+        if build:
+            # run the (slow) build commands concurrently, then stage the
+            # artifacts one VM at a time to keep the output deterministic
+            cls.run_vm_builds(parsed_vms, force_rebuild)
+
+            for vm in parsed_vms:
+                with cls.tracer.span(f"build_vm {vm.vm_id}"):
+                    ans = cls.build_vm(vm, force_rebuild, run_build_command=False)
+                if not ans:
+                    print("ERROR: Could not build VM.")
+                    sys.exit(1)
+
+            if cls.cache:
+                cls.cache.save()
+
         return VMs
 
     @classmethod
@@ -500,47 +699,60 @@ class Builder:
 
     @classmethod
     def pack_platform_image(cls, platform_image_file, cpio_dir):
-        """ Ggenerates cpio archive.
-
-        NOTE: this is basically
-                   $ find ${cpio_dir} | cpio -o > ${platform_image_file}
-        NOTE: the staging directory must contain a number of things:
-                   - platform manifest & its signature
-                   - VM images, device trees, rootfs archives
+        """ Generates the cpio archive (old binary format, as `cpio --create`).
+
+        NOTE: the archive is made of
+                   - the platform manifest, always stored first
+                   - VM kernels & ramdisks, streamed from their build location
+                     (see `cpio_members`)
+                   - everything else in the staging directory: patched device
+                     trees, signatures, files added by hooks, etc.
+        NOTE: staged files override registered members with the same name
+        NOTE: if the archive was produced by the previous call, only members
+              following the first changed one are rewritten
 
         Args:
-            platform_image_file (str): Iutput archive name
+            platform_image_file (str): Output archive name
             cpio_dir (str): Staging directory for the cpio archive
+
+        Returns:
+            int: size of the archive
         """
-        with open(platform_image_file, "wb") as f:
-            ps = subprocess.Popen(["find", ".", "-type", "f", "-not", "-name", "manifest.dtb"], cwd=cpio_dir, stdout=subprocess.PIPE)
+        writer = cpio_archive.CpioWriter(leading=["./manifest.dtb"])
 
-            files_read = b"./manifest.dtb\n" + ps.stdout.read()
+        for name, path in cls.cpio_members.items():
+            writer.add_file(f"./{name}", path)
+        writer.add_directory(cpio_dir, prefix="./")
 
-            print(files_read.decode())
+        size, _ = writer.write(platform_image_file, previous=cls.cpio_writer)
+        cls.cpio_writer = writer
 
-            cpio_proc = subprocess.Popen(["cpio", "--create"],
-                            cwd=cpio_dir,
-                            stdin=subprocess.PIPE,
-                            stdout=f)
+        for it in writer.ordered_members():
+            print(f"{it.name} (offset 0x{it.offset:X}, {it.size} bytes)")
+        if writer.reused:
+            print(f"{writer.reused} leading member(s) unchanged, not rewritten")
 
-            cpio_proc_out = cpio_proc.communicate(input=files_read)[0]
+        return size
 
 
     @classmethod
-    def create_platform_fdt(cls, platform_image_file):
+    def create_platform_fdt(cls, platform_image_file, image_size=None):
         """ Creates & compiles a device tree file based on a template.
 
         NOTE: currently, the fdts/ hardcoded path is for the Fixed Virtual Platform
 
         Args:
             platform_image_file (str): Platform initrd file
+            image_size (int, optional): Size of the platform initrd, as returned
+                by `pack_platform_image()`. Read from the file if not given.
         """
         memory_layout = cls.config.get_memory_layout_as_str()
         dts_content = ""
 
         # calculate the end address of the full platform initrd image
-        end_addr = "0x%0.2X" % (cls.config.memory_layout["VMS_START_ADDR"] + os.path.getsize(platform_image_file))
+        if image_size is None:
+            image_size = os.path.getsize(platform_image_file)
+        end_addr = "0x%0.2X" % (cls.config.memory_layout["VMS_START_ADDR"] + image_size)
 
         # replace a specific line in the FVP device tree with build-specific info:
         # i.e.: boot arguments (empty), default stdout (serial0), initrd boundary addresses
@@ -557,8 +769,9 @@ class Builder:
             f.write(dts_content)
             f.truncate()
 
-        compile_dts(out_dts_file, os.path.join(
-            cls.config.build_options["out_dir"], "peregrine_fdt.dtb"))
+        with cls.tracer.span("compile_dts platform_fdt"):
+            compile_dts(out_dts_file, os.path.join(
+                cls.config.build_options["out_dir"], "peregrine_fdt.dtb"))
 
 
     @classmethod
@@ -577,6 +790,8 @@ class Builder:
             for f in glob.glob(f"{cpio_dir}/*"):
                 os.remove(f)
 
+        cls.cpio_members = {}
+
         return cpio_dir
 
     @classmethod
@@ -600,7 +815,8 @@ class Builder:
         vms = cls.get_vms(build=True, force_rebuild=rebuild)
 
         # generate VM manifest based on previously obtained VM list
-        cls.create_merged_manifest(manifest_path, vms)
+        with cls.tracer.span("create_merged_manifest"):
+            cls.create_merged_manifest(manifest_path, vms)
 
         return vms
 
@@ -613,11 +829,163 @@ class Builder:
             cpio_dir (str): Staging dir for cpio
         """
 
-        # pack everything from the cpio staging area into an initrd image
-        cls.pack_platform_image(platform_image_file, cpio_dir)
+        # pack the VM images & the cpio staging area into an initrd image
+        with cls.tracer.span("pack_platform_image"):
+            image_size = cls.pack_platform_image(platform_image_file, cpio_dir)
 
         # generate hardware (FVP) device tree from template
-        cls.create_platform_fdt(platform_image_file)
+        with cls.tracer.span("create_platform_fdt"):
+            cls.create_platform_fdt(platform_image_file, image_size)
+
+    @classmethod
+    def get_watched_files(cls, config_path, vms):
+        """ Files whose changes trigger a rebuild in `--watch` mode
+
+        NOTE: the VMs/ directory is watched as a whole (see `watch()`)
+
+        Args:
+            config_path (str): Path to platform configuration file
+            vms (list(VM)): Current VMs
+
+        Returns:
+            list(str): file paths
+        """
+
+        files = [ config_path, cls.config.target_dts_file ]
+        for vm in vms:
+            files += [ vm.fdt_path, vm.kernel_path, vm.ramdisk_path ]
+
+        return [ os.path.abspath(it) for it in files if it ]
+
+    @classmethod
+    def rebuild_changed(cls, changed, config_path, platform_image_file, cpio_dir,
+                        manifest_path, vms):
+        """ Incrementally regenerates everything that depends on changed files
+
+        Only the VMs whose configuration, device tree, kernel or ramdisk
+        changed are rebuilt (their build commands are not executed). Unchanged
+        DTS templates are not parsed again (see `FDT_HOTFIX.parse_dts_cached()`),
+        an unchanged manifest is not rewritten and only the end of the archive
+        starting with the first changed member is. The platform FDT and the FIT
+        image only depend on the archive's size, so they are regenerated only if
+        that size changed.
+
+        Args:
+            changed (set(str)): Absolute paths of the changed files
+            config_path (str): Path to platform configuration file
+            platform_image_file (str): Platform ramdisk image to be generated
+            cpio_dir (str): Staging dir for cpio
+            manifest_path (str): Path for merged VM manifest
+            vms (list(VM)): VMs of the previous build
+
+        Returns:
+            list(VM): current VMs
+        """
+
+        vm_dir = os.path.join(cls.config.build_options["target_dir"], "VMs")
+        old_ids = { vm.uuid: vm.vm_id for vm in vms }
+        old_sources = cls.vm_sources
+
+        config_changed = bool({ os.path.abspath(config_path),
+                                os.path.abspath(cls.config.target_dts_file) } & changed)
+        if config_changed:
+            cls.init_config(config_path)
+            cls.update_exports()
+
+        if config_changed or any(os.path.dirname(it) == os.path.abspath(vm_dir)
+                                 for it in changed):
+            cls.vm_sources = {}
+            vms = cls.get_vms()
+
+        if config_changed or { vm.uuid: vm.vm_id for vm in vms } != old_ids:
+            # VM IDs are part of the archive member names, start over
+            cls.prepare_cpio_dir()
+            dirty = vms
+        else:
+            dirty = [ vm for vm in vms
+                      if cls.vm_sources.get(vm.uuid) != old_sources.get(vm.uuid)
+                      or { os.path.abspath(it) for it in (vm.fdt_path, vm.kernel_path,
+                                                           vm.ramdisk_path) if it } & changed ]
+
+        for vm in dirty:
+            # drop the VM's previous archive members, their names may change
+            prefix = f"{vm.vm_id}_"
+            cls.cpio_members = { k: v for k, v in cls.cpio_members.items()
+                                 if not k.startswith(prefix) }
+            for it in glob.glob(os.path.join(cpio_dir, f"{prefix}*")):
+                os.remove(it)
+
+            with cls.tracer.span(f"build_vm {vm.vm_id}"):
+                if not cls.build_vm(vm, run_build_command=False):
+                    print("ERROR: Could not build VM.")
+                    sys.exit(1)
+
+        if cls.cache:
+            cls.cache.save()
+
+        with cls.tracer.span("create_merged_manifest"):
+            cls.create_merged_manifest(manifest_path, vms)
+
+        with cls.tracer.span("before_vm_pack"):
+            cls.before_vm_pack(vms, manifest_path, cpio_dir)
+
+        previous_size = cls.cpio_writer.size if cls.cpio_writer else None
+        with cls.tracer.span("pack_platform_image"):
+            image_size = cls.pack_platform_image(platform_image_file, cpio_dir)
+
+        if config_changed or image_size != previous_size:
+            with cls.tracer.span("create_platform_fdt"):
+                cls.create_platform_fdt(platform_image_file, image_size)
+            with cls.tracer.span("create_platform_fit_image"):
+                cls.create_platform_fit_image()
+
+        cls.make("target")
+
+        return vms
+
+    @classmethod
+    def watch(cls, config_path, platform_image_file, cpio_dir, manifest_path, vms):
+        """ Implementation of `--watch`
+
+        Waits for changes of the platform configuration, the VM configurations,
+        the device tree templates and the VM images, then rebuilds what depends
+        on them (see `rebuild_changed()`). Runs until interrupted.
+
+        Args:
+            config_path (str): Path to platform configuration file
+            platform_image_file (str): Platform ramdisk image to be generated
+            cpio_dir (str): Staging dir for cpio
+            manifest_path (str): Path for merged VM manifest
+            vms (list(VM)): VMs of the initial build
+        """
+
+        watcher = build_watch.FileWatcher()
+        vm_dir = os.path.join(cls.config.build_options["target_dir"], "VMs")
+
+        print(f"Watching for changes ({watcher.backend}), press Ctrl+C to stop.")
+
+        try:
+            while True:
+                watcher.set_paths(cls.get_watched_files(config_path, vms), [vm_dir])
+                changed, first_change = watcher.wait()
+
+                print("Changed:", ", ".join(sorted(
+                    os.path.relpath(it, cls.BUILD_ROOT) for it in changed)))
+
+                try:
+                    with cls.tracer.span("watch cycle"):
+                        vms = cls.rebuild_changed(changed, config_path, platform_image_file,
+                                                  cpio_dir, manifest_path, vms)
+                except (SystemExit, OSError, ValueError,
+                        subprocess.CalledProcessError) as e:
+                    # keep watching; the next change may fix the error
+                    print(f"ERROR: rebuild failed ({e!r}), waiting for changes.")
+                    continue
+
+                print("Ready in %.2fs after the first change." %
+                      (time.monotonic() - first_change))
+        except KeyboardInterrupt:
+            print("Stopped watching.")
 
     @classmethod
     def make_tfa(cls):
@@ -795,10 +1163,12 @@ class Builder:
     def make_platform(cls):
         """ Builds the whole platform """
 
-        cls.prepare_hypervisor_uboot_files()
+        with cls.tracer.span("prepare_hypervisor_uboot_files"):
+            cls.prepare_hypervisor_uboot_files()
 
         # create platform certificate
-        cls.create_platform_certs()
+        with cls.tracer.span("create_platform_certs"):
+            cls.create_platform_certs()
 
         cls.make_hypervisor()
         cls.make_uboot()
@@ -818,6 +1188,24 @@ class Builder:
                             help="Only build the hypervisor.")
         parser.add_argument('--vms-only', action='store_true',
                             help="Only build VMs.")
+        parser.add_argument('-j', '--jobs', action='store', type=int,
+                            default=build_scheduler.default_jobs(),
+                            help="Global job budget shared by concurrent VM builds.")
+        parser.add_argument('--no-cache', action='store_true',
+                            help="Do not reuse cached VM artifacts.")
+        parser.add_argument('--explain', action='store_true',
+                            help="Explain why each VM was or wasn't rebuilt.")
+        parser.add_argument('--fdt-dtc-check', action='store_true',
+                            help="Cross-check natively emitted DTBs against dtc.")
+        parser.add_argument('--watch', action='store_true',
+                            help="After building, rebuild incrementally whenever VM "
+                                 "configurations, device trees or VM images change.")
+        parser.add_argument('--trace', action='store', type=str, metavar="FILE",
+                            help="Write a Chrome trace of the build phases to FILE "
+                                 "and a summary to FILE.txt.")
+        parser.add_argument('--profile', action='store', type=str, metavar="FILE",
+                            help="Profile the build script with cProfile, "
+                                 "statistics are written to FILE.")
         parser.add_argument('-wrap', action='store', type=str,
                             help='The makefile target.')
         parser.add_argument('-makefile', action='store', type=str,
@@ -828,11 +1216,16 @@ class Builder:
                             help="Config File for the build process.")
 
         args = parser.parse_args()
+        cls.tracer = build_trace.start(args.trace, args.profile)
+        cls.jobs = args.jobs
+        cls.explain = args.explain
+        cls.fdt_cross_check = args.fdt_dtc_check
 
         config_parser.set_root(cls.BUILD_ROOT)
         build_dir = os.path.join(cls.BUILD_ROOT, "build")
 
-        cls.init_config(config_path=os.path.join(build_dir, args.configfile))
+        config_path = os.path.join(build_dir, args.configfile)
+        cls.init_config(config_path=config_path)
 
         # update global environment dict with specific paths
         platform_image_file = os.path.join(cls.config.build_options["out_dir"], "vms.img")
@@ -842,8 +1235,17 @@ class Builder:
                             "BOOT_IMG_VM": platform_image_file,
                             "BOOT_IMG_VM_REL": platform_image_file_rel})
 
+        # persistent VM artifact cache (see build_cache.py) and parsed DTS
+        # tree cache (see fdt_hotfix.py)
+        if not args.no_cache:
+            cls.cache = build_cache.ArtifactCache(
+                os.path.join(cls.config.build_options["out_dir"], ".cache"))
+            fdt_hotfix.set_cache_dir(
+                os.path.join(cls.config.build_options["out_dir"], ".cache", "dts"))
+
         # call setup hook
-        cls.setup()
+        with cls.tracer.span("setup"):
+            cls.setup()
 
         # prepare staging area for the cpio archive
         cpio_dir = cls.prepare_cpio_dir()
@@ -861,28 +1263,38 @@ class Builder:
         # (maybe) compile hypervisor in addition to VMs
         if not args.vms_only:
             # let's check if any of the VMs actually needs the TPM TA or others
-            cls.get_vms()
-            cls.make_platform()
+            with cls.tracer.span("get_vms"):
+                cls.get_vms()
+            with cls.tracer.span("make_platform"):
+                cls.make_platform()
 
         # generate VMs
-        cls.create_json()
+        with cls.tracer.span("create_json"):
+            cls.create_json()
         rebuild = args.rebuild if not args.hypervisor_only else False
 
 
-        vms = cls.build_vms(platform_image_file=platform_image_file,
-                cpio_dir=cpio_dir,
-                manifest_path=manifest_path,
-                rebuild=rebuild)
+        with cls.tracer.span("build_vms"):
+            vms = cls.build_vms(platform_image_file=platform_image_file,
+                    cpio_dir=cpio_dir,
+                    manifest_path=manifest_path,
+                    rebuild=rebuild)
 
-        cls.before_vm_pack(vms, manifest_path, cpio_dir)
+        with cls.tracer.span("before_vm_pack"):
+            cls.before_vm_pack(vms, manifest_path, cpio_dir)
 
-        cls.pack_vms(platform_image_file=platform_image_file, cpio_dir=cpio_dir)
+        with cls.tracer.span("pack_vms"):
+            cls.pack_vms(platform_image_file=platform_image_file, cpio_dir=cpio_dir)
 
         # integrate everything into a single FIT image
-        cls.create_platform_fit_image()
+        with cls.tracer.span("create_platform_fit_image"):
+            cls.create_platform_fit_image()
 
         cls.make("target") # target specific make target
 
+        if args.watch:
+            cls.watch(config_path, platform_image_file, cpio_dir, manifest_path, vms)
+
 
 if __name__ == "__main__":
     Builder.build()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+""" Concurrent execution of VM build commands under a global job budget.
+
+The scheduler only runs the (potentially long) `build_command` of each VM.
+Everything that must remain deterministic, such as VM ID assignment, artifact
+staging and manifest generation, is still performed sequentially by the caller
+once all builds have finished.
+"""
+
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+
+# make's short options taking a (required / optional) argument, which is the
+# rest of the option group or, if required, the next word
+MAKE_OPTS_REQUIRED_ARG = "CfIoW"
+MAKE_OPTS_OPTIONAL_ARG = "jlO"
+
+def default_jobs():
+    """ Default global job budget
+
+    Returns:
+        int: number of online CPUs (at least 1)
+    """
+    return os.cpu_count() or 1
+
+
+def _split_short_options(group):
+    """ Split a group of short options at the first one taking an argument
+
+    Args:
+        group (str): Options without the leading "-", e.g.: "kj8"
+
+    Returns:
+        tuple(str, str, str): options before it, the option (None if there is
+            none) and the rest of the group, e.g.: ("k", "j", "8")
+    """
+    for idx, opt in enumerate(group):
+        if opt in MAKE_OPTS_REQUIRED_ARG or opt in MAKE_OPTS_OPTIONAL_ARG:
+            return group[:idx], opt, group[idx + 1:]
+    return group, None, ""
+
+
+def apply_job_limit(argv, jobs):
+    """ Rewrite the parallelism argument of a `make` command line
+
+    Handles "-j", "-j8", "-j 8", "--jobs", "--jobs=8", "--jobs 8" and "-j"
+    within a group of short options, e.g.: "-kj8".
+
+    Args:
+        argv (list(str)): Command line
+        jobs (int): Number of jobs the command may use
+
+    Returns:
+        list(str): Command line with every job count replaced by `-j<jobs>`;
+            one is appended if there was none. Commands other than `make` are
+            returned unchanged.
+    """
+    if not argv or os.path.basename(argv[0]) != "make":
+        return argv
+
+    result = [argv[0]]
+    limited = False
+    idx = 1
+
+    while idx < len(argv):
+        arg = argv[idx]
+        idx += 1
+
+        if arg == "--":
+            # the remaining words are targets and variables
+            if not limited:
+                result.append(f"-j{jobs}")
+                limited = True
+            result.extend(argv[idx - 1:])
+            break
+
+        if arg == "--jobs" or arg.startswith("--jobs="):
+            others, count = "", arg[len("--jobs="):]
+        elif arg.startswith("-") and not arg.startswith("--"):
+            others, opt, count = _split_short_options(arg[1:])
+            if opt != "j":
+                result.append(arg)
+                # skip the argument of e.g. "-C dir", it is not an option
+                if opt and opt in MAKE_OPTS_REQUIRED_ARG and not count:
+                    result.extend(argv[idx:idx + 1])
+                    idx += 1
+                continue
+        else:
+            result.append(arg)
+            continue
+
+        if others:
+            result.append(f"-{others}")
+        # "-j 8" / "--jobs 8": the job count is the next word
+        if not count and idx < len(argv) and argv[idx].isdigit():
+            idx += 1
+
+        result.append(f"-j{jobs}")
+        limited = True
+
+    if not limited:
+        result.append(f"-j{jobs}")
+
+    return result
+
+class BuildError(Exception):
+    """ Raised when a build job exits with a non-zero status """
+
+    def __init__(self, job, tail):
+        """ Initializer for BuildError
+
+        Args:
+            job (BuildJob): The failed job
+            tail (str): Last lines of the job's log file
+        """
+        super().__init__(f"build of {', '.join(job.names)} failed "
+                         f"with exit code {job.returncode}")
+        self.job = job
+        self.tail = tail
+
+
+class BuildJob:
+    """ A single build command, possibly shared by several VMs """
+
+    def __init__(self, name, argv, cwd, env, log_path):
+        """ Initializer for BuildJob
+
+        Args:
+            name (str): Name of the (first) VM requesting this build
+            argv (list(str)): Command line
+            cwd (str): Working directory of the command
+            env (dict): Environment of the command
+            log_path (str): File receiving stdout & stderr of the command
+        """
+
+        self.names = [name]
+        self.argv = argv
+        self.cwd = cwd
+        self.env = env
+        self.log_path = log_path
+        self.returncode = None
+        self.started = None         # time.monotonic() when the job was started
+        self.duration = None
+        self.process = None
+
+    def key(self):
+        """ Identity of the job; equal keys denote the exact same build
+
+        Returns:
+            tuple: hashable job identity
+        """
+        return (tuple(self.argv), self.cwd, tuple(sorted(self.env.items())))
+
+
+class VMBuildScheduler:
+    """ Runs build jobs concurrently and fails fast on the first error """
+
+    def __init__(self, jobs=None, log_dir=None, tail_lines=40):
+        """ Initializer for VMBuildScheduler
+
+        Args:
+            jobs (int, optional): Global job budget. Defaults to CPU count.
+            log_dir (str, optional): Directory for per-VM logs. Defaults to cwd.
+            tail_lines (int, optional): Log lines shown on failure. Defaults to 40.
+        """
+
+        self.jobs = max(1, jobs or default_jobs())
+        self.log_dir = log_dir or os.getcwd()
+        self.tail_lines = tail_lines
+        self.queue = []
+        self._abort = threading.Event()
+        self._lock = threading.Lock()
+
+    def add(self, name, argv, cwd, env):
+        """ Queue a build command
+
+        Identical commands (same argv, working directory and environment) are
+        only executed once, e.g.: two Linux guests sharing the same kernel and
+        buildroot tree.
+
+        Args:
+            name (str): Name of the VM (used for the log file name)
+            argv (list(str)): Command line
+            cwd (str): Working directory of the command
+            env (dict): Environment of the command
+        """
+
+        job = BuildJob(name, argv, cwd, env,
+                       os.path.join(self.log_dir, f"{name}.build.log"))
+
+        for it in self.queue:
+            if it.key() == job.key():
+                it.names.append(name)
+                return
+
+        self.queue.append(job)
+
+    def job_shares(self):
+        """ Split the global job budget between the queued builds
+
+        Returns:
+            tuple(int, int): (number of concurrent builds, jobs per build)
+        """
+        workers = max(1, min(self.jobs, len(self.queue)))
+        return workers, max(1, self.jobs // workers)
+
+    def _tail(self, job):
+        """ Read the last lines of a job's log """
+        try:
+            with open(job.log_path, "r", errors="replace") as f:
+                return "".join(f.readlines()[-self.tail_lines:])
+        except OSError:
+            return ""
+
+    def _run(self, job, jobs_per_build):
+        """ Execute a single job; runs in a worker thread """
+
+        argv = apply_job_limit(job.argv, jobs_per_build)
+        env = {**job.env, "PEREGRINE_VM_JOBS": str(jobs_per_build)}
+
+        # checked under the lock `_terminate()` holds, so that no build is
+        # started after the others were stopped
+        with self._lock:
+            if self._abort.is_set():
+                return job
+
+            print(f"Building {', '.join(job.names)} (-j{jobs_per_build}), "
+                  f"log: {job.log_path}")
+
+            start = job.started = time.monotonic()
+            with open(job.log_path, "wb") as log:
+                # own process group, so that the whole build can be stopped
+                job.process = subprocess.Popen(argv, cwd=job.cwd, env=env,
+                                               stdout=log,
+                                               stderr=subprocess.STDOUT,
+                                               stdin=subprocess.DEVNULL,
+                                               start_new_session=True)
+
+        job.returncode = job.process.wait()
+        job.duration = time.monotonic() - start
+
+        if job.returncode != 0:
+            # terminated because another build failed first
+            if self._abort.is_set():
+                return job
+
+            self._abort.set()
+            raise BuildError(job, self._tail(job))
+
+        print(f"Finished {', '.join(job.names)} in {job.duration:.1f}s")
+        return job
+
+    def _terminate(self):
+        """ Stop every build that is still running, including its children """
+        with self._lock:
+            for job in self.queue:
+                if job.process is not None and job.process.poll() is None:
+                    try:
+                        os.killpg(job.process.pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+
+    def run(self):
+        """ Execute all queued builds
+
+        Raises:
+            BuildError: first build that failed; all other builds are stopped
+        """
+
+        if not self.queue:
+            return
+
+        os.makedirs(self.log_dir, exist_ok=True)
+        workers, jobs_per_build = self.job_shares()
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [ pool.submit(self._run, job, jobs_per_build)
+                        for job in self.queue ]
+            try:
+                done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+            except KeyboardInterrupt:
+                # the builds run in their own sessions and do not receive
+                # the terminal's SIGINT
+                self._abort.set()
+                self._terminate()
+                raise
+
+            failed = [ it for it in done if it.exception() is not None ]
+            if failed:
+                self._abort.set()
+                for it in pending:
+                    it.cancel()
+                self._terminate()
+                raise failed[0].exception()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+""" Timing spans and profiling for the build process.
+
+Spans are nested, per-thread timing records of the build phases (hooks, make
+targets, VM builds, FDT patching, packing, ...). Besides wall time, each span
+records the CPU time consumed by this process and by its (waited for) child
+processes, and the peak RSS of the largest child process seen so far. Spans
+are written as Chrome trace-event JSON (open in chrome://tracing or Perfetto)
+along with a text summary sorted by total wall time.
+
+Child process statistics come from `getrusage(RUSAGE_CHILDREN)`, which is
+process-wide: spans that overlap in time (e.g.: concurrent VM builds) are all
+charged with the CPU time of every child that finished meanwhile.
+"""
+
+import atexit
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import resource
+import threading
+import time
+
+PROFILE_TOP_ENTRIES = 40
+
+
+def _usage():
+    """ Snapshot of (self CPU time, children CPU time, children peak RSS [KiB]) """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + own.ru_stime,
+            children.ru_utime + children.ru_stime,
+            children.ru_maxrss)
+
+
+class BuildTracer:
+    """ Records timing spans; all methods are no-ops while disabled """
+
+    def __init__(self, enabled=False):
+        """ Initializer for BuildTracer
+
+        Args:
+            enabled (bool, optional): Record spans. Defaults to False.
+        """
+
+        self.enabled = enabled
+        self.origin = time.monotonic()
+        self.events = []
+        self.threads = {}
+        self._lock = threading.Lock()
+
+    def _thread_id(self, name=None):
+        """ Small, stable ID of the current thread (or of a named lane) """
+
+        name = name or threading.current_thread().name
+        with self._lock:
+            return self.threads.setdefault(name, len(self.threads) + 1)
+
+    def record(self, name, start, duration, thread=None, **args):
+        """ Adds an already measured span
+
+        Args:
+            name (str): Span name
+            start (float): `time.monotonic()` at the beginning of the span
+            duration (float): Wall time [s]
+            thread (str, optional): Lane of the span. Defaults to the current
+                thread.
+            args (dict): Extra values shown with the span
+        """
+
+        if not self.enabled:
+            return
+
+        event = {
+            "name": name,
+            "ph": "X",
+            "pid": os.getpid(),
+            "tid": self._thread_id(thread),
+            "ts": (start - self.origin) * 1e6,
+            "dur": duration * 1e6,
+            "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def record_sequence(self, prefix, timings, start):
+        """ Adds consecutive spans measured as (name, duration) pairs
+
+        Args:
+            prefix (str): Prepended to the name of each span
+            timings (list(tuple(str, float))): e.g.: `FdtPipeline.timings`
+            start (float): `time.monotonic()` at the beginning of the first span
+        """
+
+        for name, duration in timings:
+            self.record(f"{prefix}{name}", start, duration)
+            start += duration
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """ Context manager measuring the enclosed block
+
+        Args:
+            name (str): Span name
+            args (dict): Extra values shown with the span
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        usage = _usage()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            end_usage = _usage()
+            self.record(name, start, duration,
+                        cpu_s=round(end_usage[0] - usage[0], 6),
+                        child_cpu_s=round(end_usage[1] - usage[1], 6),
+                        child_max_rss_kib=end_usage[2],
+                        **args)
+
+    def summary(self):
+        """ Aggregates the spans by name
+
+        Returns:
+            str: one line per span name, sorted by total wall time
+        """
+
+        totals = {}
+        for it in self.events:
+            entry = totals.setdefault(it["name"], [0, 0.0, 0.0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += it["dur"] / 1e6
+            entry[2] = max(entry[2], it["dur"] / 1e6)
+            entry[3] += it["args"].get("child_cpu_s", 0.0)
+            entry[4] = max(entry[4], it["args"].get("child_max_rss_kib", 0))
+
+        lines = ["%-48s %6s %10s %10s %12s %14s" % ("span", "count", "total [s]",
+                 "max [s]", "child CPU [s]", "child RSS [MiB]")]
+        for name, (count, total, longest, child_cpu, rss) in \
+                sorted(totals.items(), key=lambda it: it[1][1], reverse=True):
+            lines.append("%-48s %6d %10.3f %10.3f %12.3f %14.1f" % (
+                name[:48], count, total, longest, child_cpu, rss / 1024))
+
+        return "\n".join(lines)
+
+    def write(self, trace_path):
+        """ Writes the Chrome trace-event JSON and the text summary
+
+        The summary is stored next to the trace as `<trace_path>.txt`.
+
+        Args:
+            trace_path (str): Output file
+        """
+
+        metadata = [ {"name": "thread_name", "ph": "M", "pid": os.getpid(),
+                      "tid": tid, "args": {"name": name}}
+                     for name, tid in self.threads.items() ]
+
+        with open(trace_path, "w") as f:
+            json.dump({"traceEvents": metadata + self.events,
+                       "displayTimeUnit": "ms"}, f)
+
+        summary = self.summary()
+        with open(f"{trace_path}.txt", "w") as f:
+            f.write(summary + "\n")
+
+        print(f"----- build trace: {trace_path} -----\n{summary}")
+
+
+def start(trace_path=None, profile_path=None):
+    """ Enables tracing and/or profiling until the interpreter exits
+
+    Args:
+        trace_path (str, optional): Output file of the Chrome trace
+        profile_path (str, optional): Output file of the cProfile statistics
+            (`pstats` format) covering the Python code of the main thread,
+            e.g.: DTS parsing and FDT patching
+
+    Returns:
+        BuildTracer: tracer to record spans with (disabled if no `trace_path`)
+    """
+
+    # the build may change directories before exiting
+    trace_path = os.path.abspath(trace_path) if trace_path else None
+    profile_path = os.path.abspath(profile_path) if profile_path else None
+
+    tracer = BuildTracer(enabled=trace_path is not None)
+    profiler = None
+
+    if profile_path is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def finish():
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report) \
+                  .sort_stats("cumulative").print_stats(PROFILE_TOP_ENTRIES)
+            print(f"----- profile: {profile_path} -----{report.getvalue()}")
+
+        if tracer.enabled:
+            tracer.write(trace_path)
+
+    # runs on `sys.exit()` as well, so failed builds can be inspected too
+    atexit.register(finish)
+    return tracer
@@ -1,4 +1,10 @@
 import subprocess
+import os
+import shutil
+import fcntl
+
+# ioctl number of FICLONE (see linux/fs.h)
+FICLONE = 0x40049409
 
 def replace_file_line(file, old_line_text, new_line_text):
     """Replace a line in a file
@@ -32,3 +38,26 @@ def compile_dts(src, dest, *args):
     """
 
     subprocess.run(["dtc", "-I", "dts", "-O", "dtb", "-o", dest, src, *args], check=True)
+
+def reflink_or_copy(src, dest):
+    """ Stages a file as an independent copy of its source.
+    Tries a reflink (copy-on-write clone) first and falls back to a regular
+    copy. Hardlinks are not used on purpose: editing the staged file in place
+    (e.g.: from a hook) must not change the source.
+
+    Args:
+        src (str): Path to source file
+        dest (str): Path to destination file (replaced if present)
+    """
+
+    if os.path.lexists(dest):
+        os.remove(dest)
+
+    try:
+        with open(src, "rb") as f_in, open(dest, "wb") as f_out:
+            fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+        return
+    except OSError:
+        pass
+
+    shutil.copyfile(src, dest)
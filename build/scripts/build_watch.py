@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+""" File change notifications for the `--watch` build mode.
+
+Changes are detected with Linux inotify (through ctypes, no extra dependency)
+by watching the parent directories of the files of interest, so that editors
+replacing a file by renaming a temporary one are handled as well. Where
+inotify is not available, the files are polled instead.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_NONBLOCK    = 0x00000800
+IN_CLOEXEC     = 0x00080000
+
+# IN_MODIFY is left out on purpose: files being written trigger IN_CLOSE_WRITE
+# once they are complete
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | \
+             IN_DELETE | IN_ATTRIB
+
+_event_header = struct.Struct("iIII")
+
+
+def _file_identity(path):
+    """ Values that change whenever the content of a file may have changed """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+class _Inotify:
+    """ Thin ctypes wrapper around the inotify system calls """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1() failed")
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch() failed for {path}")
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """ Reads pending events
+
+        Returns:
+            list(tuple(int, int, str)): (watch descriptor, mask, file name)
+        """
+
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+                offset += _event_header.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                events.append((wd, mask, name))
+
+
+class FileWatcher:
+    """ Reports changes of a set of files and directories """
+
+    def __init__(self, poll_interval=0.5, settle_time=0.2, use_inotify=True):
+        """ Initializer for FileWatcher
+
+        Args:
+            poll_interval (float, optional): Seconds between two checks when
+                polling. Defaults to 0.5.
+            settle_time (float, optional): A batch of changes is reported once
+                no further change happened for this long [s]. Defaults to 0.2.
+            use_inotify (bool, optional): Use inotify if available. Defaults
+                to True.
+        """
+
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.files = set()
+        self.directories = set()
+        self.identities = {}
+        self.inotify = None
+        self.watches = {}           # directory -> watch descriptor
+        self.unwatchable = set()    # missing directories (warned about once)
+
+        if use_inotify:
+            try:
+                self.inotify = _Inotify()
+            except (OSError, AttributeError) as e:
+                print(f"WARNING: inotify not available ({e}), polling for changes.")
+
+    @property
+    def backend(self):
+        """ str: "inotify" or "polling" """
+        return "inotify" if self.inotify else "polling"
+
+    def set_paths(self, files, directories=()):
+        """ Selects what to watch
+
+        Args:
+            files (list(str)): Files whose changes are reported; they do not
+                need to exist yet
+            directories (list(str), optional): Directories in which any
+                changed, created or deleted file is reported
+        """
+
+        self.files = { os.path.abspath(it) for it in files if it }
+        self.directories = { os.path.abspath(it) for it in directories if it }
+
+        watched = self.directories | { os.path.dirname(it) for it in self.files }
+        # keep known baselines, so that changes made during a rebuild are
+        # still reported by the next poll
+        self.identities = { it: self.identities[it] if it in self.identities
+                                else _file_identity(it)
+                            for it in self._polled_files() }
+
+        if not self.inotify:
+            return
+
+        for it in set(self.watches) - watched:
+            self.inotify.rm_watch(self.watches.pop(it))
+        for it in watched - set(self.watches):
+            try:
+                self.watches[it] = self.inotify.add_watch(it, WATCH_MASK)
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                if it not in self.unwatchable:
+                    print(f"WARNING: cannot watch {it}: {os.strerror(e.errno)}")
+                    self.unwatchable.add(it)
+
+    def _polled_files(self):
+        """ Every file to stat when polling """
+        files = set(self.files)
+        for directory in self.directories:
+            try:
+                files.update(os.path.join(directory, it) for it in os.listdir(directory))
+            except OSError:
+                pass
+        return files
+
+    def _is_relevant(self, path):
+        return path in self.files or os.path.dirname(path) in self.directories
+
+    def _poll_changes(self):
+        """ Compares the identity of every watched file with the last one """
+
+        changed = set()
+        for it in self._polled_files() | set(self.identities):
+            identity = _file_identity(it)
+            if identity != self.identities.get(it):
+                self.identities[it] = identity
+                changed.add(it)
+        return changed
+
+    def _inotify_changes(self, timeout):
+        """ Waits up to `timeout` seconds for inotify events of watched files
+
+        Events of other files in the watched directories (e.g.: temporary
+        files of a build) do not end the wait.
+        """
+
+        deadline = time.monotonic() + timeout
+        changed = set()
+
+        while not changed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            ready, _, _ = select.select([self.inotify.fd], [], [], remaining)
+            if not ready:
+                break
+
+            directories = { wd: path for path, wd in self.watches.items() }
+            for wd, mask, name in self.inotify.read_events():
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, fall back to comparing the files
+                    changed |= self._poll_changes()
+                    continue
+                if mask & IN_IGNORED or wd not in directories or not name:
+                    continue
+
+                path = os.path.join(directories[wd], name)
+                if self._is_relevant(path):
+                    changed.add(path)
+
+        return changed
+
+    def _changes(self, timeout):
+        """ Changed files, waiting at most `timeout` seconds for the first one """
+
+        if self.inotify:
+            return self._inotify_changes(timeout)
+
+        time.sleep(timeout)
+        return self._poll_changes()
+
+    def wait(self):
+        """ Blocks until at least one watched file changed
+
+        Changes are collected until the files settle, so that e.g. a VM build
+        replacing its kernel and ramdisk is reported as a single batch.
+
+        Returns:
+            tuple(set(str), float): absolute paths of the changed files and
+                `time.monotonic()` when the first change was noticed
+        """
+
+        while True:
+            changed = self._changes(self.poll_interval)
+            if changed:
+                break
+
+        first_change = time.monotonic()
+        while True:
+            more = self._changes(self.settle_time)
+            if not more:
+                break
+            changed |= more
+
+        # keep the polling baseline current for the next batch
+        for it in changed:
+            self.identities[it] = _file_identity(it)
+
+        return changed, first_change
@@ -14,6 +14,7 @@ vm_count = 0
 found_primary = False
 
 regex_json_remove_comment = re.compile(r"#.*\n")
+regex_cpu_node = re.compile(r"^/cpus/cpu@[^/]*$")
 
 MANIFEST_SIG_ALGO_ID    = 0x70414930
 MANIFEST_SIG_SIZE       = 0x100
@@ -200,6 +201,7 @@ class VM:
     requires_identity_mapping: bool = False
     ipa_memory_layout: Dict[str, int] = field(default=None)
     device_whitelist: List[str] = field(default=None)
+    prune_dependent_devices: bool = False
     device_regions: List[DeviceRegions] =  field(default=None)
 
     hash_algo_id: int = MANIFEST_HASH_ALGO_ID
@@ -367,11 +369,10 @@ class PlatformConfig:
                 dts_text = f.read()
 
             if dts_text:
-                dts_parsed = FDT_HOTFIX.parse_dts(dts_text)
-                
-                cpu_list = list(filter(lambda x: x.name.startswith("cpu@"), dts_parsed.get_node("cpus").nodes))
+                # only the CPU nodes are needed, skip building the whole tree
+                cpu_list = list(FDT_HOTFIX.query_dts(dts_text, regex_cpu_node.match).values())
                 for core in cpu_list:
-                    affinity =  core.get_property("reg")[-1]
+                    affinity =  core["reg"][-1]
 
                     affinity0 = affinity % 256 #calculate affinity level 0
                     affinity1 = (affinity//256) % 256 #calculate affinity level 1
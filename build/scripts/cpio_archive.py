@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+""" Streaming writer for cpio archives.
+
+Two formats are supported:
+    "bin"   old binary format (magic 070707, 16 bit little-endian fields),
+            as written by `cpio --create` by default and read by the
+            hypervisor's loader (derived from Hafnium's `cpio.c`)
+    "newc"  SVR4 format without CRC (magic 070701, ASCII hex fields)
+
+Members are registered with the path of their source file and are streamed
+into the archive with `copy_file_range()` / `sendfile()` when writing it, so
+nothing has to be staged in a directory first. The archive is reproducible:
+member order is fixed (leading members first, then sorted by name), and
+modification times, owners, permissions and inode numbers are normalized.
+
+An archive can be updated in place: given the writer that produced it, only
+the members following the first changed one are rewritten.
+"""
+
+import os
+import struct
+
+BIN_MAGIC = 0o070707
+NEWC_MAGIC = b"070701"
+TRAILER = "TRAILER!!!"
+BLOCK_SIZE = 512
+FILE_MODE = 0o100644
+
+# old binary header: magic, dev, ino, mode, uid, gid, nlink, rdev, mtime (2
+# words, most significant first), namesize, filesize (2 words, idem)
+_bin_header = struct.Struct("<13H")
+
+
+def _pad(offset, alignment):
+    """ Number of padding bytes needed to align `offset` """
+    return -offset % alignment
+
+
+def _bin_header_bytes(ino, mode, nlink, mtime, filesize, name):
+    """ Encodes an old binary member header followed by its (padded) name """
+    name = name.encode() + b"\0"
+    if filesize >= 1 << 32 or len(name) >= 1 << 16:
+        raise ValueError(f"{name[:-1].decode()}: too large for the cpio \"bin\" format")
+
+    header = _bin_header.pack(BIN_MAGIC, 0, ino & 0xFFFF, mode & 0xFFFF, 0, 0,
+                              nlink, 0, (mtime >> 16) & 0xFFFF, mtime & 0xFFFF,
+                              len(name), filesize >> 16, filesize & 0xFFFF) + name
+    return header + b"\0" * _pad(len(header), 2)
+
+
+def _newc_header_bytes(ino, mode, nlink, mtime, filesize, name):
+    """ Encodes a newc member header followed by its (padded) name """
+    name = name.encode() + b"\0"
+    fields = (ino, mode, 0, 0, nlink, mtime, filesize, 0, 0, 0, 0, len(name), 0)
+    header = NEWC_MAGIC + b"".join(b"%08X" % it for it in fields) + name
+    return header + b"\0" * _pad(len(header), 4)
+
+
+# format -> (header encoder, alignment of headers and data)
+FORMATS = {
+    "bin":  (_bin_header_bytes, 2),
+    "newc": (_newc_header_bytes, 4),
+}
+
+
+def _file_identity(st):
+    """ Values that change whenever the content of a file may have changed """
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+def _write(fd, data):
+    """ Writes all of `data` to a file descriptor """
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _copy_range(src_fd, dst_fd, size):
+    """ Copies `size` bytes between the current offsets of two descriptors
+
+    Uses `copy_file_range()` (in-kernel, possibly reflinked), then
+    `sendfile()`, then a plain read/write loop, whichever the platform and
+    file systems support.
+    """
+
+    remaining = size
+    for copy in ("copy_file_range", "sendfile"):
+        if not hasattr(os, copy):
+            continue
+        try:
+            while remaining > 0:
+                if copy == "copy_file_range":
+                    done = os.copy_file_range(src_fd, dst_fd, remaining)
+                else:
+                    done = os.sendfile(dst_fd, src_fd, None, remaining)
+                if done == 0:
+                    break
+                remaining -= done
+            if remaining == 0:
+                return
+        except OSError:
+            # e.g.: EXDEV/EINVAL on older kernels, retry with the next method
+            continue
+
+    while remaining > 0:
+        chunk = os.read(src_fd, min(remaining, 1 << 20))
+        if not chunk:
+            raise OSError(f"unexpected end of file, {remaining} bytes missing")
+        _write(dst_fd, chunk)
+        remaining -= len(chunk)
+
+
+class CpioMember:
+    """ A regular file of the archive """
+
+    def __init__(self, name, path):
+        """ Initializer for CpioMember
+
+        Args:
+            name (str): Name of the member inside the archive
+            path (str): Source file
+        """
+
+        self.name = name
+        self.path = path
+        self.size = None
+        self.offset = None          # offset of the member's data in the archive
+        self.identity = None        # identity of the source file when written
+
+    def end(self, alignment):
+        """ Offset of the next header in the archive
+
+        Args:
+            alignment (int): Alignment of the archive format
+        """
+        return self.offset + self.size + _pad(self.size, alignment)
+
+
+class CpioWriter:
+    """ Collects archive members and writes them as a cpio archive """
+
+    def __init__(self, leading=(), mtime=None, fmt="bin"):
+        """ Initializer for CpioWriter
+
+        Args:
+            leading (list(str), optional): Names of the members that must be
+                stored first, in this order. All of them must be added.
+            mtime (int, optional): Modification time of all members. Defaults
+                to $SOURCE_DATE_EPOCH, or 0 if not set.
+            fmt (str, optional): Archive format, one of `FORMATS`. Defaults to
+                "bin", the default format of `cpio --create`.
+        """
+
+        if fmt not in FORMATS:
+            raise ValueError(f"unknown cpio format: {fmt}")
+
+        self.fmt = fmt
+        self.leading = list(leading)
+        self.mtime = int(os.environ.get("SOURCE_DATE_EPOCH", 0)) if mtime is None else mtime
+        self.members = {}
+        self.size = None
+        self.identity = None        # identity of the written archive
+        self.reused = 0             # members kept from a previous archive
+
+    def add_file(self, name, path):
+        """ Registers a member; a later registration of the same name wins
+
+        Args:
+            name (str): Name of the member inside the archive
+            path (str): Source file
+        """
+        self.members[name] = CpioMember(name, path)
+
+    def add_directory(self, directory, prefix="", exclude=()):
+        """ Registers every regular file of a directory tree
+
+        Args:
+            directory (str): Directory to scan
+            prefix (str, optional): Prepended to the relative path of each file
+            exclude (list(str), optional): Member names that are not added
+        """
+
+        for root, dirs, files in os.walk(directory):
+            for it in files:
+                path = os.path.join(root, it)
+                name = prefix + os.path.relpath(path, directory)
+                if name not in exclude and os.path.isfile(path):
+                    self.add_file(name, path)
+
+    def ordered_members(self):
+        """ Members in archive order
+
+        Returns:
+            list(CpioMember): leading members, then the others sorted by name
+
+        Raises:
+            ValueError: a leading member was not added
+        """
+
+        missing = [ it for it in self.leading if it not in self.members ]
+        if missing:
+            raise ValueError(f"missing archive member(s): {', '.join(missing)}")
+
+        rest = sorted(it for it in self.members if it not in self.leading)
+        return [ self.members[it] for it in self.leading + rest ]
+
+    def _reusable(self, archive_path, previous, members):
+        """ Number of leading members that are unchanged since `previous` """
+
+        try:
+            if _file_identity(os.stat(archive_path)) != previous.identity:
+                return 0
+        except OSError:
+            return 0
+
+        count = 0
+        for member, old in zip(members, previous.ordered_members()):
+            try:
+                identity = _file_identity(os.stat(member.path))
+            except OSError:
+                break
+            if (member.name, member.path, identity) != (old.name, old.path, old.identity):
+                break
+            count += 1
+
+        return count if (previous.mtime, previous.fmt) == (self.mtime, self.fmt) else 0
+
+    def write(self, archive_path, previous=None):
+        """ Writes the archive
+
+        Args:
+            archive_path (str): Output file
+            previous (CpioWriter, optional): Writer of the current content of
+                `archive_path`. Members up to the first one that was added,
+                removed or whose source file changed since are kept as is.
+
+        Returns:
+            tuple(int, dict): size of the archive and, for each member name,
+                the (offset, size) of its data inside the archive
+        """
+
+        encode_header, alignment = FORMATS[self.fmt]
+        members = self.ordered_members()
+        self.reused = self._reusable(archive_path, previous, members) if previous else 0
+
+        offset = 0
+        if self.reused:
+            for member, old in zip(members[:self.reused], previous.ordered_members()):
+                member.size, member.offset, member.identity = old.size, old.offset, old.identity
+                offset = member.end(alignment)
+
+        with open(archive_path, "r+b" if self.reused else "wb", buffering=0) as out:
+            out_fd = out.fileno()
+            out.seek(offset)
+
+            for ino, member in enumerate(members[self.reused:], start=self.reused + 1):
+                with open(member.path, "rb") as src:
+                    st = os.fstat(src.fileno())
+                    member.size = st.st_size
+                    member.identity = _file_identity(st)
+
+                    header = encode_header(ino, FILE_MODE, 1, self.mtime,
+                                           member.size, member.name)
+                    _write(out_fd, header)
+                    member.offset = offset + len(header)
+
+                    _copy_range(src.fileno(), out_fd, member.size)
+
+                padding = _pad(member.size, alignment)
+                _write(out_fd, b"\0" * padding)
+                offset = member.offset + member.size + padding
+
+            trailer = encode_header(0, 0, 1, 0, 0, TRAILER)
+            trailer += b"\0" * _pad(offset + len(trailer), BLOCK_SIZE)
+            _write(out_fd, trailer)
+            self.size = offset + len(trailer)
+            out.truncate(self.size)
+
+        self.identity = _file_identity(os.stat(archive_path))
+        return self.size, { it.name: (it.offset, it.size) for it in self.members.values() }
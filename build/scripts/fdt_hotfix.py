@@ -14,146 +14,932 @@
 # limitations under the License.
 
 # This file is a patch for pyFDT by Martin Olejar (molejar).
-# In the upstream version, single-line empty node definitions break parsing.
+# The upstream DTS parser works line by line on string splits; it breaks on
+# single-line empty node definitions and rejects several dtc constructs. It is
+# replaced by a single-pass, statement-level tokenizer, which also backs a
+# parsed-tree cache and a query-only mode that builds no FDT objects.
 
 from fdt import items, misc, FDT
+import fdt
+import ast
+import contextlib
+import gc
+import hashlib
+import operator
 import os
+import pickle
+import re
+import sys
+import tempfile
+
+# Bump whenever the parser output changes, invalidates cached trees
+PARSER_VERSION = 3
+
+# Directory of the on-disk parsed-tree cache (None: in-memory cache only)
+CACHE_DIR = None
+
+# in-memory parsed-tree cache: key -> pickled (dependencies, FDT)
+_cache = {}
+
+# one match per statement (node open / close, property or directive) and the
+# whitespace, comments & C preprocessor lines preceding it
+_regex_statement = re.compile(r"""
+    (?: \s+ | //[^\n]* | /\*.*?\*/
+      | (?<!\S)\#[ \t]*(?:include|define|undef|ifdef|ifndef|if|elif
+                         |else|endif|pragma|line|error|warning|\d)
+        (?![\w-])(?:[^\n\\]|\\.)* )*
+    (?: (?P<close>     \} [ \t]* ;? )
+      | (?P<item>      (?P<labels> (?:[A-Za-z_]\w*:\s*)* )
+                       (?:/omit-if-no-ref/\s*)?
+                       (?P<name> [A-Za-z0-9,._+?\#@-]+ | / | &\{[^}]*\} | &[A-Za-z_]\w* ) \s*
+                       (?: (?P<open> \{ )
+                         | (?: = \s* (?P<value> (?: [^;"'/]+(?![^;"'/]) | "(?:[^"\\]|\\.)*"
+                                            | '(?:[^'\\]|\\.)*' | //[^\n]* | /\*.*?\*/ | / )* ) )? ; ) )
+      | (?P<directive> (?P<keyword> /[a-z][a-z0-9-]*/ ) (?P<args> [^;{}]* ) ; )
+      | (?P<end>       \Z )
+      | (?P<error>     . ) )
+""", re.S | re.X)
+
+# tokens of a property value
+_regex_token = re.compile(r"""
+      (?P<space>   (?: \s+ | //[^\n]* | /\*.*?\*/ )+ )
+    | (?P<string>  "(?:[^"\\]|\\.)*" )
+    | (?P<char>    '(?:[^'\\]|\\.)+' )
+    | (?P<keyword> /[a-z][a-z0-9-]*/ )
+    | (?P<label>   [A-Za-z_]\w*: )
+    | (?P<ref>     &(?:\{[^}]*\}|[A-Za-z_]\w*) )
+    | (?P<word>    [A-Za-z0-9,._+?\#@-]+ )
+    | (?P<punct>   [{}<>\[\]();=/&|^~!%*:] )
+    | (?P<error>   . )
+""", re.S | re.X)
+
+# values made of <...> cell lists or of strings only, decoded without tokens
+_regex_simple_cells   = re.compile(r'^<[^"\'(\[/:]*>$')
+_regex_simple_strings = re.compile(r'^"(?:[^"\\]|\\.)*"(?:\s*,\s*"(?:[^"\\]|\\.)*")*$')
+_regex_string         = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+_regex_label   = re.compile(r'([A-Za-z_]\w*)\s*:')
+_regex_include = re.compile(r'^[ \t]*/include/[ \t]*"([^"]*)"[ \t]*$', re.M)
+_regex_incbin  = re.compile(r'/incbin/\s*\(\s*"((?:[^"\\]|\\.)*)"')
+_regex_char    = re.compile(r"'((?:[^'\\]|\\.)+)'")
+_regex_escape  = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)', re.S)
+_regex_number  = re.compile(r'(0[xX][0-9a-fA-F]+|0[bB][01]+|\d+)[uUlL]*')
+_regex_expr    = re.compile(r'^[0-9a-fA-FxXuUlL\s()+\-*/%<>=!&|^~]*$')
+
+# operators of dtc cell expressions (after translation to Python syntax)
+_MASK64 = (1 << 64) - 1
+_binary_ops = {ast.Add: operator.add, ast.Sub: operator.sub,
+               ast.Mult: operator.mul, ast.FloorDiv: operator.floordiv,
+               ast.Mod: operator.mod, ast.LShift: operator.lshift,
+               ast.RShift: operator.rshift, ast.BitAnd: operator.and_,
+               ast.BitOr: operator.or_, ast.BitXor: operator.xor}
+_unary_ops  = {ast.USub: operator.neg, ast.UAdd: operator.pos,
+               ast.Invert: operator.invert, ast.Not: lambda it: int(not it)}
+_compare_ops = {ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt,
+                ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge}
+
+_escapes = {'a': '\a', 'b': '\b', 't': '\t', 'n': '\n', 'v': '\v', 'f': '\f',
+            'r': '\r'}
+
+
+def set_cache_dir(path):
+    """
+    Enable the on-disk parsed-tree cache
+
+    :param path: Cache directory (created if missing); None disables it
+    """
+    global CACHE_DIR
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+    CACHE_DIR = path
+
+
+def _to_int(word, bits=32):
+    """ Converts a dtc integer literal (octal with leading 0, U/L suffixes,
+        negative values wrap around) """
+    try:
+        return int(word, 0) & ((1 << bits) - 1)
+    except ValueError:
+        pass
+
+    word = word.rstrip('uUlL')
+    sign = -1 if word.startswith('-') else 1
+    word = word.lstrip('-')
+    if word[:2] in ('0x', '0X'):
+        value = int(word[2:], 16)
+    elif word[:2] in ('0b', '0B'):
+        value = int(word[2:], 2)
+    elif word.startswith('0'):
+        value = int(word, 8)
+    else:
+        value = int(word)
+    return (sign * value) & ((1 << bits) - 1)
+
+
+def _unescape(text):
+    """ Resolves C-style escape sequences of a string / char literal """
+    if '\\' not in text:
+        return text
+
+    def _replace(m):
+        seq = m.group(1)
+        if seq[0] == 'x' and len(seq) > 1:
+            return chr(int(seq[1:], 16))
+        if seq[0] in '01234567':
+            return chr(int(seq, 8))
+        return _escapes.get(seq, seq)
+
+    return _regex_escape.sub(_replace, text)
+
+
+def _eval_node(node):
+    """ Evaluates a node of a parsed cell expression with dtc semantics: every
+        operation is carried out on unsigned 64 bit integers """
+    if isinstance(node, ast.Expression):
+        return _eval_node(node.body)
+
+    if isinstance(node, ast.Constant) and type(node.value) is int:
+        return node.value & _MASK64
+
+    if isinstance(node, ast.BinOp) and type(node.op) in _binary_ops:
+        left, right = _eval_node(node.left), _eval_node(node.right)
+        if isinstance(node.op, (ast.FloorDiv, ast.Mod)) and right == 0:
+            raise ValueError("division by zero")
+        # shifting by the operand width or more yields 0 (keeps results small)
+        if isinstance(node.op, ast.LShift) and right >= 64:
+            return 0
+        return _binary_ops[type(node.op)](left, right) & _MASK64
+
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _unary_ops:
+        return _unary_ops[type(node.op)](_eval_node(node.operand)) & _MASK64
+
+    if isinstance(node, ast.BoolOp):
+        # short-circuits like the C operators
+        check = all if isinstance(node.op, ast.And) else any
+        return int(check(_eval_node(it) for it in node.values))
+
+    if isinstance(node, ast.Compare) and \
+            all(type(it) in _compare_ops for it in node.ops):
+        # C comparisons do not chain: "a < b < c" is "(a < b) < c"
+        value = _eval_node(node.left)
+        for op, right in zip(node.ops, node.comparators):
+            value = int(_compare_ops[type(op)](value, _eval_node(right)))
+        return value
+
+    raise ValueError("unsupported operation: {}".format(type(node).__name__))
+
+
+def _eval_expr(expr, bits=32):
+    """ Evaluates a parenthesized integer expression of a cell list """
+    text = _regex_char.sub(lambda m: str(ord(_unescape(m.group(1)))), expr)
+    if not _regex_expr.match(text) or '?' in text:
+        raise ValueError("unsupported expression: {}".format(expr))
+    text = _regex_number.sub(lambda m: str(_to_int(m.group(1), 64)), text)
+    text = text.replace('&&', ' and ').replace('||', ' or ').replace('/', '//')
+    text = re.sub(r'!(?!=)', ' not ', text)
+    try:
+        return _eval_node(ast.parse(text.strip(), mode='eval')) & ((1 << bits) - 1)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        raise ValueError("unsupported expression: {}".format(expr))
+
+
+def _normalize(text):
+    """ Reproduces the logical-line form of a property value used by the
+        original parser for phantom "*_with_references" properties """
+    if '\n' not in text and '/' not in text and '\0' not in text:
+        return text.replace('\t', ' ').strip().replace(';', '')
+    text = misc.strip_comments(text + '\n')
+    lines = (it.replace('\t', ' ').rstrip('\0').strip() for it in text.split('\n'))
+    return ' '.join(it for it in lines if it).replace(';', '')
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    """ Suspends the cyclic garbage collector while a tree is built: its tens
+        of thousands of new objects would otherwise trigger collections that
+        traverse them again and again, without ever finding garbage """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _file_digest(path):
+    """ SHA-256 of a file, None if it is not readable """
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except (OSError, TypeError):
+        return None
+
+
+# digest of this module, part of the parsed-tree cache key
+_MODULE_DIGEST = _file_digest(__file__) or ''
+
+
+def _new_item(cls, name, parent, **state):
+    """ Creates a pyfdt node / property without running its constructor, which
+        validates the name character by character (names matched by
+        `_regex_statement` are printable) """
+    item = cls.__new__(cls)
+    item.__dict__.update(_name=name, _label=None, _parent=parent, **state)
+    return item
+
+
+def _node_path(node):
+    """ Absolute path of a parsed node """
+    names = []
+    while node is not None and node.parent is not None:
+        names.append(node.name)
+        node = node.parent
+    return '/' + '/'.join(reversed(names))
+
+
+class _DtsParser:
+    """
+    Single-pass parser of DTS text
+
+    Statements (node open / close, properties, directives) are matched one at
+    a time by `_regex_statement`. The parser only validates the structure;
+    tree construction is delegated to a handler receiving open_root/open_ref/
+    open_node/close_node, property, delete_node/delete_property and memreserve
+    events. Property values are decoded on demand through `parse_value()`.
+    """
+
+    def __init__(self, text, root_dir, handler):
+        self.root_dir = root_dir
+        self.deps     = []
+        self.text     = self._include(text, 0) if '/include/' in text else text
+        self.handler  = handler
+
+    def _include(self, text, depth):
+        """ Splices /include/ files into the source text """
+        if depth > 32:
+            raise Exception("/include/ nested too deeply")
+
+        def _replace(m):
+            with open(self._resolve(m.group(1)), 'r') as f:
+                return self._include(f.read(), depth + 1)
+
+        return _regex_include.sub(_replace, text)
+
+    def _resolve(self, name):
+        """
+        Locates an /include/ or /incbin/ file: relative paths are looked up in
+        the root directory first, then in the current working directory (where
+        they were looked up before the root directory was introduced)
+
+        :return: Path of the file; it and the candidates that did not exist
+                 are recorded as dependencies
+        """
+        candidates = [os.path.join(self.root_dir, name)]
+        if self.root_dir and not os.path.isabs(name):
+            candidates.append(name)
+
+        for path in candidates:
+            self.deps.append(os.path.abspath(path))
+            if os.path.exists(path):
+                return path
+
+        raise Exception("File path doesn't exist: {}".format(candidates[0]))
+
+    def error(self, msg, offset):
+        """ Raises a parsing error located at a text offset """
+        line = self.text.count('\n', 0, offset) + 1
+        raise Exception("DTS line {}: {}".format(line, msg))
+
+    def value_error(self, msg, start):
+        """ Raises a parsing error located in the value being decoded """
+        self.error(msg, self.offset + start)
+
+    def parse(self):
+        """ Parses the whole text """
+        handler  = self.handler
+        property = handler.property
+        depth    = 0
+
+        for m in _regex_statement.finditer(self.text):
+            kind = m.lastgroup
+
+            if kind == 'item':
+                name, labels, is_node, value = m.group('name', 'labels', 'open', 'value')
+                special = name[0] in '&/'
+                if is_node is None:
+                    if depth == 0 or special:
+                        self.error("unexpected property '{}'".format(name), m.start('name'))
+                    property(name, value, m.start('value'))
+                    continue
+                labels = _regex_label.findall(labels) if labels else ()
+                if depth > 0 and not special:
+                    handler.open_node(name, labels)
+                elif depth == 0 and name == '/':
+                    handler.open_root(labels)
+                elif depth == 0 and name[0] == '&':
+                    handler.open_ref(name, labels)
+                else:
+                    self.error("unexpected node '{}'".format(name), m.start('name'))
+                depth += 1
+            elif kind == 'close':
+                if depth == 0:
+                    self.error("unbalanced '}'", m.start('close'))
+                handler.close_node()
+                depth -= 1
+            elif kind == 'directive':
+                self._directive(m, depth)
+            elif kind == 'error':
+                self.error("unexpected character '{}'".format(m.group('error')),
+                           m.start('error'))
+
+        if depth != 0:
+            self.error("unterminated node", len(self.text))
+
+    def _directive(self, m, depth):
+        """ Handles a /keyword/ ... ; statement """
+        keyword = m.group('keyword')
+        args    = m.group('args').split()
+
+        if keyword == '/dts-v1/' and depth == 0 and not args:
+            pass
+        elif keyword == '/memreserve/' and depth == 0 and len(args) == 2:
+            self.handler.memreserve(_to_int(args[0], 64), _to_int(args[1], 64))
+        elif keyword == '/delete-node/' and len(args) == 1 and \
+             (depth > 0) != args[0].startswith('&'):
+            if depth > 0:
+                self.handler.delete_node(name=args[0])
+            else:
+                self.handler.delete_node(ref=args[0])
+        elif keyword == '/delete-property/' and depth > 0 and len(args) == 1:
+            self.handler.delete_property(args[0])
+        elif keyword == '/plugin/':
+            raise NotImplementedError("Not implemented: /plugin/")
+        else:
+            self.error("invalid {} statement".format(keyword), m.start('keyword'))
+
+    def parse_value(self, value, offset):
+        """
+        Decodes a property value
+
+        :param value: Value text (between '=' and ';')
+        :param offset: Position of the value in the parsed text
+        :return: List of components: ('cells', bits, [int | '&ref']),
+                 ('string', str), ('path', '&ref'), ('bytes', bytes) and
+                 ('incbin', bytes, file name)
+        """
+        value = value.rstrip()
+
+        # fast paths for the vast majority of the properties: cell lists
+        # made of plain numbers and strings without escape sequences
+        if value[:1] == '<' and value[-1:] == '>':
+            words = value.replace('<', ' ').replace('>', ' ').replace(',', ' ').split()
+            if '&' not in value and '-' not in value:
+                try:
+                    return [('cells', 32, [ int(it, 0) for it in words ])]
+                except ValueError:
+                    pass
+            elif _regex_simple_cells.match(value):
+                return [('cells', 32, [ it if it[0] == '&' else _to_int(it) for it in words ])]
+        elif value[:1] == '"':
+            if value.count('"') == 2 and value[-1] == '"' and '\\' not in value:
+                return [('string', value[1:-1])]
+            if _regex_simple_strings.match(value):
+                return [ ('string', _unescape(it)) for it in _regex_string.findall(value) ]
+
+        self.offset = offset
+        tokens = [ (m.lastgroup, m.group(), m.start(), m.end())
+                   for m in _regex_token.finditer(value) if m.lastgroup != 'space' ]
+        end    = len(tokens)
+        comps  = []
+        i      = 0
+
+        while i < end:
+            kind, token, start, _ = tokens[i]
+            i += 1
+
+            if kind == 'label' or (kind == 'word' and not token.strip(',')):
+                continue
+            elif kind == 'string':
+                comps.append(('string', _unescape(token[1:-1])))
+            elif kind == 'ref':
+                comps.append(('path', token))
+            elif kind == 'keyword' and token == '/bits/':
+                bits = int(tokens[i][1], 0) if i < end else 0
+                if bits not in (8, 16, 32, 64) or i + 1 >= end or tokens[i + 1][1] != '<':
+                    self.value_error("invalid /bits/ specification", start)
+                i, cells = self._cells(tokens, i + 2, value, bits)
+                comps.append(('cells', bits, cells))
+            elif token == '<':
+                i, cells = self._cells(tokens, i, value, 32)
+                comps.append(('cells', 32, cells))
+            elif token == '[':
+                data = []
+                while i < end and tokens[i][1] != ']':
+                    if tokens[i][0] == 'word':
+                        data.append(tokens[i][1].replace(',', ''))
+                    elif tokens[i][0] != 'label':
+                        self.value_error("invalid byte string", tokens[i][2])
+                    i += 1
+                data = ''.join(data)
+                if i == end or len(data) % 2:
+                    self.value_error("invalid byte string", start)
+                comps.append(('bytes', bytes.fromhex(data)))
+                i += 1
+            elif kind == 'keyword' and token == '/incbin/':
+                i, comp = self._incbin(tokens, i, value)
+                comps.append(comp)
+            elif kind == 'keyword' and token == '/plugin/':
+                raise NotImplementedError("Not implemented property value: /plugin/")
+            else:
+                self.value_error("unexpected '{}' in property value".format(token), start)
+
+        return comps
+
+    def _cells(self, tokens, i, value, bits):
+        """ Decodes the content of a <...> cell list starting at token i """
+        cells = []
+
+        while i < len(tokens) and tokens[i][1] != '>':
+            kind, token, start, end = tokens[i]
+            if kind == 'word':
+                cells.extend(_to_int(it, bits) for it in token.split(',') if it)
+            elif kind == 'ref':
+                if bits != 32:
+                    self.value_error("references are only allowed in 32-bit cells", start)
+                cells.append(token)
+            elif kind == 'char':
+                cells.append(ord(_unescape(token[1:-1])) & ((1 << bits) - 1))
+            elif token == '(':
+                depth = 0
+                for k in range(i, len(tokens)):
+                    depth += (tokens[k][1] == '(') - (tokens[k][1] == ')')
+                    if depth == 0:
+                        break
+                else:
+                    self.value_error("unbalanced '('", start)
+                cells.append(_eval_expr(value[start:tokens[k][3]], bits))
+                i = k
+            elif kind != 'label':
+                self.value_error("unexpected '{}' in cell list".format(token), start)
+            i += 1
+
+        if i >= len(tokens):
+            self.value_error("unterminated cell list", tokens[-1][2])
+        return i + 1, cells
+
+    def _incbin(self, tokens, i, value):
+        """ Reads the data of an /incbin/("file"[, offset, size]) value """
+        close = i
+        while close < len(tokens) and tokens[close][1] != ')':
+            close += 1
+        if close >= len(tokens) or close < i + 2 or tokens[i][1] != '(' or \
+           tokens[i + 1][0] != 'string':
+            self.value_error("invalid /incbin/ arguments", tokens[i - 1][2])
+
+        args = [ _to_int(it.strip(), 64)
+                 for it in value[tokens[i + 1][3]:tokens[close][3] - 1].split(',')
+                 if it.strip() ]
+
+        file_path = self._resolve(_unescape(tokens[i + 1][1][1:-1]))
+
+        with open(file_path, 'rb') as f:
+            f.seek(args[0] if args else 0)
+            data = f.read(args[1]) if len(args) > 1 else f.read()
+        return close + 1, ('incbin', data, os.path.split(file_path)[1])
+
+
+class _TreeBuilder:
+    """ Parser handler building a fdt.FDT object """
+
+    def __init__(self):
+        self.fdt_obj      = FDT()
+        self.fdt_obj.entries = []
+        self.fdt_obj.root = None
+        self.parser       = None
+        self.stack        = []
+        self.labels       = {}      # label     -> node
+        self.children     = {}      # id(node)  -> {name: node}, nodes with children only
+        self.props        = {}      # id(node)  -> (node, {name: property}), see finish()
+        self.events       = []      # phandle allocations: (label | node, cells, index)
+        self.placeholders = {}      # id(prop)  -> phandle props allocated by the parser
+        self.path_refs    = []      # (strings, index, '&ref')
+        self.decoded      = {}      # value     -> (class, data) of reference-free values
+
+    def _new_node(self, name, parent):
+        node = _new_item(items.Node, name, parent, _props=[], _nodes=[])
+        self.props[id(node)] = (node, {})
+        if parent is not None:
+            parent._nodes.append(node)
+            self.children.setdefault(id(parent), {})[name] = node
+        return node
+
+    def _open(self, node, labels):
+        for label in labels:
+            if node._label is None:
+                node._label = label
+            self.labels[label] = node
+        self.stack.append(node)
+
+    def _subnode(self, node, name):
+        children = self.children.get(id(node))
+        return children.get(name) if children else None
+
+    def _resolve(self, ref):
+        """ Node referenced by '&label' or '&{/path}'; None if missing """
+        if not ref.startswith('&{'):
+            return self.labels.get(ref[1:])
+        node = self.fdt_obj.root
+        for name in ref[2:-1].strip('/').split('/'):
+            if node is None or not name:
+                break
+            node = self._subnode(node, name)
+        return node
+
+    def _add_prop(self, node, cls, name, **state):
+        """ Adds a property to a node, replacing a previous definition """
+        prop = cls.__new__(cls)
+        prop.__dict__.update(_name=name, _label=None, _parent=node, **state)
+        self.props[id(node)][1][name] = prop
+        return prop
+
+    def _remove_prop(self, node, name):
+        self.props[id(node)][1].pop(name, None)
+
+    def memreserve(self, address, size):
+        self.fdt_obj.entries.append({'address': address, 'size': size})
+
+    def open_root(self, labels):
+        if self.fdt_obj.root is None:
+            self.fdt_obj.root = self._new_node('/', None)
+        self._open(self.fdt_obj.root, labels)
+
+    def open_ref(self, ref, labels):
+        node = self._resolve(ref)
+        if node is None:
+            raise Exception("Reference to non-existent node or label {}".format(ref))
+        self._open(node, labels)
+
+    def open_node(self, name, labels):
+        parent = self.stack[-1]
+        node   = self._subnode(parent, name)
+        if node is None:
+            node = self._new_node(name, parent)
+        self._open(node, labels)
+
+    def close_node(self):
+        node = self.stack.pop()
+        if node.label is not None and 'phandle' not in self.props[id(node)][1]:
+            prop = self._add_prop(node, items.PropWords, 'phandle', data=[0], word_size=32)
+            self.placeholders[id(prop)] = prop
+            self.events.append((node, prop.data, 0))
+
+    def delete_node(self, name=None, ref=None):
+        if ref is not None:
+            node = self._resolve(ref)
+            if node is None:
+                raise Exception("Reference to non-existent node or label {}".format(ref))
+        else:
+            node = self._subnode(self.stack[-1], name)
+        if node is not None and node.parent is not None:
+            del self.children[id(node.parent)][node.name]
+            node.parent.nodes[:] = [ it for it in node.parent.nodes if it is not node ]
+
+    def delete_property(self, name):
+        self._remove_prop(self.stack[-1], name)
+        self._remove_prop(self.stack[-1], name + '_with_references')
+
+    def property(self, name, value, offset):
+        node = self.stack[-1]
+
+        # a redefinition drops the phantom property of the previous value
+        phantom_name = name + '_with_references'
+        if phantom_name in self.props[id(node)][1]:
+            self._remove_prop(node, phantom_name)
+
+        if value is None:
+            self._add_prop(node, items.Property, name)
+            return
+
+        # values repeat a lot (status, compatible, ...): the reference-free
+        # ones are decoded once, every property gets its own copy of the data
+        known = self.decoded.get(value)
+        if known is not None:
+            if known[0] is items.PropWords:
+                self._add_prop(node, items.PropWords, name, data=list(known[1]), word_size=32)
+            else:
+                self._add_prop(node, known[0], name, data=list(known[1]))
+            return
+
+        comps = self.parser.parse_value(value, offset)
+
+        if len(comps) == 1 and comps[0][0] == 'cells' and comps[0][1] == 32:
+            data = comps[0][2]
+        elif comps and all(it[0] == 'cells' and it[1] == 32 for it in comps):
+            data = [ it for comp in comps for it in comp[2] ]
+        else:
+            data = None
+
+        if data is not None:
+            if '&' in value:
+                refs = [ i for i, it in enumerate(data) if type(it) is str ]
+                for i in refs:
+                    self.events.append((data[i][1:], data, i))
+                # keep the orginal references for phandles as a phantom property
+                if refs:
+                    self._add_prop(node, items.PropStrings, phantom_name,
+                                   data=[_normalize(value)])
+            else:
+                self.decoded[value] = (items.PropWords, tuple(data))
+            self._add_prop(node, items.PropWords, name, data=data, word_size=32)
+            return
+
+        kinds = set(it[0] for it in comps)
+        if kinds <= {'string', 'path'}:
+            data = []
+            for comp in comps:
+                if comp[0] == 'path':
+                    self.path_refs.append((data, len(data), comp[1]))
+                    data.append(comp[1])
+                elif comp[1]:
+                    data.append(comp[1])
+            if 'path' not in kinds:
+                self.decoded[value] = (items.PropStrings, tuple(data))
+            self._add_prop(node, items.PropStrings, name, data=data)
+        elif len(comps) == 1 and kinds == {'bytes'}:
+            self._add_prop(node, items.PropBytes, name, data=bytearray(comps[0][1]))
+        elif len(comps) == 1 and kinds == {'incbin'}:
+            self._add_prop(node, items.PropIncBin, name, data=bytearray(comps[0][1]),
+                           file_name=comps[0][2], relative_path=None)
+        else:
+            # mixed value, stored as raw big-endian bytes
+            data = bytearray()
+            for comp in comps:
+                if comp[0] == 'cells':
+                    if any(isinstance(it, str) for it in comp[2]):
+                        raise Exception("{}: phandle references in mixed values are "
+                                        "not supported".format(name))
+                    for it in comp[2]:
+                        data += it.to_bytes(comp[1] // 8, 'big')
+                elif comp[0] == 'string':
+                    data += comp[1].encode() + b'\0'
+                elif comp[0] == 'path':
+                    raise Exception("{}: path references in mixed values are "
+                                    "not supported".format(name))
+                else:
+                    data += comp[1]
+            self._add_prop(node, items.PropBytes, name, data=data)
+
+    def finish(self):
+        """ Allocates phandles & resolves references
+
+        Handles are allocated in the order of first reference / labeled node
+        close, as done by the original parser. Labeled nodes with an explicit
+        phandle keep it, allocated handles skip explicitly used values.
+        """
+        # a redefined property keeps the position of its first definition
+        for node, props in self.props.values():
+            node._props = list(props.values())
+
+        fdt_obj  = self.fdt_obj
+        explicit = {}
+        for label, node in self.labels.items():
+            prop = self.props[id(node)][1].get('phandle')
+            if prop is not None and id(prop) not in self.placeholders and \
+               isinstance(prop, items.PropWords) and prop.data:
+                explicit[id(node)] = prop.data[0]
+
+        used    = set(explicit.values())
+        handles = {}
+        last    = 0
+        for it, data, index in self.events:
+            if isinstance(it, str):
+                label, node = it, self.labels.get(it)
+            else:
+                label, node = it.label, it
+            key = id(node) if node is not None else label
+
+            handle = handles.get(key)
+            if handle is None:
+                handle = explicit.get(key)
+                if handle is None:
+                    last += 1
+                    while last in used:
+                        last += 1
+                    handle = last
+                handles[key] = handle
+            data[index] = handle
+
+            fdt_obj.label_to_handle.setdefault(label, handle)
+            fdt_obj.handle_to_label.setdefault(handle, label)
+
+        fdt_obj.last_handle = max([last] + list(used))
+
+        for data, index, ref in self.path_refs:
+            node = self._resolve(ref)
+            if node is None:
+                raise Exception("Reference to non-existent node or label {}".format(ref))
+            data[index] = _node_path(node)
+
+        return fdt_obj
+
+
+class _QueryCollector:
+    """ Parser handler collecting the properties of selected nodes """
+
+    def __init__(self, node_filter):
+        self.node_filter = node_filter
+        self.parser      = None
+        self.stack       = []
+        self.labels      = {}   # label -> path
+        self.nodes       = {}   # path  -> {name: value}
+
+    def _open(self, path, labels):
+        for label in labels:
+            self.labels[label] = path
+        if path not in self.nodes and self.node_filter(path):
+            self.nodes[path] = {}
+        self.stack.append(path)
+
+    def memreserve(self, address, size):
+        pass
+
+    def open_root(self, labels):
+        self._open('/', labels)
+
+    def _resolve(self, ref):
+        """ Path referenced by '&label' or '&{/path}' """
+        path = ref[2:-1] if ref.startswith('&{') else self.labels.get(ref[1:])
+        if path is None:
+            raise Exception("Reference to non-existent node or label {}".format(ref))
+        return path
+
+    def open_ref(self, ref, labels):
+        self._open(self._resolve(ref), labels)
+
+    def open_node(self, name, labels):
+        parent = self.stack[-1]
+        self._open(parent + '/' + name if parent != '/' else '/' + name, labels)
+
+    def close_node(self):
+        self.stack.pop()
+
+    def delete_node(self, name=None, ref=None):
+        if ref is not None:
+            path = self._resolve(ref)
+        else:
+            path = self.stack[-1].rstrip('/') + '/' + name
+        for it in [ it for it in self.nodes if it == path or it.startswith(path + '/') ]:
+            del self.nodes[it]
+
+    def delete_property(self, name):
+        self.nodes.get(self.stack[-1], {}).pop(name, None)
+
+    def property(self, name, value, offset):
+        props = self.nodes.get(self.stack[-1])
+        if props is None:
+            return
+        if value is None:
+            props[name] = None
+            return
+
+        comps = self.parser.parse_value(value, offset)
+        kinds = set(it[0] for it in comps)
+        if kinds == {'cells'}:
+            props[name] = [ it for comp in comps for it in comp[2] ]
+        elif kinds <= {'string', 'path'}:
+            props[name] = [ comp[1] for comp in comps ]
+        elif len(comps) == 1:
+            props[name] = comps[0][1]
+        else:
+            props[name] = comps
+
+    def finish(self):
+        return self.nodes
+
 
 class FDT_HOTFIX(FDT):
     def parse_dts(text: str, root_dir: str = '') -> FDT:
         """
         Parse DTS text file and create FDT Object
 
-        :param text:
-        :param root_dir: 
+        :param text: DTS source (without C preprocessor macros)
+        :param root_dir: Base directory of /include/ and /incbin/ files,
+                         searched before the current working directory
         """
+        return FDT_HOTFIX._parse(text, root_dir)[0]
+
+    def _parse(text: str, root_dir: str = ''):
+        """ Parses DTS text, returns the FDT object & the files it depends on """
+        builder = _TreeBuilder()
+        parser  = _DtsParser(text, root_dir, builder)
+        builder.parser = parser
+
         ver = misc.get_version_info(text)
-        text = misc.strip_comments(text)
-        dts_lines = misc.split_to_lines(text)
-        fdt_obj = FDT()
+        fdt_obj = builder.fdt_obj
         if 'version' in ver:
             fdt_obj.header.version = ver['version']
         if 'last_comp_version' in ver:
             fdt_obj.header.last_comp_version = ver['last_comp_version']
         if 'boot_cpuid_phys' in ver:
             fdt_obj.header.boot_cpuid_phys = ver['boot_cpuid_phys']
-        # parse entries
-        fdt_obj.entries = []
-        for line in dts_lines:
-            if line.endswith('{'):
-                break
-            if line.startswith('/memreserve/'):
-                line = line.strip(';')
-                line = line.split()
-                if len(line) != 3 :
-                    raise Exception()
-                fdt_obj.entries.append({'address': int(line[1], 0), 'size': int(line[2], 0)})
-        # parse nodes
-        curnode = None
-        fdt_obj.root = None
-        node_needs_fix = False
-
-        for line in dts_lines:
-            if line.endswith('{'):
-                # start node
-                if ':' in line:  #indicates the present of a label
-                    label, rest = line.split(':')
-                    node_name = rest.split()[0]
-                    new_node = items.Node(node_name)
-                    new_node.set_label(label)
-                else:
-                    node_name = line.split()[0]
-                    new_node = items.Node(node_name)
-                if fdt_obj.root is None:
-                    fdt_obj.root = new_node
-                if curnode is not None:
-                    curnode.append(new_node)
-                else:
-                    node_needs_fix = True
-                curnode = new_node
-
-            elif line.endswith('}'):
-                if curnode is not None:
-                    # HOTFIX for empty nodes
-                    if node_needs_fix:
-                        node_needs_fix = False
-
-                        line_name = line.split('{')[0].strip()
-
-                        # add empty node
-                        if len(line_name) > 1:
-                            curnode.append(items.Node(line_name))    
-                            continue
-
-                    if curnode.get_property('phandle') is None:
-                        if hasattr(curnode, 'label') and curnode.label is not None:
-                            handle = fdt_obj.add_label(curnode.label)
-                            curnode.set_property('phandle', handle)
-                    curnode = curnode.parent
-            else:
-                # properties
-                if line.find('=') == -1:
-                    prop_name = line
-                    prop_obj = items.Property(prop_name)
-                else:
-                    line = line.split('=', maxsplit=1)
-                    prop_name = line[0].rstrip(' ')
-                    prop_value = line[1].lstrip(' ')
-                    if prop_value.startswith('<'):
-                        prop_obj = items.PropWords(prop_name)
-                        prop_value = prop_value.replace('<', '').replace('>', '')
-                        # ['interrupts ' = ' <0 5 4>, <0 6 4>']
-                        # just change ',' to ' ' -- to concatenate the values into single array
-                        if ',' in prop_value:
-                            prop_value = prop_value.replace(',', ' ')
-                        
-                        # keep the orginal references for phandles as a phantom
-                        # property
-                        if "&" in prop_value:
-                            phantom_obj = items.PropStrings(prop_name+'_with_references')
-                            phantom_obj.append(line[1].lstrip(' '))
-                            if curnode is not None:
-                                curnode.append(phantom_obj)
-                        for prop in prop_value.split():
-                            if prop.startswith('0x'):
-                                prop_obj.append(int(prop, 16))
-                            elif prop.startswith('0b'):
-                                prop_obj.append(int(prop, 2))
-                            elif prop.startswith('0'):
-                                prop_obj.append(int(prop, 8))
-                            elif prop.startswith('&'):
-                                prop_obj.append(fdt_obj.add_label(prop[1:]))
-                            else:
-                                prop_obj.append(int(prop))
-                    elif prop_value.startswith('['):
-                        prop_obj = items.PropBytes(prop_name)
-                        prop_value = prop_value.replace('[', '').replace(']', '')
-                        for prop in prop_value.split():
-                            prop_obj.append(int(prop, 16))
-                    elif prop_value.startswith('/incbin/'):
-                        prop_value = prop_value.replace('/incbin/("', '').replace('")', '')
-                        prop_value = prop_value.split(',')
-                        file_path  = os.path.join(root_dir, prop_value[0].strip())
-                        file_offset = int(prop_value.strip(), 0) if len(prop_value) > 1 else 0
-                        file_size = int(prop_value.strip(), 0) if len(prop_value) > 2 else 0
-                        if file_path is None or not os.path.exists(file_path):
-                            raise Exception("File path doesn't exist: {}".format(file_path))
-                        with open(file_path, "rb") as f:
-                            f.seek(file_offset)
-                            prop_data = f.read(file_size) if file_size > 0 else f.read()
-                        prop_obj = items.PropIncBin(prop_name, prop_data, os.path.split(file_path)[1])
-                    elif prop_value.startswith('/plugin/'):
-                        raise NotImplementedError("Not implemented property value: /plugin/")
-                    elif prop_value.startswith('/bits/'):
-                        raise NotImplementedError("Not implemented property value: /bits/")
-                    else:
-                        prop_obj = items.PropStrings(prop_name)
-                        for prop in prop_value.split('",'):
-                            prop = prop.replace('"', "")
-                            prop = prop.strip()
-                            if len(prop) > 0:
-                                prop_obj.append(prop)
-                if curnode is not None:
-                    curnode.append(prop_obj)
 
-        return fdt_obj
+        with _gc_paused():
+            parser.parse()
+            return builder.finish(), parser.deps
+
+    def parse_dts_cached(text: str, root_dir: str = '') -> FDT:
+        """
+        Parse DTS text, reusing previously parsed trees
+
+        Trees are cached in memory and, if `set_cache_dir()` was called, on
+        disk. The key is the SHA-256 of the text, the root and working
+        directories, the parser version and the versions of Python, pyfdt and of this module;
+        trees including other files are revalidated against the digests of
+        these files. Unreadable cache files are parsed again. Every call
+        returns an independent copy.
+
+        :param text: DTS source (without C preprocessor macros)
+        :param root_dir: Base directory of /include/ and /incbin/ files,
+                         searched before the current working directory
+        """
+        h = hashlib.sha256()
+        for it in (str(PARSER_VERSION), fdt.__version__, sys.version, _MODULE_DIGEST,
+                   os.path.abspath(root_dir), os.getcwd(), text):
+            h.update(it.encode())
+            h.update(b'\0')
+        key = h.hexdigest()
+
+        path = os.path.join(CACHE_DIR, key + '.pickle') if CACHE_DIR else None
+        blob = _cache.get(key)
+        if blob is None and path is not None:
+            try:
+                with open(path, 'rb') as f:
+                    blob = f.read()
+            except OSError:
+                blob = None
+
+        if blob is not None:
+            # any error (truncated or foreign file, ...) means a cache miss
+            try:
+                deps, fdt_obj = pickle.loads(blob)
+                valid = isinstance(fdt_obj, FDT) and \
+                        all(_file_digest(it) == digest for it, digest in deps)
+            except Exception:
+                valid = False
+            if valid:
+                _cache[key] = blob
+                return fdt_obj
+
+        fdt_obj, deps = FDT_HOTFIX._parse(text, root_dir)
+        blob = pickle.dumps(([ (it, _file_digest(it)) for it in deps ], fdt_obj),
+                            pickle.HIGHEST_PROTOCOL)
+        _cache[key] = blob
+
+        if path is not None:
+            fd, tmp = tempfile.mkstemp(dir=CACHE_DIR)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(blob)
+            os.replace(tmp, path)
+
+        return pickle.loads(blob)[1]
+
+    def get_dependencies(text: str, root_dir: str = '') -> list:
+        """
+        Files a DTS source depends on, found without parsing its tree
+
+        :param text: DTS source (without C preprocessor macros)
+        :param root_dir: Base directory of /include/ and /incbin/ files,
+                         searched before the current working directory
+        :return: Absolute paths of the /include/ and /incbin/ files, as well
+                 as of the lookup candidates that do not exist (their creation
+                 changes the tree too)
+        """
+        parser = _DtsParser('', root_dir, None)
+        try:
+            text = parser._include(text, 0) if '/include/' in text else text
+            for m in _regex_incbin.finditer(text):
+                parser._resolve(_unescape(m.group(1)))
+        except Exception:
+            # reported once the tree is parsed
+            pass
+        return parser.deps
+
+    def query_dts(text: str, node_filter, root_dir: str = '') -> dict:
+        """
+        Collect properties of selected nodes without building an FDT object
+
+        :param text: DTS source (without C preprocessor macros)
+        :param node_filter: Callable selecting nodes by absolute path
+        :param root_dir: Base directory of /include/ and /incbin/ files,
+                         searched before the current working directory
+        :return: {path: {property name: value}} of the selected nodes, in
+                 order of definition. Values are lists of cells (references
+                 are kept as '&label' strings) or strings, bytes, or None for
+                 properties without value.
+        """
+        collector = _QueryCollector(node_filter)
+        parser = _DtsParser(text, root_dir, collector)
+        collector.parser = parser
+        parser.parse()
+        return collector.finish()
@@ -18,41 +18,281 @@ from fdt_hotfix import FDT_HOTFIX
 import fdt
 import argparse
 import code
+import copy
+import os
+import re
+import subprocess
+import tempfile
+import time
+
+# DTB header values emitted by `dtc` for trees parsed from DTS
+DTB_VERSION           = 17
+DTB_BOOT_CPUID_PHYS   = 0
 
 
 ################################################################################
 ########################## INTERNAL UTILITY FUNCTIONS ##########################
 ################################################################################
 
-def _is_in_whitelist(node_name, whitelist):
-    """ Checks if node is part of a whitelisted device (or ancestors)
+def _whitelist_paths(whitelist):
+    """ Computes the paths of every whitelisted node and of its ancestors
 
     Parameters
     ----------
-    node_name : [str] Absolute node path
-    whitelist : [list(str)] Device whitelist (also absolute paths)
+    whitelist : [list(str)] Device whitelist (absolute paths)
 
     Return
     ------
-    True if device is part of the list; False otherwise
+    Set of strings; a node is part of a whitelisted device (or one of its
+    ancestors) iff its absolute path is in this set
+
+    Details
+    -------
+    Replaces a linear scan of the whitelist per node with a single set lookup.
+    Paths are matched on whole components: whitelisting "/cpus/cpu@10000"
+    does not include "/cpus/cpu@100".
     """
-    return True in [ it.startswith(node_name) for it in whitelist ]
+    paths = set()
+    for it in whitelist:
+        names = [ name for name in it.split('/') if name ]
+        paths.update('/' + '/'.join(names[:idx]) for idx in range(len(names) + 1))
+    return paths
 
 
-def _has_ancestor(node_name, prunelist):
-    """ Checks if node is descendant of another in prunelist
+def _node_path(parent_path, node):
+    """ Absolute path of `node`, given its parent's absolute path """
+    return parent_path + node.name if parent_path == '/' \
+           else parent_path + '/' + node.name
 
-    Parameters
-    ----------
-    node_name : [str] Absolute node path
-    prunelist : [list(str)] Device prunelist (also absolute paths)
 
-    Return
-    ------
-    True if device has ancestor present; False otherwise
+# phandle references in the original property text: "&label" or "&{/path}"
+_regex_reference = re.compile(r'&(\{[^}]*\}|[A-Za-z_][\w,.+-]*)')
+
+################################################################################
+################################## FDT INDEX ###################################
+################################################################################
+
+class FdtIndex:
+    """ Path & alias index over an FDT, used for batch node pruning
+
+    Details
+    -------
+    The index is built in a single walk of the tree and maps every absolute
+    node path to its node object, every alias target to the names of the
+    aliases pointing at it, and every node label to the labeled node.
+
+    Nodes parsed from DTS retain the original text of properties with phandle
+    references in phantom "*_with_references" properties. These are used to
+    find nodes that reference a pruned device (see `prune()`). Trees parsed
+    from DTB lack this information.
     """
-    return True in [ node_name.startswith(it) and node_name != it \
-                     for it in prunelist ]
+
+    def __init__(self, fdt_data):
+        """
+        Parameters
+        ----------
+        fdt_data : [fdt.FDT] Indexed device tree
+        """
+        self.fdt_data = fdt_data
+        self.nodes    = {}      # path   -> node
+        self.parents  = {}      # path   -> parent path
+        self.labels   = {}      # label  -> path
+        self.aliases  = {}      # target -> [alias names]
+        self.refs     = {}      # path   -> [referenced labels / paths]
+
+        stack = [ ('/', None, fdt_data.root) ]
+        while stack:
+            path, parent_path, node = stack.pop()
+
+            self.nodes[path]   = node
+            self.parents[path] = parent_path
+            if node.label is not None:
+                self.labels[node.label] = path
+
+            refs = [ ref for prop in node.props
+                         if prop.name.endswith('_with_references')
+                         for text in prop.data
+                         for ref in _regex_reference.findall(text) ]
+            if refs:
+                self.refs[path] = [ it[1:-1] if it.startswith('{') else it
+                                    for it in refs ]
+
+            stack.extend((_node_path(path, it), path, it)
+                         for it in reversed(node.nodes))
+
+        aliases = self.nodes.get('/aliases')
+        if aliases is not None:
+            for prop in aliases.props:
+                if isinstance(prop, fdt.PropStrings) and len(prop.data) > 0:
+                    self.aliases.setdefault(prop.data[0], []).append(prop.name)
+
+    def subtree(self, path):
+        """ Lists the absolute paths of a node and all of its descendants
+
+        Parameters
+        ----------
+        path : [str] Absolute node path
+
+        Returns
+        -------
+        List of absolute node path strings (pre-order)
+        """
+        paths = []
+        stack = [ (path, self.nodes[path]) ]
+        while stack:
+            path, node = stack.pop()
+            paths.append(path)
+            stack.extend((_node_path(path, it), it) for it in reversed(node.nodes))
+        return paths
+
+    def blacklist_from_whitelist(self, whitelist):
+        """ Computes the minimal blacklist implied by a whitelist
+
+        Parameters
+        ----------
+        whitelist : [list(str)] List of absolute node paths; every node on each
+                    path is included
+
+        Returns
+        -------
+        List of absolute paths of the topmost nodes that are not whitelisted;
+        descendants of these are implicitly excluded
+        """
+        included  = _whitelist_paths(whitelist)
+        blacklist = []
+
+        stack = [ '/' ]
+        while stack:
+            path = stack.pop()
+            if path not in included:
+                blacklist.append(path)
+                continue
+            stack.extend(_node_path(path, it)
+                         for it in reversed(self.nodes[path].nodes))
+
+        return blacklist
+
+    def dependents(self, pruned, protected=()):
+        """ Finds nodes referencing (via phandle) any node in `pruned`
+
+        Parameters
+        ----------
+        pruned    : [set(str)] Absolute paths of pruned nodes (incl. children)
+        protected : [iterable(str)] Paths that must never be pruned
+
+        Returns
+        -------
+        List of absolute paths of dependent nodes, in discovery order. The
+        search is transitive: nodes referencing a dependent node are included.
+        """
+        protected = set(protected) | { '/' }
+
+        # reverse dependency map: referenced path -> referencing paths
+        users = {}
+        for path, refs in self.refs.items():
+            for ref in refs:
+                target = ref if ref.startswith('/') else self.labels.get(ref)
+                if target is not None:
+                    users.setdefault(target, []).append(path)
+
+        pruned  = set(pruned)
+        found   = []
+        pending = list(pruned)
+        while pending:
+            for user in users.get(pending.pop(), []):
+                # references from within the pruned subtrees are irrelevant
+                if user in pruned:
+                    continue
+
+                if user in protected:
+                    print('WAR: "%s" references a pruned node' % user)
+                    continue
+
+                found.append(user)
+                subtree = self.subtree(user)
+                pruned.update(subtree)
+                pending.extend(subtree)
+
+        return found
+
+    def prune(self, paths, prune_dependents=False, protected=()):
+        """ Removes nodes (and their aliases) from the FDT in one batch
+
+        Parameters
+        ----------
+        paths            : [list(str)] Absolute node paths; children are
+                           deleted as well
+        prune_dependents : [bool] Also remove nodes that reference a pruned
+                           node via phandle (default: False)
+        protected        : [iterable(str)] Paths never removed as dependents
+
+        Returns
+        -------
+        List of absolute paths of the removed (topmost) nodes
+        """
+        # nodes are processed in order, as if removed one by one: a node whose
+        # ancestor was removed before it can no longer be found
+        targets = []
+        pruned  = set()
+        for path in paths:
+            if path == '/':
+                continue
+            elif not path.startswith('/'):
+                print('ERR: invalid node path "%s"' % path)
+            elif path not in self.nodes or path in pruned or \
+                 any(it in pruned for it in self._ancestors(path)):
+                print('WAR: unable to get node "%s"' % path)
+            else:
+                targets.append(path)
+                pruned.add(path)
+
+        if prune_dependents:
+            subtrees = { it for path in targets for it in self.subtree(path) }
+            targets += [ it for it in self.dependents(subtrees, protected)
+                         if not any(anc in pruned for anc in self._ancestors(it)) ]
+
+        # delete aliases of removed nodes
+        aliases = self.nodes.get('/aliases')
+        for path in targets:
+            names = self.aliases.pop(path, [])
+
+            # potentially corrupted FDT; should have one alias per device
+            if len(names) > 1:
+                print('WAR: multiple aliases for "%s" node' % path)
+
+            for name in names:
+                aliases.remove_property(name)
+
+        # drop nodes nested in other removed nodes (e.g.: in dependents)
+        pruned  = set(targets)
+        targets = [ it for it in targets
+                    if not any(anc in pruned for anc in self._ancestors(it)) ]
+
+        # detach nodes; one pass over every affected parent's child list
+        removed = {}
+        for path in targets:
+            removed.setdefault(self.parents[path], set()).add(id(self.nodes[path]))
+        for parent_path, ids in removed.items():
+            children = self.nodes[parent_path].nodes
+            children[:] = [ it for it in children if id(it) not in ids ]
+
+        # forget removed nodes
+        for path in targets:
+            for it in self.subtree(path):
+                node = self.nodes.pop(it)
+                self.parents.pop(it)
+                self.refs.pop(it, None)
+                if node.label is not None:
+                    self.labels.pop(node.label, None)
+
+        return targets
+
+    def _ancestors(self, path):
+        """ Yields the absolute paths of all ancestors of a node """
+        path = self.parents.get(path)
+        while path is not None:
+            yield path
+            path = self.parents.get(path)
 
 ################################################################################
 ########################### FDT {WHITE,BLACK}LISTING ###########################
@@ -82,84 +322,59 @@ def get_nodelist(fdt_data, minimal=False):
                    if not minimal or len(it[1]) == 0 ]
 
 
-def prune_node(node_path, fdt_data):
+def prune_node(node_path, fdt_data, prune_dependents=False):
     """ Removes node from FDT
 
     Parameters
     ----------
-    node_path: [str] Node's absolute path in FDT
-    fdt_data  : [fdt.FDT] Target device tree
+    node_path        : [str] Node's absolute path in FDT
+    fdt_data         : [fdt.FDT] Target device tree
+    prune_dependents : [bool] Also remove nodes referencing the pruned node
+                       via phandle (default: False)
 
     Details
     -------
     Aside from removing node in question, this function also affects any
-    related nodes, such as "/aliases".
+    related nodes, such as "/aliases". Phandle dependencies can only be tracked
+    for FDTs parsed from DTS (see `FdtIndex`).
     """
-
-    # attempt to get node using provided FDT path
-    try:
-        node = fdt_data.get_node(node_path)
-    except:
-        print('WAR: unable to get node "%s"' % node_path)
-        return
-
-    # check if node alias needs deleting
-    try:
-        aliases   = fdt_data.get_node('/aliases')
-        to_delete = [ it for it in aliases.props if it.data[0] == node_path]
-
-        # potentially corrupted FDT; should have one alias per device
-        if len(to_delete) > 1:
-            print('WAR: multiple aliases for "%s" node' % node_path)
-
-        for it in to_delete:
-            aliases.remove_property(it.name)
-    except:
-        pass
-
-    # TODO: add phandle check based on optional marker information
-
-    # delete node
-    sep_idx   = node_path.rfind('/')
-
-    if sep_idx != -1:
-        fdt_data.remove_node(node_path[sep_idx + 1 :], node_path[:sep_idx])
-    else:
-        print('ERR: invalid node path "%s"' % node_path)
+    apply_blacklist(fdt_data, [ node_path ], prune_dependents)
 
 
-def apply_blacklist(fdt_data, blacklist):
+def apply_blacklist(fdt_data, blacklist, prune_dependents=False):
     """ Removes nodes that are part of the blacklist
 
     Parameters
     ----------
-    fdt_data  : [fdt.FDT] Target device tree
-    blacklist : [list(str)] List of absolute node paths; children are deleted
-                as well
+    fdt_data         : [fdt.FDT] Target device tree
+    blacklist        : [list(str)] List of absolute node paths; children are
+                       deleted as well
+    prune_dependents : [bool] Also remove nodes referencing a pruned node via
+                       phandle (default: False)
     """
-
-    for it in blacklist:
-        prune_node(it, fdt_data)
+    FdtIndex(fdt_data).prune(blacklist, prune_dependents)
 
 
-def apply_whitelist(fdt_data, whitelist):
+def apply_whitelist(fdt_data, whitelist, prune_dependents=False):
     """ Removes nodes that are not part of the whitelist
 
     Parameters
     ----------
-    fdt_data  : [fdt.FDT] Target device tree
-    whitelist : [list(str)] List of absolute node paths; every node on each
-                path is included
+    fdt_data         : [fdt.FDT] Target device tree
+    whitelist        : [list(str)] List of absolute node paths; every node on
+                       each path is included
+    prune_dependents : [bool] Also remove nodes referencing a pruned node via
+                       phandle; whitelisted nodes are never removed
+                       (default: False)
     """
 
-    # get a full node list from the FDT data before starting to cut things
-    nodelist = get_nodelist(fdt_data, False)
+    # index the FDT before starting to cut things; the blacklist is already
+    # minimal (i.e.: set of oldest common ancestors)
+    index     = FdtIndex(fdt_data)
+    blacklist = index.blacklist_from_whitelist(whitelist)
 
-    # calculate blacklist, then minimize it to set of oldest common ancestors
-    blacklist = [ it for it in nodelist if not _is_in_whitelist(it, whitelist) ]
-    blacklist = [ it for it in blacklist if not _has_ancestor(it, blacklist) ]
-
-    apply_blacklist(fdt_data, blacklist)
+    index.prune(blacklist, prune_dependents,
+                protected=_whitelist_paths(whitelist))
 
 ################################################################################
 ################################ FDT TOUCH-UPS #################################
@@ -381,6 +596,36 @@ def trim_excess_cpus(fdt_data, num_cpus):
 ############################## FDT I/O OPERATIONS ##############################
 ################################################################################
 
+def _parse_dtb(dtb_data):
+    """ Parses a DTB blob with a memory reservation list of its own
+
+    Parameters
+    ----------
+    dtb_data : [bytes] DTB blob
+
+    Returns
+    -------
+    fdt.FDT object
+
+    Details
+    -------
+    `fdt.parse_dtb()` appends the /memreserve/ entries to the mutable default
+    argument of `fdt.FDT.__init__()`, i.e. to a list shared by every FDT
+    created without `entries`. Each parse would then add to the entries of
+    all of them (e.g.: once per `--watch` rebuild). The new entries are moved
+    to a private list and the shared one is restored.
+    """
+    shared = fdt.FDT().entries
+    count = len(shared)
+
+    fdt_data = fdt.parse_dtb(dtb_data)
+
+    if fdt_data.entries is shared:
+        fdt_data.entries = shared[count:]
+        del shared[count:]
+
+    return fdt_data
+
 def parse_fdt(fdt_name):
     """ Loads FDT object from file
 
@@ -400,10 +645,11 @@ def parse_fdt(fdt_name):
     """
     if fdt_name.endswith('.dtb'):
         with open(fdt_name, 'rb') as f:
-            fdt_data = fdt.parse_dtb(f.read())
+            fdt_data = _parse_dtb(f.read())
     elif fdt_name.endswith('.dts'):
         with open(fdt_name, 'rt') as f:
-            fdt_data = FDT_HOTFIX.parse_dts(f.read())
+            fdt_data = FDT_HOTFIX.parse_dts_cached(f.read(),
+                                                   os.path.dirname(fdt_name))
     else:
         print('ERR: unknown FDT file extension for "%s"' % fdt_name)
         fdt_data = None
@@ -431,7 +677,7 @@ def store_fdt(fdt_name, fdt_data):
         print(fdt_data.to_dts())
     elif fdt_name.endswith('.dtb'):
         with open(fdt_name, 'wb') as f:
-            f.write(fdt_data.to_dtb())
+            f.write(to_dtb(fdt_data))
     elif fdt_name.endswith('.dts'):
         with open(fdt_name, 'wt') as f:
             f.write(fdt_data.to_dts())
@@ -441,6 +687,223 @@ def store_fdt(fdt_name, fdt_data):
 
     return True
 
+def to_dtb(fdt_data):
+    """ Serializes FDT object to DTB without invoking `dtc`
+
+    Parameters
+    ----------
+    fdt_data : [fdt.FDT] Target device tree
+
+    Returns
+    -------
+    DTB blob as bytes
+
+    Details
+    -------
+    Trees parsed from DTS carry no header version. In that case, the same
+    values that `dtc` would emit (version 17, last compatible version 16) are
+    used. Phantom "*_with_references" properties are never emitted.
+
+    `fdt.FDT.to_dtb()` stores the blob layout in the header; it is applied to
+    a copy of the header, so `fdt_data` is left unchanged.
+    """
+    out_data = fdt.FDT(copy.copy(fdt_data.header), fdt_data.entries)
+    out_data.root = fdt_data.root
+
+    if out_data.header.version is None:
+        out_data.header.version         = DTB_VERSION
+        out_data.header.boot_cpuid_phys = DTB_BOOT_CPUID_PHYS
+
+    return out_data.to_dtb()
+
+
+def check_dtb(fdt_data, dtb_data):
+    """ Cross-checks a natively emitted DTB against `dtc` output
+
+    Parameters
+    ----------
+    fdt_data : [fdt.FDT] Device tree that was serialized
+    dtb_data : [bytes] Natively emitted DTB
+
+    Returns
+    -------
+    True if `dtc` produces an equivalent tree; False otherwise
+
+    Details
+    -------
+    The tree is written to a temporary DTS and compiled with `dtc`. Both blobs
+    are parsed back and compared structurally, since `dtc` may lay out the
+    strings block differently.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dts_name = os.path.join(tmp_dir, 'check.dts')
+        dtb_name = os.path.join(tmp_dir, 'check.dtb')
+
+        with open(dts_name, 'wt') as f:
+            f.write(fdt_data.to_dts())
+
+        subprocess.run(['dtc', '-I', 'dts', '-O', 'dtb', '-o', dtb_name,
+                        dts_name], check=True)
+
+        with open(dtb_name, 'rb') as f:
+            ref_data = _parse_dtb(f.read())
+
+    new_data = _parse_dtb(dtb_data)
+
+    return new_data.root == ref_data.root and \
+           new_data.entries == ref_data.entries
+
+################################################################################
+############################## FDT PATCH PIPELINE ##############################
+################################################################################
+
+class FdtPipeline:
+    """ Parses an FDT once, patches it in memory and emits the DTB once
+
+    Usage
+    -----
+        pipeline = FdtPipeline('vm.dts')
+        pipeline.substitute('<initrd-start>', '<0x85000000>')
+        pipeline.add_pass('set_memory', set_memory, mem_sz, kernel_addr)
+        pipeline.add_pass('apply_whitelist', apply_whitelist, whitelist)
+
+        if pipeline.run():
+            pipeline.store('vm.dtb')
+
+    Details
+    -------
+    Each pass is a callable that receives the in-memory `fdt.FDT` object as its
+    first argument, followed by the arguments given to `add_pass()`. Passes are
+    applied in the order in which they were added. A pass returning `False` is
+    considered to have failed; any other return value (including `None`) counts
+    as success.
+
+    Text substitutions only apply to DTS inputs and are performed before
+    parsing. They are meant for placeholders that are not valid DTS (such as
+    "<initrd-start>").
+
+    Wall time of every step is recorded in `timings` as (name, seconds).
+    """
+
+    def __init__(self, fdt_name):
+        """
+        Parameters
+        ----------
+        fdt_name : [str] Input DTB or DTS file path
+        """
+        self.fdt_name      = fdt_name
+        self.substitutions = []
+        self.passes        = []
+        self.timings       = []
+        self.fdt_data      = None
+
+    def substitute(self, old, new):
+        """ Registers a text substitution performed before DTS parsing
+
+        Parameters
+        ----------
+        old : [str] Text to replace
+        new : [str] Replacement text
+
+        Returns
+        -------
+        The pipeline itself (for chaining)
+        """
+        self.substitutions.append((old, new))
+        return self
+
+    def add_pass(self, name, func, *args, **kwargs):
+        """ Appends a patch pass
+
+        Parameters
+        ----------
+        name   : [str] Pass name (used in timings & error messages)
+        func   : [callable] Patch function; `func(fdt_data, *args, **kwargs)`
+        args   : Positional arguments of the patch function
+        kwargs : Keyword arguments of the patch function
+
+        Returns
+        -------
+        The pipeline itself (for chaining)
+        """
+        self.passes.append((name, func, args, kwargs))
+        return self
+
+    def _timed(self, name, func, *args, **kwargs):
+        """ Invokes `func` and records its wall time under `name` """
+        start = time.perf_counter()
+        ans   = func(*args, **kwargs)
+        self.timings.append((name, time.perf_counter() - start))
+        return ans
+
+    def load(self):
+        """ Parses the input file (applying text substitutions for DTS)
+
+        Returns
+        -------
+        True if everything went well; False otherwise
+        """
+        if self.fdt_name.endswith('.dts') and self.substitutions:
+            def _parse():
+                with open(self.fdt_name, 'rt') as f:
+                    text = f.read()
+                for old, new in self.substitutions:
+                    text = text.replace(old, new)
+                return FDT_HOTFIX.parse_dts_cached(text,
+                                                   os.path.dirname(self.fdt_name))
+
+            self.fdt_data = self._timed('parse', _parse)
+        else:
+            self.fdt_data = self._timed('parse', parse_fdt, self.fdt_name)
+
+        return self.fdt_data is not None
+
+    def run(self):
+        """ Parses the input (if not already done) and applies all passes
+
+        Returns
+        -------
+        True if everything went well; False otherwise
+        """
+        if self.fdt_data is None and not self.load():
+            print('ERR: unable to parse "%s"' % self.fdt_name)
+            return False
+
+        for name, func, args, kwargs in self.passes:
+            ans = self._timed(name, func, self.fdt_data, *args, **kwargs)
+            if ans is False:
+                print('ERR: pass "%s" failed on "%s"' % (name, self.fdt_name))
+                return False
+
+        return True
+
+    def store(self, fdt_name, cross_check=False):
+        """ Emits the patched FDT
+
+        Parameters
+        ----------
+        fdt_name    : [str] Output file path; DTB is emitted natively
+        cross_check : [bool] Verify DTB output against `dtc` (default: False)
+
+        Returns
+        -------
+        True if everything went well; False otherwise
+        """
+        if not fdt_name.endswith('.dtb'):
+            return self._timed('store', store_fdt, fdt_name, self.fdt_data)
+
+        dtb_data = self._timed('store', to_dtb, self.fdt_data)
+        with open(fdt_name, 'wb') as f:
+            f.write(dtb_data)
+
+        if cross_check:
+            ans = self._timed('dtc_check', check_dtb, self.fdt_data, dtb_data)
+            if ans is False:
+                print('ERR: DTB of "%s" differs from dtc output' % self.fdt_name)
+                return False
+
+        return True
+
 ################################################################################
 ################################ CLI INTERFACE #################################
 ################################################################################
@@ -464,8 +927,7 @@ def CLI_delete_nodes(args):
     if fdt_data is None:
         exit(-1)
 
-    for node_name in args.prune_list:
-        prune_node(node_name, fdt_data)
+    apply_blacklist(fdt_data, args.prune_list, args.prune_dependents)
 
     ans = store_fdt(args.fdt_out, fdt_data)
     if ans is False:
@@ -512,6 +974,9 @@ def main():
     parser_2.add_argument('-d', action='append', metavar='<node_path>', type=str,
                           required=False, dest='prune_list', default=[],
                           help='path of deleted node')
+    parser_2.add_argument('-p', action='store_true',
+                          required=False, dest='prune_dependents',
+                          help='also delete nodes referencing deleted ones')
     parser_2.set_defaults(func=CLI_delete_nodes)
 
     # TODO: subcommand for setting "/chosen" node
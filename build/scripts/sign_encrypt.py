@@ -11,15 +11,22 @@ except ImportError:
     from Crypto.Hash import SHA256
     from Crypto.PublicKey import RSA
 import base64
+import hashlib
+import json
 import logging
+import mmap
 import os
+import shlex
 import struct
 import sys
-import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 algo = {'TEE_ALG_RSASSA_PKCS1_PSS_MGF1_SHA256': 0x70414930,
         'TEE_ALG_RSASSA_PKCS1_V1_5_SHA256': 0x70004830}
 
+HASH_CHUNK_SIZE = 1 << 20
+
 
 def uuid_parse(s):
     from uuid import UUID
@@ -42,6 +49,7 @@ def get_args(logger):
         '   command:\n' +
         '     sign    Generate signature of Peregrine manifest file.\n' +
         '                 Takes arguments --uuid, --key, --img_path, --img_version --out_file\n' +
+        '                 or --key, --batch to sign several images at once\n' +
         '   %(prog)s --help  show available commands and arguments\n\n',
         formatter_class=RawDescriptionHelpFormatter,
         epilog=textwrap.dedent('''\
@@ -61,6 +69,11 @@ def get_args(logger):
               openssl pkeyutl -sign -inkey <KEYFILE>.pem \\
                   -pkeyopt digest:sha256 -pkeyopt rsa_padding_mode:pkcs1 | \\
               base64 > <UUID>.sig
+
+            the --batch file lists one image per line (empty lines and lines
+            starting with '#' are ignored, paths containing spaces must be
+            quoted):
+              <UUID> <VERSION> <IMG_PATH> <OUT_FILE>
             '''))
 
     parser.add_argument('command', choices=command_base, nargs='?', default='sign',
@@ -68,16 +81,23 @@ def get_args(logger):
     # Don't use the UUID type
     #parser.add_argument('--uuid', required=True,
     #                    type=uuid_parse, help='String UUID of the TA')
-    parser.add_argument('--uuid', required=True, dest='uuid',
+    parser.add_argument('--uuid', required=False, dest='uuid',
                         help='String UUID of the manifest')   
-    parser.add_argument('--version', required=True, type=int_parse, dest='version',
+    parser.add_argument('--version', required=False, type=int_parse, dest='version',
                         help='Manifest version') 
     parser.add_argument('--key', required=True, dest='key',
                         help='Path to the signing key file (PEM format)')
-    parser.add_argument('--img_path', required=True, dest='img_path',
+    parser.add_argument('--img_path', required=False, dest='img_path',
                         help='Path to the manifest file')
-    parser.add_argument('--out', required=True, dest='out_file',
+    parser.add_argument('--out', required=False, dest='out_file',
                         help='Output signature file')
+    parser.add_argument('--batch', required=False, dest='batch',
+                        help='File listing the images to sign (see below)')
+    parser.add_argument('--jobs', required=False, type=int, dest='jobs',
+                        default=os.cpu_count() or 1,
+                        help='Number of images hashed in parallel (--batch)')
+    parser.add_argument('--digest_cache', required=False, dest='digest_cache',
+                        help='JSON file caching the digests of unchanged images')
     parser.add_argument('--algo', required=False, choices=list(algo.keys()),
                         default='TEE_ALG_RSASSA_PKCS1_PSS_MGF1_SHA256',
                         help='The hash and signature algorithm, ' +
@@ -87,6 +107,18 @@ def get_args(logger):
     parsed = parser.parse_args()
 
     # Check parameter combinations
+    if parsed.batch is not None:
+        if parsed.uuid or parsed.version is not None or parsed.img_path or parsed.out_file:
+            logger.error('--batch cannot be combined with --uuid, --version, --img_path or --out.')
+            sys.exit(1)
+        return parsed
+
+    for arg, name in [(parsed.uuid, '--uuid'), (parsed.version, '--version'),
+                      (parsed.img_path, '--img_path')]:
+        if arg is None:
+            logger.error('No ' + name + ' specified.')
+            sys.exit(1)
+
     if parsed.out_file is None:
         logger.error('No output file specified.')
         sys.exit(1)
@@ -104,60 +136,206 @@ def write_signature(sigf, signature):
         sigfile.write(signature)
 
 
-def get_digest(uuid, img_path, version):
+class DigestCache:
+    """ Image digests memoized by file identity, persisted as JSON """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if path is not None:
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    @staticmethod
+    def identity(st):
+        # values that change whenever the content of the file may have changed
+        return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+    def get(self, key, identity):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[0] == identity:
+            return bytes.fromhex(entry[1])
+        return None
+
+    def put(self, key, identity, digest):
+        with self.lock:
+            self.entries[key] = [identity, digest.hex()]
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, sort_keys=True)
+        os.replace(tmp, self.path)
 
+
+class _PrecomputedSHA256:
+    """ SHA-256 hash object for an already computed digest, as accepted by
+    the pss / pkcs1_15 signers """
+
+    oid = SHA256.SHA256Hash.oid
+    digest_size = SHA256.digest_size
+    block_size = SHA256.block_size
+
+    def __init__(self, digest):
+        self._digest = digest
+
+    def digest(self):
+        return self._digest
+
+    def hexdigest(self):
+        return self._digest.hex()
+
+    def new(self, data=None):
+        return SHA256.new(data)
+
+
+def hash_file(h, img_path):
+    # stream the image into the hash object, without reading it into memory
     with open(img_path, 'rb') as f:
-        img = f.read()
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+                return
+        except (ValueError, OSError):
+            # empty files and special files cannot be mapped
+            pass
+
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+
+
+def get_digest(uuid, img_path, version, digest_cache=None):
+
+    if digest_cache is not None:
+        key = '%s:%s:%d' % (os.path.abspath(img_path), uuid, version)
+        identity = DigestCache.identity(os.stat(img_path))
+        digest = digest_cache.get(key, identity)
+        if digest is not None:
+            return digest
 
     uuid_raw = uuid.encode('ASCII')
     version_pack = struct.pack('<I', version)
 
-    h = SHA256.new()
+    # hashlib releases the GIL while hashing, which lets batches run in threads
+    h = hashlib.sha256()
     h.update(uuid_raw)
     h.update(version_pack)
-    h.update(img)
+    hash_file(h, img_path)
+    digest = h.digest()
 
-    return h.digest()
+    if digest_cache is not None:
+        digest_cache.put(key, identity, digest)
 
- 
-def get_sign(key, digest):
-    arg_string = ['openssl', 'pkeyutl', '-sign', '-inkey', key, '-pkeyopt', 'digest:sha256', '-pkeyopt', 'rsa_padding_mode:pss', '-pkeyopt', 'rsa_pss_saltlen:digest', '-pkeyopt', 'rsa_mgf1_md:sha256']
-
-    try:
-        out = subprocess.Popen(arg_string, stdin=subprocess.PIPE, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-        signature = out.communicate(digest)[0] # (stdout, stderr)
-        return signature
-    except subprocess.CalledProcessError as e:
-        print("Error during signing: " + e.output)
+    return digest
+
+
+def load_key(key):
+    with open(key, 'rb') as f:
+        return RSA.import_key(f.read())
+
+
+def get_sign(key, digest, algorithm='TEE_ALG_RSASSA_PKCS1_PSS_MGF1_SHA256'):
+    # `key` is either an RSA key object or the path of a PEM key file
+    if isinstance(key, str):
+        key = load_key(key)
+
+    h = _PrecomputedSHA256(digest)
+    if algo[algorithm] == algo['TEE_ALG_RSASSA_PKCS1_PSS_MGF1_SHA256']:
+        # MGF1 with SHA-256, salt length = digest length
+        return pss.new(key, salt_bytes=h.digest_size).sign(h)
+    return pkcs1_15.new(key).sign(h)
  
  
-def vm_gen_digest(uuid, img_path, version):
+def vm_gen_digest(uuid, img_path, version, digest_cache=None):
 
-    digest = get_digest(uuid, img_path, version)  
+    digest = get_digest(uuid, img_path, version, digest_cache)
     return base64.b64encode(digest)       
    
         
-def vm_gen_sig(uuid, key, img_path, version):
+def vm_gen_sig(uuid, key, img_path, version,
+               algorithm='TEE_ALG_RSASSA_PKCS1_PSS_MGF1_SHA256', digest_cache=None):
 
-    digest = get_digest(uuid, img_path, version)
-    signature = get_sign(key, digest)
+    digest = get_digest(uuid, img_path, version, digest_cache)
+    signature = get_sign(key, digest, algorithm)
     
     return base64.b64encode(signature)
 
 
+def read_batch(batch_file, logger):
+    """ Reads a --batch file into (uuid, version, img_path, out_file) tuples;
+    exits on malformed lines. Fields are split like shell words, so paths
+    containing spaces can be quoted. """
+    entries = []
+    with open(batch_file, 'r') as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                fields = shlex.split(line)
+            except ValueError as e:
+                logger.error('%s:%d: %s' % (batch_file, lineno, e))
+                sys.exit(1)
+            if len(fields) != 4:
+                logger.error('%s:%d: expected 4 fields, got %d' % (batch_file, lineno, len(fields)))
+                sys.exit(1)
+            uuid, version, img_path, out_file = fields
+            try:
+                version = int_parse(version)
+            except ValueError:
+                logger.error('%s:%d: invalid version "%s"' % (batch_file, lineno, version))
+                sys.exit(1)
+            entries.append((uuid, version, img_path, out_file))
+    return entries
+
+def vm_gen_sigs(entries, key, algorithm='TEE_ALG_RSASSA_PKCS1_PSS_MGF1_SHA256',
+                digest_cache=None, jobs=None):
+    """ Signs several images; the key is loaded once and images are hashed
+    in parallel. `entries` is a list of (uuid, version, img_path) and the
+    base64 signatures are returned in the same order. """
+
+    if isinstance(key, str):
+        key = load_key(key)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        digests = list(pool.map(lambda it: get_digest(it[0], it[2], it[1], digest_cache),
+                                entries))
+
+    return [base64.b64encode(get_sign(key, digest, algorithm)) for digest in digests]
+
+
 def main():
     logging.basicConfig()
     logger = logging.getLogger(os.path.basename(__file__))
 
     args = get_args(logger)  
     
-    if args.command in ['sign']:
-        signature = vm_gen_sig(args.uuid, args.key, args.img_path, args.version)
+    digest_cache = DigestCache(args.digest_cache) if args.digest_cache else None
+
+    if args.command in ['sign'] and args.batch is not None:
+        entries = read_batch(args.batch, logger)
+        signatures = vm_gen_sigs([it[:3] for it in entries], args.key, args.algo,
+                                 digest_cache, args.jobs)
+        for entry, signature in zip(entries, signatures):
+            write_signature(entry[3], signature)
+    elif args.command in ['sign']:
+        signature = vm_gen_sig(args.uuid, args.key, args.img_path, args.version,
+                               args.algo, digest_cache)
         write_signature(args.out_file, signature)
     else:
-        logger.error('Command ' + parse.command + ' not found.')
+        logger.error('Command ' + args.command + ' not found.')
         sys.exit(1)
 
+    if digest_cache is not None:
+        digest_cache.save()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the build scripts are plain modules next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
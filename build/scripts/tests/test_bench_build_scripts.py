@@ -0,0 +1,61 @@
+import types
+
+import pytest
+
+import bench_build_scripts
+
+# noisy runs of a 10 ms benchmark
+TIMES = [10, 12, 9, 10, 25, 11, 10, 9, 13, 10, 11, 10]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ Simulated time.perf_counter() [s], advanced by the benchmarks """
+    clock = [0.0]
+    monkeypatch.setattr(bench_build_scripts, "time",
+                        types.SimpleNamespace(perf_counter=lambda: clock[0]))
+    monkeypatch.setattr(bench_build_scripts, "gc",
+                        types.SimpleNamespace(collect=lambda: None))
+    return clock
+
+
+def _timings(clock, times):
+    """ measure() results of runs taking `times` [ms] """
+    runs = iter(times)
+
+    def run(_):
+        clock[0] += next(runs) / 1000
+
+    return bench_build_scripts.measure(run, iterations=len(times))
+
+
+def test_measure_runs_until_min_time(clock):
+    def run(_):
+        clock[0] += 1 / 64
+
+    assert bench_build_scripts.measure(run, iterations=3)["iterations"] == 3
+    result = bench_build_scripts.measure(run, iterations=3, min_time=0.5)
+    assert result["iterations"] == 32
+    assert result["median_ms"] == result["q1_ms"] == result["q3_ms"] == 1000 / 64
+
+
+def test_compare_tolerates_noise(clock):
+    baseline = {"parse_dts": _timings(clock, TIMES)}
+    assert baseline["parse_dts"]["median_ms"] == pytest.approx(10)
+
+    # the same distribution in another order, with a larger outlier
+    results = {"parse_dts": _timings(clock, TIMES[6:] + TIMES[:4] + [40, 11])}
+    assert bench_build_scripts.compare(results, baseline, 0.1) == []
+
+
+def test_compare_reports_regressions(clock):
+    baseline = {"parse_dts": _timings(clock, TIMES), "store_fdt": _timings(clock, TIMES)}
+    results = {"parse_dts": _timings(clock, [ it * 1.5 for it in TIMES ]),
+               "store_fdt": _timings(clock, [ it * 0.5 for it in TIMES ]),
+               "new": _timings(clock, TIMES)}
+    assert bench_build_scripts.compare(results, baseline, 0.1) == ["parse_dts"]
+
+    # the tolerance grows with the noise of the runs
+    noisy = _timings(clock, [ it * (1.5 if i % 2 else 0.5) for i, it in enumerate(TIMES) ])
+    assert bench_build_scripts.tolerance(noisy, noisy, 0.1) > 0.5
+    assert bench_build_scripts.tolerance(baseline["parse_dts"], results["parse_dts"], 0.1) < 0.5
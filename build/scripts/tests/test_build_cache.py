@@ -0,0 +1,77 @@
+import os
+
+import build_cache
+
+
+def test_materialize_is_independent_of_cached_object(tmp_path):
+    cache = build_cache.ArtifactCache(str(tmp_path / "cache"))
+    built = tmp_path / "vm1.dtb"
+    built.write_bytes(b"patched fdt")
+
+    inputs = {"fdt": build_cache.digest_bytes(b"source")}
+    entry = cache.store(cache.make_key(inputs), inputs, {"fdt": str(built)})
+
+    staged = tmp_path / "cpio" / "vm1.dtb"
+    staged.parent.mkdir()
+    cache.materialize(entry, "fdt", str(staged))
+    assert staged.read_bytes() == b"patched fdt"
+
+    # hooks may edit staged files in place
+    with open(staged, "r+b") as f:
+        f.write(b"PATCHED")
+
+    cached = os.path.join(cache.objects_dir, entry["outputs"]["fdt"])
+    with open(cached, "rb") as f:
+        assert f.read() == b"patched fdt"
+
+    assert cache.lookup(cache.make_key(inputs))["key"] == entry["key"]
+
+
+def test_key_is_order_independent(tmp_path):
+    cache = build_cache.ArtifactCache(str(tmp_path))
+    assert cache.make_key({"kernel": "a", "fdt": None}) == \
+           cache.make_key({"fdt": None, "kernel": "a"})
+    assert cache.make_key({"kernel": "a"}) != cache.make_key({"kernel": "b"})
+
+
+def test_file_digest_follows_content(tmp_path):
+    cache = build_cache.ArtifactCache(str(tmp_path / "cache"))
+    image = tmp_path / "Image"
+    image.write_bytes(b"kernel 1")
+    first = cache.file_digest(str(image))
+    assert first == build_cache.digest_bytes(b"kernel 1")
+
+    image.write_bytes(b"kernel 2")
+    assert cache.file_digest(str(image)) == build_cache.digest_bytes(b"kernel 2")
+    assert cache.file_digest(str(tmp_path / "missing")) is None
+
+    # memoized digests survive a restart
+    cache.save()
+    restarted = build_cache.ArtifactCache(str(tmp_path / "cache"))
+    assert restarted.file_hashes == cache.file_hashes
+
+
+def test_lookup_requires_output_objects(tmp_path):
+    cache = build_cache.ArtifactCache(str(tmp_path / "cache"))
+    built = tmp_path / "vm1.dtb"
+    built.write_bytes(b"patched fdt")
+    inputs = {"fdt": "digest"}
+    key = cache.make_key(inputs)
+
+    assert cache.lookup(key) is None
+    entry = cache.store(key, inputs, {"fdt": str(built)})
+    assert cache.lookup(key) == entry
+
+    os.remove(os.path.join(cache.objects_dir, entry["outputs"]["fdt"]))
+    assert cache.lookup(key) is None
+
+
+def test_explain(tmp_path):
+    cache = build_cache.ArtifactCache(str(tmp_path))
+    assert cache.explain("uuid", {"kernel": "a"}) is None
+
+    cache.set_last_entry("uuid", {"key": "k", "inputs": {"kernel": "a", "fdt": "b"},
+                                  "outputs": {}})
+    assert cache.explain("uuid", {"kernel": "a", "fdt": "b"}) == []
+    assert cache.explain("uuid", {"kernel": "c", "ramdisk": "d"}) == \
+           ["fdt", "kernel", "ramdisk"]
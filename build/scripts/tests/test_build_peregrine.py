@@ -0,0 +1,202 @@
+import json
+import os
+import re
+import shutil
+
+import pytest
+
+import build_cache
+import build_peregrine
+import config_parser
+import fdt_patcher
+from fdt_hotfix import FDT_HOTFIX
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+Builder = build_peregrine.Builder
+
+
+@pytest.fixture
+def platform(tmp_path, monkeypatch):
+    """ Copy of the FVP target whose VMs use DTB device trees
+
+    External tools (dtc, make, mkimage) are replaced, so only the Python part
+    of the build runs.
+    """
+
+    root = str(tmp_path) + "/"
+    target = os.path.join(root, "build/targets/fvp")
+    src = os.path.join(SCRIPTS_DIR, "../targets/fvp")
+    os.makedirs(os.path.join(target, "VMs"))
+    os.makedirs(os.path.join(root, "linux"))
+    os.makedirs(os.path.join(root, "out"))
+    shutil.copy(os.path.join(src, "platform_fdt.dts"), target)
+    shutil.copytree(os.path.join(src, "vm-dts"), os.path.join(target, "vm-dts"))
+
+    with open(os.path.join(root, "linux/Image"), "wb") as f:
+        f.write(b"kernel")
+
+    for name in ("linux1.json", "linux2.json"):
+        with open(os.path.join(src, "VMs", name), "r") as f:
+            vm_json = json.loads(f.read().replace("$(ROOT)/", "$(ROOT)"))
+
+        vm = next(iter(vm_json.values()))
+        with open(vm["fdt_path"].replace("$(ROOT)build/targets/fvp", src), "r") as f:
+            dts_text = re.sub(r"<initrd-(start|end)>", "<0x0>", f.read())
+        dtb_data = fdt_patcher.to_dtb(FDT_HOTFIX.parse_dts(dts_text))
+        vm["fdt_path"] = vm["fdt_path"][:-1] + "b"
+        with open(vm["fdt_path"].replace("$(ROOT)", root), "wb") as f:
+            f.write(dtb_data)
+
+        vm.update(kernel_path="$(ROOT)linux/Image", build_command="")
+        vm.pop("ramdisk_path", None)
+        with open(os.path.join(target, "VMs", name), "w") as f:
+            json.dump(vm_json, f)
+
+    with open(os.path.join(src, "fvp.json"), "r") as f:
+        config = f.read().replace("$(ROOT)/", "$(ROOT)")
+    config_path = os.path.join(target, "fvp.json")
+    with open(config_path, "w") as f:
+        f.write(config)
+
+    monkeypatch.setattr(build_peregrine, "compile_dts",
+                        lambda src, dest, *args: shutil.copyfile(src, dest))
+    for name in ("make", "create_platform_fit_image", "update_exports"):
+        monkeypatch.setattr(Builder, name, classmethod(lambda cls, *args, **kwargs: None))
+    for name, value in vars(Builder).items():
+        if not name.startswith("__") and not callable(value) \
+                and not isinstance(value, (classmethod, staticmethod)):
+            monkeypatch.setattr(Builder, name, value)
+
+    monkeypatch.setattr(config_parser, "vm_count", 0)
+    monkeypatch.setattr(config_parser, "found_primary", False)
+    monkeypatch.setattr(config_parser, "BUILD_ROOT", root)
+    monkeypatch.setattr(Builder, "BUILD_ROOT", root)
+    monkeypatch.setattr(Builder, "cache", None)
+    Builder.init_config(config_path)
+    return config_path
+
+
+def test_memreserve_entries_stable_across_rebuilds(platform):
+    out_dir = Builder.config.build_options["out_dir"]
+    cpio_dir = Builder.prepare_cpio_dir()
+    manifest_path = os.path.join(cpio_dir, "manifest.dtb")
+    image_path = os.path.join(out_dir, "vms.img")
+
+    vms = Builder.build_vms(image_path, cpio_dir, manifest_path)
+    Builder.pack_vms(image_path, cpio_dir)
+
+    def memreserve_counts():
+        return { name: len(fdt_patcher.parse_fdt(os.path.join(cpio_dir, name)).entries)
+                 for name in sorted(os.listdir(cpio_dir)) if name.endswith(".dtb") }
+
+    counts = memreserve_counts()
+    assert counts[manifest_path.rsplit("/", 1)[1]] == 0
+    assert all(counts[f"{vm.vm_id}_{os.path.basename(vm.fdt_path)}"] == 1 for vm in vms)
+
+    for _ in range(2):
+        changed = { os.path.abspath(vm.fdt_path) for vm in vms }
+        vms = Builder.rebuild_changed(changed, platform, image_path, cpio_dir,
+                                      manifest_path, vms)
+        assert memreserve_counts() == counts
+
+
+def _edit_vm(config_path, name, **fields):
+    """ Changes fields of a VM configuration of the `platform` fixture """
+    path = os.path.join(os.path.dirname(config_path), "VMs", name)
+    with open(path, "r") as f:
+        vm_json = json.load(f)
+    next(iter(vm_json.values())).update(fields)
+    with open(path, "w") as f:
+        json.dump(vm_json, f)
+
+
+def _build_primary_vm():
+    """ Stages the primary VM into an empty cpio directory
+
+    Returns:
+        str: path of its patched device tree
+    """
+    cpio_dir = Builder.prepare_cpio_dir()
+    vm = Builder.get_vms()[0]
+    assert Builder.build_vm(vm)
+    return os.path.join(cpio_dir, f"{vm.vm_id}_{os.path.basename(vm.fdt_path)[:-1]}b")
+
+
+@pytest.fixture
+def artifact_cache(platform, monkeypatch):
+    cache = build_cache.ArtifactCache(
+        os.path.join(Builder.config.build_options["out_dir"], ".cache"))
+    monkeypatch.setattr(Builder, "cache", cache)
+    return cache
+
+
+@pytest.fixture
+def patched(monkeypatch):
+    """ IDs of the VMs whose device tree was patched """
+    calls = []
+    patch_vm_fdt = Builder.patch_vm_fdt
+
+    def _patch_vm_fdt(cls, vm, outpath):
+        calls.append(vm.vm_id)
+        return patch_vm_fdt(vm, outpath)
+
+    monkeypatch.setattr(Builder, "patch_vm_fdt", classmethod(_patch_vm_fdt))
+    return calls
+
+
+def test_cache_hit_reuses_patched_fdt(artifact_cache, patched):
+    staged = _build_primary_vm()
+    with open(staged, "rb") as f:
+        dtb_data = f.read()
+    assert patched == ["vm1"]
+
+    staged = _build_primary_vm()
+    assert patched == ["vm1"]
+    with open(staged, "rb") as f:
+        assert f.read() == dtb_data
+    # a copy, hooks editing it in place do not change the cache
+    assert os.stat(staged).st_nlink == 1
+
+
+def test_no_cache_repatches(platform, patched):
+    _build_primary_vm()
+    _build_primary_vm()
+    assert patched == ["vm1", "vm1"]
+
+
+def test_always_rebuild_runs_despite_cache_hit(platform, artifact_cache, patched, tmp_path):
+    log = tmp_path / "builds.log"
+    _edit_vm(platform, "linux1.json", build_command=f"sh -c 'echo built >> {log}'",
+             always_rebuild=True)
+
+    _build_primary_vm()
+    _build_primary_vm()
+    assert log.read_text() == "built\nbuilt\n"
+    assert patched == ["vm1"]
+
+    _edit_vm(platform, "linux1.json", always_rebuild=False)
+    _build_primary_vm()
+    assert log.read_text() == "built\nbuilt\n"
+
+
+def test_included_file_change_misses_cache(platform, artifact_cache, patched):
+    dts_path = os.path.join(os.path.dirname(platform), "vm-dts", "primary_vm_fdt.dts")
+    include_path = os.path.join(os.path.dirname(dts_path), "extra.dtsi")
+    with open(dts_path, "r") as f:
+        dts_text = re.sub(r"<initrd-(start|end)>", "<0x0>", f.read())
+    with open(dts_path, "w") as f:
+        f.write(dts_text + '\n/include/ "extra.dtsi"\n')
+    with open(include_path, "w") as f:
+        f.write("/ { extra { value = <1>; }; };\n")
+    _edit_vm(platform, "linux1.json", fdt_path=dts_path)
+
+    _build_primary_vm()
+    _build_primary_vm()
+    assert patched == ["vm1"]
+
+    with open(include_path, "w") as f:
+        f.write("/ { extra { value = <2>; }; };\n")
+    staged = _build_primary_vm()
+    assert patched == ["vm1", "vm1"]
+    assert fdt_patcher.parse_fdt(staged).get_property("value", "/extra").value == 2
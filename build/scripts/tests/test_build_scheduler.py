@@ -0,0 +1,78 @@
+import os
+import time
+
+import pytest
+
+from build_scheduler import BuildError, VMBuildScheduler, apply_job_limit
+
+
+@pytest.mark.parametrize("argv, expected", [
+    (["make", "linux-vm"], ["make", "linux-vm", "-j2"]),
+    (["make", "-j6", "linux-vm"], ["make", "-j2", "linux-vm"]),
+    (["make", "-j", "linux-vm"], ["make", "-j2", "linux-vm"]),
+    (["make", "-j", "6", "linux-vm"], ["make", "-j2", "linux-vm"]),
+    (["make", "--jobs", "6", "linux-vm"], ["make", "-j2", "linux-vm"]),
+    (["make", "--jobs=6", "linux-vm"], ["make", "-j2", "linux-vm"]),
+    (["make", "--jobs", "linux-vm"], ["make", "-j2", "linux-vm"]),
+    (["make", "-kj6", "linux-vm"], ["make", "-k", "-j2", "linux-vm"]),
+    (["make", "-kj", "6"], ["make", "-k", "-j2"]),
+    (["/usr/bin/make", "-f", "vm.mk", "linux-vm", "-j6"],
+        ["/usr/bin/make", "-f", "vm.mk", "linux-vm", "-j2"]),
+])
+def test_job_count_is_replaced(argv, expected):
+    assert apply_job_limit(argv, 2) == expected
+
+
+@pytest.mark.parametrize("argv", [
+    ["make", "-C", "-j6-dir"],
+    ["make", "-Cproj", "-f", "build-j.mk"],
+])
+def test_option_arguments_are_kept(argv):
+    assert apply_job_limit(argv, 2) == argv + ["-j2"]
+
+
+def test_limit_precedes_end_of_options():
+    assert apply_job_limit(["make", "-k", "--", "-j6"], 2) == \
+        ["make", "-k", "-j2", "--", "-j6"]
+
+
+def test_other_commands_are_unchanged():
+    argv = ["./build.sh", "-j6"]
+    assert apply_job_limit(argv, 2) == argv
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def test_failure_stops_whole_process_group(tmp_path):
+    pid_file = tmp_path / "sleep.pid"
+    scheduler = VMBuildScheduler(jobs=2, log_dir=str(tmp_path))
+    scheduler.add("vm1", ["sh", "-c", f"sleep 30 & echo $! > {pid_file}; wait"],
+                  str(tmp_path), dict(os.environ))
+    scheduler.add("vm2", ["sh", "-c", f"while [ ! -s {pid_file} ]; do sleep 0.05; done; exit 3"],
+                  str(tmp_path), dict(os.environ))
+
+    with pytest.raises(BuildError) as error:
+        scheduler.run()
+    assert error.value.job.names == ["vm2"]
+
+    pid = int(pid_file.read_text())
+    deadline = time.monotonic() + 5
+    while _alive(pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not _alive(pid)
+
+
+def test_no_build_starts_after_abort(tmp_path):
+    scheduler = VMBuildScheduler(jobs=1, log_dir=str(tmp_path))
+    scheduler.add("vm1", ["sh", "-c", "exit 1"], str(tmp_path), dict(os.environ))
+    scheduler.add("vm2", ["sh", "-c", "exit 0"], str(tmp_path), dict(os.environ))
+
+    with pytest.raises(BuildError):
+        scheduler.run()
+    assert scheduler.queue[1].process is None
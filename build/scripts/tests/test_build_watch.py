@@ -0,0 +1,49 @@
+import os
+import threading
+import time
+
+import pytest
+
+from build_watch import FileWatcher
+
+
+def _wait(watcher, timeout=10):
+    """ FileWatcher.wait() that fails instead of blocking forever """
+    result = []
+    thread = threading.Thread(target=lambda: result.append(watcher.wait()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert result, "no change reported"
+    return result[0][0]
+
+
+@pytest.fixture(params=[True, False], ids=["inotify", "polling"])
+def watcher(request):
+    watcher = FileWatcher(poll_interval=0.05, settle_time=0.2, use_inotify=request.param)
+    if request.param and watcher.backend != "inotify":
+        pytest.skip("inotify not available")
+    return watcher
+
+
+def test_changes_are_batched(tmp_path, watcher):
+    kernel, ramdisk, other = (tmp_path / it for it in ("Image", "rootfs.cpio.gz", "other"))
+    for it in (kernel, ramdisk, other):
+        it.write_bytes(b"old")
+    vm_dir = tmp_path / "VMs"
+    vm_dir.mkdir()
+    watcher.set_paths([str(kernel), str(ramdisk)], [str(vm_dir)])
+
+    def build():
+        kernel.write_bytes(b"new kernel")
+        other.write_bytes(b"not watched")
+        time.sleep(0.05)
+        ramdisk.write_bytes(b"new ramdisk")
+        # editors replace files by renaming a temporary one
+        (tmp_path / "tmp.json").write_text("{}")
+        os.replace(tmp_path / "tmp.json", vm_dir / "linux3.json")
+
+    threading.Timer(0.1, build).start()
+    assert _wait(watcher) == {str(kernel), str(ramdisk), str(vm_dir / "linux3.json")}
+
+    threading.Timer(0.1, lambda: kernel.unlink()).start()
+    assert _wait(watcher) == {str(kernel)}
@@ -0,0 +1,161 @@
+import os
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+from cpio_archive import BIN_MAGIC, BLOCK_SIZE, CpioWriter
+
+bsdtar = shutil.which("bsdtar")
+requires_bsdtar = pytest.mark.skipif(bsdtar is None, reason="bsdtar not installed")
+
+FILES = {
+    "manifest.dtb": b"\xd0\x0d\xfe\xed" * 10,
+    "vm1_Image": os.urandom(100003),
+    "vm2_Image": b"abc",
+    "keys/vm1.sig": b"signature",
+}
+
+
+def _list(archive_path):
+    return subprocess.run([bsdtar, "-tf", archive_path], check=True,
+                          capture_output=True, text=True).stdout.split()
+
+
+def _extract(archive_path, dest):
+    os.makedirs(dest)
+    subprocess.run([bsdtar, "-xf", archive_path, "-C", dest], check=True)
+    return { os.path.relpath(os.path.join(root, it), dest):
+                 open(os.path.join(root, it), "rb").read()
+             for root, _, files in os.walk(dest) for it in files }
+
+
+def _writer(src, fmt):
+    writer = CpioWriter(leading=["./manifest.dtb"], fmt=fmt)
+    writer.add_directory(str(src), prefix="./")
+    return writer
+
+
+@pytest.fixture(params=["bin", "newc"])
+def fmt(request):
+    return request.param
+
+
+@pytest.fixture
+def src(tmp_path):
+    src = tmp_path / "cpio"
+    for name, data in FILES.items():
+        (src / name).parent.mkdir(parents=True, exist_ok=True)
+        (src / name).write_bytes(data)
+    return src
+
+
+@requires_bsdtar
+def test_round_trip(tmp_path, src, fmt):
+    archive = str(tmp_path / "vms.img")
+    size, offsets = _writer(src, fmt).write(archive)
+
+    assert size == os.path.getsize(archive)
+    assert size % BLOCK_SIZE == 0
+    assert _list(archive) == ["./manifest.dtb", "./keys/vm1.sig", "./vm1_Image", "./vm2_Image"]
+    assert _extract(archive, str(tmp_path / "out")) == FILES
+
+    with open(archive, "rb") as f:
+        data = f.read()
+    for name, (offset, length) in offsets.items():
+        assert data[offset:offset + length] == FILES[name[2:]]
+
+
+@requires_bsdtar
+@pytest.mark.parametrize("name, data, reused", [
+    ("vm2_Image", b"abcd", 3),              # last member grows
+    ("vm1_Image", b"short", 2),             # earlier member shrinks
+    ("keys/vm1.sig", b"SIGNATURE", 1),      # same size, new content
+])
+def test_incremental_write(tmp_path, src, fmt, name, data, reused):
+    archive = str(tmp_path / "vms.img")
+    previous = _writer(src, fmt)
+    previous.write(archive)
+
+    (src / name).write_bytes(data)
+
+    writer = _writer(src, fmt)
+    size, _ = writer.write(archive, previous=previous)
+    assert writer.reused == reused
+
+    fresh = str(tmp_path / "fresh.img")
+    _writer(src, fmt).write(fresh)
+    with open(archive, "rb") as a, open(fresh, "rb") as b:
+        assert a.read() == b.read()
+
+    assert size == os.path.getsize(archive)
+    assert _extract(archive, str(tmp_path / "out")) == dict(FILES, **{name: data})
+
+
+def test_incremental_write_unchanged(tmp_path, src, fmt):
+    archive = str(tmp_path / "vms.img")
+    previous = _writer(src, fmt)
+    previous.write(archive)
+    with open(archive, "rb") as f:
+        data = f.read()
+
+    writer = _writer(src, fmt)
+    writer.write(archive, previous=previous)
+    assert writer.reused == len(FILES)
+    with open(archive, "rb") as f:
+        assert f.read() == data
+
+
+@requires_bsdtar
+def test_incremental_write_after_external_change(tmp_path, src, fmt):
+    archive = str(tmp_path / "vms.img")
+    previous = _writer(src, fmt)
+    previous.write(archive)
+
+    with open(archive, "r+b") as f:
+        f.write(b"garbage")
+
+    writer = _writer(src, fmt)
+    writer.write(archive, previous=previous)
+    assert writer.reused == 0
+    assert _extract(archive, str(tmp_path / "out")) == FILES
+
+
+def _parse_bin(data):
+    """ Reads an old binary archive the way the hypervisor's loader does """
+    members, offset = {}, 0
+    while True:
+        fields = struct.unpack_from("<13H", data, offset)
+        assert fields[0] == BIN_MAGIC
+        namesize, filesize = fields[10], fields[11] << 16 | fields[12]
+        name = data[offset + 26:offset + 26 + namesize - 1].decode()
+        offset += 26 + namesize + namesize % 2
+        if name == "TRAILER!!!":
+            return members
+        members[name] = data[offset:offset + filesize]
+        offset += filesize + filesize % 2
+
+
+def test_bin_format(tmp_path, src):
+    archive = str(tmp_path / "vms.img")
+    _writer(src, "bin").write(archive)
+
+    with open(archive, "rb") as f:
+        data = f.read()
+    assert data[:2] == b"\xc7\x71"
+    assert list(_parse_bin(data)) == ["./manifest.dtb", "./keys/vm1.sig", "./vm1_Image", "./vm2_Image"]
+    assert _parse_bin(data) == { f"./{name}": data for name, data in FILES.items() }
+
+
+def test_bin_format_limits(tmp_path):
+    with pytest.raises(ValueError):
+        CpioWriter(fmt="odc")
+
+    sparse = tmp_path / "huge"
+    with open(sparse, "wb") as f:
+        f.truncate(1 << 32)
+    writer = CpioWriter()
+    writer.add_file("./huge", str(sparse))
+    with pytest.raises(ValueError, match="too large"):
+        writer.write(str(tmp_path / "vms.img"))
@@ -0,0 +1,141 @@
+import gc
+import os
+import pickle
+
+import pytest
+
+import fdt_hotfix
+from fdt_hotfix import FDT_HOTFIX, _eval_expr
+
+
+@pytest.mark.parametrize("expr, bits, expected", [
+    ("(1 + 2 * 3)", 32, 7),
+    ("((0x10 | 3) & ~1)", 32, 0x12),
+    ("(2 * (3 + 4) >> 1)", 32, 7),
+    ("(10 / 3)", 32, 3),
+    ("(10 % 3)", 32, 1),
+    ("(-1)", 32, 0xffffffff),
+    ("(-1)", 64, 0xffffffffffffffff),
+    ("(1 < 2 < 1)", 32, 0),
+    ("(!0 && 5)", 32, 1),
+    ("('a' + 1)", 32, 0x62),
+    ("(1 << 63)", 64, 1 << 63),
+    ("(1 << 99999999)", 64, 0),
+])
+def test_eval_expr(expr, bits, expected):
+    assert _eval_expr(expr, bits) == expected
+
+
+@pytest.mark.parametrize("expr", [
+    "(9**9**9)",
+    "(7 / 0)",
+    "(1 ? 2 : 3)",
+    "(__import__)",
+    "(" * 10000 + "1" + ")" * 10000,
+])
+def test_eval_expr_rejects(expr):
+    with pytest.raises(ValueError):
+        _eval_expr(expr)
+
+
+def test_expression_cells():
+    tree = FDT_HOTFIX.parse_dts("/dts-v1/;\n/ { reg = <(0x1000 + 0x20) (1 << 4)>; };\n")
+    assert tree.get_property("reg", "/").data == [0x1020, 0x10]
+
+
+def test_property_redefinition():
+    gc_enabled = gc.isenabled()
+    tree = FDT_HOTFIX.parse_dts("""/dts-v1/;
+/ {
+    a { x = <1>; y = "s"; z = <&b>; };
+    b: b { x = <1>; y = "s"; };
+    c { x = <1>; y = "s"; };
+    a { x = <2>; /delete-property/ y; };
+    a { y = "t"; z = <3>; };
+};
+""")
+    assert gc.isenabled() == gc_enabled
+
+    a, b = tree.get_node("/a"), tree.get_node("/b")
+    # a redefinition keeps the position, a deleted property is appended again
+    assert [ it.name for it in a.props ] == ["x", "z", "y"]
+    assert a.get_property("x").data == [2]
+    assert a.get_property("z").data == [3]
+    assert b.get_property("x").data == [1]
+    assert [ it.name for it in b.props ] == ["x", "y", "phandle"]
+
+    # equal values are decoded once, but not shared
+    b.get_property("x").data.append(5)
+    b.get_property("y").data.append("u")
+    assert tree.get_property("x", "/c").data == [1]
+    assert tree.get_property("y", "/c").data == ["s"]
+
+
+@pytest.mark.parametrize("content", [
+    b"",
+    b"\x80\x09garbage",                 # unsupported pickle protocol
+    pickle.dumps((1, 2)),               # not a (dependencies, tree) pair
+    pickle.dumps(([], "not a tree")),
+])
+def test_unreadable_cache_files_are_reparsed(tmp_path, monkeypatch, content):
+    monkeypatch.setattr(fdt_hotfix, "_cache", {})
+    monkeypatch.setattr(fdt_hotfix, "CACHE_DIR", str(tmp_path))
+
+    text = "/dts-v1/;\n/ { model = \"cached\"; };\n"
+    FDT_HOTFIX.parse_dts_cached(text)
+    cache_files = os.listdir(tmp_path)
+    assert len(cache_files) == 1
+
+    for name in cache_files:
+        (tmp_path / name).write_bytes(content)
+    fdt_hotfix._cache.clear()
+
+    tree = FDT_HOTFIX.parse_dts_cached(text)
+    assert tree.get_property("model", "/").value == "cached"
+
+
+def test_include_lookup(tmp_path, monkeypatch):
+    dts_dir, cwd = tmp_path / "dts", tmp_path / "cwd"
+    dts_dir.mkdir()
+    cwd.mkdir()
+    (dts_dir / "model.dtsi").write_text('/ { model = "dts dir"; };\n')
+    (cwd / "model.dtsi").write_text('/ { model = "cwd"; };\n')
+    (cwd / "compatible.dtsi").write_text('/ { compatible = "cwd"; };\n')
+    monkeypatch.chdir(cwd)
+
+    text = '/dts-v1/;\n/include/ "model.dtsi"\n/include/ "compatible.dtsi"\n'
+    tree = FDT_HOTFIX.parse_dts(text, str(dts_dir))
+    assert tree.get_property("model", "/").value == "dts dir"
+    assert tree.get_property("compatible", "/").value == "cwd"
+
+    with pytest.raises(Exception, match="doesn't exist"):
+        FDT_HOTFIX.parse_dts('/dts-v1/;\n/include/ "missing.dtsi"\n', str(dts_dir))
+
+
+def test_cached_tree_revalidates_include_lookup(tmp_path, monkeypatch):
+    monkeypatch.setattr(fdt_hotfix, "_cache", {})
+    dts_dir = tmp_path / "dts"
+    dts_dir.mkdir()
+    (tmp_path / "model.dtsi").write_text('/ { model = "cwd"; };\n')
+    monkeypatch.chdir(tmp_path)
+
+    text = '/dts-v1/;\n/include/ "model.dtsi"\n'
+    assert FDT_HOTFIX.parse_dts_cached(text, str(dts_dir)) \
+                     .get_property("model", "/").value == "cwd"
+
+    # a file in the DTS directory takes precedence once it exists
+    (dts_dir / "model.dtsi").write_text('/ { model = "dts dir"; };\n')
+    assert FDT_HOTFIX.parse_dts_cached(text, str(dts_dir)) \
+                     .get_property("model", "/").value == "dts dir"
+
+
+def test_get_dependencies(tmp_path):
+    (tmp_path / "extra.dtsi").write_text('/ { blob = /incbin/("blob.bin"); };\n')
+    (tmp_path / "blob.bin").write_bytes(b"\x01\x02")
+    text = '/dts-v1/;\n/ { };\n/include/ "extra.dtsi"\n'
+
+    assert FDT_HOTFIX.get_dependencies(text, str(tmp_path)) == \
+        [str(tmp_path / "extra.dtsi"), str(tmp_path / "blob.bin")]
+    # dependencies that cannot be found are reported by the parser
+    assert FDT_HOTFIX.get_dependencies('/include/ "missing.dtsi"\n', str(tmp_path)) == \
+        [str(tmp_path / "missing.dtsi"), os.path.abspath("missing.dtsi")]
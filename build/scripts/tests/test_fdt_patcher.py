@@ -0,0 +1,175 @@
+import copy
+import os
+import sys
+
+import pytest
+
+import bench_generators
+import fdt_patcher
+from fdt_hotfix import FDT_HOTFIX
+
+TARGETS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           "../targets")
+
+DTS = """/dts-v1/;
+/memreserve/ 0x80000000 0x10000;
+/ {
+    #address-cells = <2>;
+    #size-cells = <2>;
+    memory@80000000 { device_type = "memory"; reg = <0x0 0x80000000 0x0 0x8000000>; };
+};
+"""
+
+
+def test_to_dtb_leaves_tree_unchanged():
+    for tree in (FDT_HOTFIX.parse_dts(DTS),
+                 fdt_patcher._parse_dtb(fdt_patcher.to_dtb(FDT_HOTFIX.parse_dts(DTS)))):
+        header = copy.copy(vars(tree.header))
+        dtb_data = fdt_patcher.to_dtb(tree)
+        assert vars(tree.header) == header
+
+        parsed = fdt_patcher._parse_dtb(dtb_data)
+        assert parsed.header.version == fdt_patcher.DTB_VERSION
+        assert parsed.entries == [{"address": 0x80000000, "size": 0x10000}]
+        assert parsed.root == tree.root
+
+
+PRUNE_DTS = """/dts-v1/;
+/ {
+    aliases { serial0 = "/uart@1000"; gpio0 = "/gpio@2000"; };
+    cpus {
+        cpu@100 { reg = <0x100>; };
+        cpu@10000 { reg = <0x10000>; };
+    };
+    clk: clock { #clock-cells = <0>; };
+    uart: uart@1000 { clocks = <&clk>; };
+    gpio: gpio@2000 { interrupt-parent = <&uart>; };
+    leds { gpios = <&gpio 1>; };
+    bus { dev { dmas = <&{/uart@1000}>; }; };
+};
+"""
+
+
+def _paths(tree):
+    return set(fdt_patcher.get_nodelist(tree))
+
+
+def test_index():
+    index = fdt_patcher.FdtIndex(FDT_HOTFIX.parse_dts(PRUNE_DTS))
+
+    assert index.parents["/bus/dev"] == "/bus"
+    assert index.parents["/"] is None
+    assert index.nodes["/cpus/cpu@100"].name == "cpu@100"
+    assert index.labels == {"clk": "/clock", "uart": "/uart@1000", "gpio": "/gpio@2000"}
+    assert index.aliases == {"/uart@1000": ["serial0"], "/gpio@2000": ["gpio0"]}
+    assert index.refs == {"/uart@1000": ["clk"], "/gpio@2000": ["uart"],
+                          "/leds": ["gpio"], "/bus/dev": ["/uart@1000"]}
+    assert index.subtree("/bus") == ["/bus", "/bus/dev"]
+    assert index.subtree("/cpus") == ["/cpus", "/cpus/cpu@100", "/cpus/cpu@10000"]
+
+
+def test_whitelist_matches_whole_path_components():
+    tree  = FDT_HOTFIX.parse_dts(PRUNE_DTS)
+    index = fdt_patcher.FdtIndex(tree)
+    whitelist = ["/cpus/cpu@10000", "/bus/"]
+
+    assert index.blacklist_from_whitelist(whitelist) == \
+        ["/aliases", "/cpus/cpu@100", "/clock", "/uart@1000", "/gpio@2000",
+         "/leds", "/bus/dev"]
+
+    fdt_patcher.apply_whitelist(tree, whitelist)
+    assert _paths(tree) == {"/", "/cpus", "/cpus/cpu@10000", "/bus"}
+
+
+def test_prune_dependents_transitively(capsys):
+    tree = FDT_HOTFIX.parse_dts(PRUNE_DTS)
+    fdt_patcher.apply_blacklist(tree, ["/uart@1000"])
+    assert _paths(tree) >= {"/gpio@2000", "/leds", "/bus/dev"}
+
+    tree = FDT_HOTFIX.parse_dts(PRUNE_DTS)
+    fdt_patcher.apply_blacklist(tree, ["/uart@1000"], prune_dependents=True)
+    # gpio@2000 references the uart, leds reference gpio@2000
+    assert _paths(tree) == {"/", "/aliases", "/cpus", "/cpus/cpu@100",
+                            "/cpus/cpu@10000", "/clock", "/bus"}
+    assert "WAR" not in capsys.readouterr().out
+
+
+def test_prune_removes_aliases():
+    tree = FDT_HOTFIX.parse_dts(PRUNE_DTS)
+    fdt_patcher.apply_blacklist(tree, ["/uart@1000"], prune_dependents=True)
+    # the alias of a dependent goes as well
+    assert tree.get_node("/aliases").props == []
+
+    tree = FDT_HOTFIX.parse_dts(PRUNE_DTS)
+    fdt_patcher.prune_node("/gpio@2000", tree)
+    assert [ it.name for it in tree.get_node("/aliases").props ] == ["serial0"]
+
+
+def test_whitelisted_node_referencing_pruned_node_is_kept(capsys):
+    tree = FDT_HOTFIX.parse_dts(PRUNE_DTS)
+    fdt_patcher.apply_whitelist(tree, ["/aliases", "/clock", "/leds", "/bus/dev"],
+                                prune_dependents=True)
+
+    assert _paths(tree) == {"/", "/aliases", "/clock", "/leds", "/bus", "/bus/dev"}
+    out = capsys.readouterr().out
+    assert 'WAR: "/leds" references a pruned node' in out
+    assert 'WAR: "/bus/dev" references a pruned node' in out
+    assert [ it.name for it in tree.get_node("/aliases").props ] == []
+
+
+def test_delete_nodes_cli(tmp_path, monkeypatch):
+    dts_path = tmp_path / "in.dts"
+    dts_path.write_text(PRUNE_DTS)
+
+    def delete_nodes(*args):
+        out_path = tmp_path / "out.dts"
+        monkeypatch.setattr(sys, "argv", ["fdt_patcher.py", "delete-nodes",
+                                          "-i", str(dts_path), "-o", str(out_path),
+                                          "-d", "/uart@1000", *args])
+        fdt_patcher.main()
+        return _paths(FDT_HOTFIX.parse_dts(out_path.read_text()))
+
+    assert "/leds" in delete_nodes()
+    assert delete_nodes("-p") == {"/", "/aliases", "/cpus", "/cpus/cpu@100",
+                                  "/cpus/cpu@10000", "/clock", "/bus"}
+
+
+def _reference_apply_whitelist(fdt_data, whitelist):
+    """ apply_whitelist() as it was before FdtIndex, one node at a time """
+    nodelist  = fdt_patcher.get_nodelist(fdt_data, False)
+    blacklist = [ it for it in nodelist
+                  if not any(path.startswith(it) for path in whitelist) ]
+    blacklist = [ it for it in blacklist
+                  if not any(it.startswith(path) and it != path for path in blacklist) ]
+
+    for path in blacklist:
+        try:
+            aliases = fdt_data.get_node("/aliases")
+            for prop in [ it for it in aliases.props if it.data[0] == path ]:
+                aliases.remove_property(prop.name)
+        except Exception:
+            pass
+        sep_idx = path.rfind("/")
+        fdt_data.remove_node(path[sep_idx + 1:], path[:sep_idx])
+
+
+# no node name is a prefix of a sibling's that is pruned, where the string
+# prefix matching of the reference differs
+@pytest.mark.parametrize("dts_text, whitelist", [
+    (bench_generators.generate_dts(nodes=200, aliases=50, cpus=4),
+     bench_generators.generate_whitelist(200)),
+    (open(os.path.join(TARGETS_DIR, "fvp/platform_fdt.dts")).read(),
+     ["/cpus/cpu@0", "/cpus/cpu@100", "/cpus/cpu@200", "/cpus/cpu@300",
+      "/cpus/cpu@10000", "/cpus/cpu@10100", "/cpus/cpu@10200", "/cpus/cpu@10300",
+      "/memory@80000000", "/timer",
+      "/smb@0,0/motherboard/iofpga@3,00000000/uart@90000"]),
+])
+def test_whitelist_matches_reference(dts_text, whitelist):
+    expected = FDT_HOTFIX.parse_dts(dts_text)
+    _reference_apply_whitelist(expected, whitelist)
+    tree = FDT_HOTFIX.parse_dts(dts_text)
+    fdt_patcher.apply_whitelist(tree, whitelist)
+
+    assert len(_paths(tree)) < len(_paths(FDT_HOTFIX.parse_dts(dts_text)))
+    assert tree.to_dts() == expected.to_dts()
+    assert fdt_patcher.to_dtb(tree) == fdt_patcher.to_dtb(expected)
@@ -0,0 +1,198 @@
+import base64
+import hashlib
+import logging
+import os
+import struct
+import sys
+import types
+
+import pytest
+
+try:
+    from Cryptodome.Signature import pss
+    from Cryptodome.Signature import pkcs1_15
+    from Cryptodome.Hash import SHA256
+    from Cryptodome.PublicKey import RSA
+except ImportError:
+    from Crypto.Signature import pss
+    from Crypto.Signature import pkcs1_15
+    from Crypto.Hash import SHA256
+    from Crypto.PublicKey import RSA
+
+import sign_encrypt
+from sign_encrypt import DigestCache, get_digest, get_sign, read_batch
+
+logger = logging.getLogger(__name__)
+
+UUID = "ff336ad7-f2d4-4f56-a700-65b906dbf3ba"
+PSS = "TEE_ALG_RSASSA_PKCS1_PSS_MGF1_SHA256"
+PKCS1_15 = "TEE_ALG_RSASSA_PKCS1_V1_5_SHA256"
+
+
+@pytest.fixture(scope="module")
+def key():
+    return RSA.generate(2048)
+
+
+def _message(uuid, version, data):
+    return uuid.encode("ASCII") + struct.pack("<I", version) + data
+
+
+def _verify(public_key, algorithm, message, signature):
+    verifier = pss if algorithm == PSS else pkcs1_15
+    # raises ValueError if the signature does not match
+    verifier.new(public_key).verify(SHA256.new(message), signature)
+
+
+@pytest.mark.parametrize("data", [b"", b"kernel image" * 1000])
+@pytest.mark.parametrize("mapped", [True, False])
+def test_get_digest(tmp_path, monkeypatch, data, mapped):
+    image = tmp_path / "Image"
+    image.write_bytes(data)
+    monkeypatch.setattr(sign_encrypt, "HASH_CHUNK_SIZE", 7)
+    if not mapped:
+        def unmappable(*args, **kwargs):
+            raise ValueError("cannot mmap")
+        monkeypatch.setattr(sign_encrypt.mmap, "mmap", unmappable)
+
+    assert get_digest(UUID, str(image), 0x10, None) == \
+        hashlib.sha256(_message(UUID, 0x10, data)).digest()
+
+
+def test_digest_cache(tmp_path, monkeypatch):
+    image = tmp_path / "Image"
+    image.write_bytes(b"kernel 1")
+    cache = DigestCache(str(tmp_path / "digests.json"))
+
+    def digest(data):
+        return hashlib.sha256(_message(UUID, 1, data)).digest()
+
+    assert get_digest(UUID, str(image), 1, cache) == digest(b"kernel 1")
+
+    # unchanged images are not read again, also after a restart
+    cache.save()
+    cache = DigestCache(str(tmp_path / "digests.json"))
+    with monkeypatch.context() as m:
+        m.setattr(sign_encrypt, "hash_file", None)
+        assert get_digest(UUID, str(image), 1, cache) == digest(b"kernel 1")
+
+    # other UUIDs or versions of the same image are separate entries
+    assert get_digest(UUID, str(image), 2, cache) == \
+        hashlib.sha256(_message(UUID, 2, b"kernel 1")).digest()
+
+    # size
+    image.write_bytes(b"kernel 12")
+    assert get_digest(UUID, str(image), 1, cache) == digest(b"kernel 12")
+
+    # mtime, with the same size
+    st = os.stat(image)
+    image.write_bytes(b"kernel 34")
+    os.utime(image, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    assert get_digest(UUID, str(image), 1, cache) == digest(b"kernel 34")
+
+    # inode, with the same size and mtime
+    st = os.stat(image)
+    replacement = tmp_path / "Image.new"
+    replacement.write_bytes(b"kernel 56")
+    os.utime(replacement, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(replacement, image)
+    assert os.stat(image).st_ino != st.st_ino
+    assert get_digest(UUID, str(image), 1, cache) == digest(b"kernel 56")
+
+
+@pytest.mark.parametrize("field", ["st_ino", "st_size", "st_mtime_ns"])
+def test_digest_cache_identity(tmp_path, field):
+    st = os.stat(tmp_path)
+    changed = {it: getattr(st, it) for it in
+               ["st_dev", "st_ino", "st_size", "st_mtime_ns", "st_ctime_ns"]}
+    changed[field] += 1
+
+    cache = DigestCache()
+    cache.put("key", DigestCache.identity(st), b"\x01\x02")
+    assert cache.get("key", DigestCache.identity(st)) == b"\x01\x02"
+    assert cache.get("key", DigestCache.identity(types.SimpleNamespace(**changed))) is None
+
+
+@pytest.mark.parametrize("algorithm", [PSS, PKCS1_15])
+def test_get_sign(tmp_path, key, algorithm):
+    image = tmp_path / "Image"
+    image.write_bytes(b"kernel image")
+    key_file = tmp_path / "key.pem"
+    key_file.write_bytes(key.export_key("PEM"))
+
+    message = _message(UUID, 3, b"kernel image")
+    digest = get_digest(UUID, str(image), 3)
+    for signing_key in [key, str(key_file)]:
+        _verify(key.publickey(), algorithm, message, get_sign(signing_key, digest, algorithm))
+
+    with pytest.raises(ValueError):
+        _verify(key.publickey(), algorithm, message + b"x", get_sign(key, digest, algorithm))
+
+
+@pytest.mark.parametrize("algorithm", [PSS, PKCS1_15])
+def test_batch_matches_single_images(tmp_path, monkeypatch, key, algorithm):
+    key_file = tmp_path / "key.pem"
+    key_file.write_bytes(key.export_key("PEM"))
+    images = []
+    for i in range(6):
+        image = tmp_path / ("vm%d_Image" % i)
+        image.write_bytes(b"kernel %d" % i * (i + 1))
+        images.append(("%08x-f2d4-4f56-a700-65b906dbf3ba" % i, i, image))
+
+    batch = tmp_path / "batch.txt"
+    batch.write_text("".join("%s %d '%s' '%s.batch.sig'\n" % (uuid, version, image, image)
+                             for uuid, version, image in images))
+    monkeypatch.setattr(sys, "argv", ["sign_encrypt.py", "--key", str(key_file),
+                                      "--algo", algorithm, "--batch", str(batch),
+                                      "--jobs", "4"])
+    sign_encrypt.main()
+
+    for uuid, version, image in images:
+        monkeypatch.setattr(sys, "argv", ["sign_encrypt.py", "--key", str(key_file),
+                                          "--algo", algorithm, "--uuid", uuid,
+                                          "--version", str(version), "--img_path", str(image),
+                                          "--out", "%s.sig" % image])
+        sign_encrypt.main()
+
+        with open("%s.batch.sig" % image, "rb") as f:
+            batched = f.read()
+        with open("%s.sig" % image, "rb") as f:
+            single = f.read()
+        if algorithm == PKCS1_15:
+            assert batched == single
+        # PSS signatures are salted, compare them by verification
+        message = _message(uuid, version, image.read_bytes())
+        for signature in [batched, single]:
+            _verify(key.publickey(), algorithm, message, base64.b64decode(signature))
+
+
+def test_read_batch(tmp_path):
+    batch = tmp_path / "batch.txt"
+    batch.write_text(
+        "# uuid version image signature\n"
+        "\n"
+        "ff336ad7-f2d4-4f56-a700-65b906dbf3ba 1 /out/vm1_Image /out/vm1.sig\n"
+        "   \n"
+        "0f8a3c4e-1d2b-4c5d-8e9f-a0b1c2d3e4f5 0x10 '/out/my vm/Image' \"/out/my vm.sig\"\n")
+
+    assert read_batch(str(batch), logger) == [
+        ("ff336ad7-f2d4-4f56-a700-65b906dbf3ba", 1, "/out/vm1_Image", "/out/vm1.sig"),
+        ("0f8a3c4e-1d2b-4c5d-8e9f-a0b1c2d3e4f5", 16, "/out/my vm/Image", "/out/my vm.sig"),
+    ]
+
+
+@pytest.mark.parametrize("line, message", [
+    ("ff336ad7 1 /out/vm1_Image", "expected 4 fields, got 3"),
+    ("ff336ad7 1 /out/my vm/Image /out/vm1.sig", "expected 4 fields, got 5"),
+    ("ff336ad7 one /out/vm1_Image /out/vm1.sig", 'invalid version "one"'),
+    ("ff336ad7 1 '/out/vm1_Image /out/vm1.sig", "No closing quotation"),
+])
+def test_read_batch_reports_bad_lines(tmp_path, caplog, line, message):
+    batch = tmp_path / "batch.txt"
+    batch.write_text("# header\n\n" + line + "\n")
+
+    with pytest.raises(SystemExit) as exit_info:
+        read_batch(str(batch), logger)
+
+    assert exit_info.value.code == 1
+    assert caplog.messages == [f"{batch}:3: {message}"]
@@ -120,8 +120,11 @@ linux-cleaner: linux-cleaner-common
 
 linux-vm: linux buildroot-sub
 
+# global job budget shared by concurrently built VMs (default: CPU count)
+VM_JOBS_FLAG = $(if $(VM_JOBS),--jobs $(VM_JOBS))
+
 vms-rebuild: 
-	$(BUILD_SCRIPTS)/build_peregrine.py --rebuild --vms-only -configfile $(PLATFORM_CONFIG_FILE)
+	$(BUILD_SCRIPTS)/build_peregrine.py --rebuild --vms-only $(VM_JOBS_FLAG) -configfile $(PLATFORM_CONFIG_FILE)
 	$(BUILD_SCRIPTS)/build_peregrine.py -wrap arm-tf --vms-only -configfile $(PLATFORM_CONFIG_FILE)
 
 vms: 
@@ -129,5 +132,5 @@ vms:
 	# cp $(ANDROID_PATH)/kernel $(ROOT)/out/cpio/
 	# cp $(ANDROID_PATH)/combined-ramdisk.img $(ROOT)/out/cpio/
 	# cp $(ANDROID_PATH)/devtree.dtb $(ROOT)/out/cpio/
-	$(BUILD_SCRIPTS)/build_peregrine.py --vms-only -configfile $(PLATFORM_CONFIG_FILE)
+	$(BUILD_SCRIPTS)/build_peregrine.py --vms-only $(VM_JOBS_FLAG) -configfile $(PLATFORM_CONFIG_FILE)
 	